@@ -1,35 +1,118 @@
 # blur_detection_model.py
 
+import argparse
+
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
 class BlurDetectionModel(nn.Module):
+    """
+        Three conv/batch norm/ReLU/max pool stages and a global average
+        pooled head, so any input size works (224x224 in training and
+        inference). Outputs the probability that the image is blurry.
+    """
     def __init__(self):
         super(BlurDetectionModel, self).__init__()
         self.conv1 = nn.Conv2d(3, 32, kernel_size=3, stride=1, padding=1)
-        self.bn1 = nn.BatchNorm2d(32) 
+        self.bn1 = nn.BatchNorm2d(32)
         self.conv2 = nn.Conv2d(32, 64, kernel_size=3, stride=1, padding=1)
+        self.bn2 = nn.BatchNorm2d(64)
         self.conv3 = nn.Conv2d(64, 128, kernel_size=3, stride=1, padding=1)
+        self.bn3 = nn.BatchNorm2d(128)
         self.pool = nn.MaxPool2d(kernel_size=2, stride=2, padding=0)
+        # global average pooling replaces the 128 * 28 * 28 flatten, which
+        # tied the model to 224x224 inputs and held 12.8M of fc1's weights
+        self.gap = nn.AdaptiveAvgPool2d(1)
         self.dropout = nn.Dropout(0.5)
-        self.fc1 = nn.Linear(128 * 28 * 28, 128)
+        self.fc1 = nn.Linear(128, 128)
         self.fc2 = nn.Linear(128, 1)
-        
+
     def forward(self, x):
-        x = self.pool(F.relu(self.conv1(x)))
-        x = self.pool(F.relu(self.conv2(x)))
-        x = self.pool(F.relu(self.conv3(x)))
-        x = x.view(-1, 128 * 28 * 28)
         x = self.pool(F.relu(self.bn1(self.conv1(x))))
+        x = self.pool(F.relu(self.bn2(self.conv2(x))))
+        x = self.pool(F.relu(self.bn3(self.conv3(x))))
+        x = torch.flatten(self.gap(x), 1)
         x = self.dropout(x)
+        x = F.relu(self.fc1(x))
         x = torch.sigmoid(self.fc2(x))
         return x
 
-def save_model():
-    model = BlurDetectionModel()
-    torch.save(model.state_dict(), "blur_detection_model.pth")
+
+class SeparableConv(nn.Module):
+    """
+        Depthwise 3x3 convolution followed by a pointwise 1x1 convolution,
+        each with batch norm and ReLU: about 8x fewer multiply-adds than a
+        full 3x3 convolution with the same channels.
+    """
+    def __init__(self, in_channels, out_channels, stride=1):
+        super(SeparableConv, self).__init__()
+        self.depthwise = nn.Conv2d(in_channels, in_channels, kernel_size=3, stride=stride, padding=1,
+                                   groups=in_channels, bias=False)
+        self.bn1 = nn.BatchNorm2d(in_channels)
+        self.pointwise = nn.Conv2d(in_channels, out_channels, kernel_size=1, bias=False)
+        self.bn2 = nn.BatchNorm2d(out_channels)
+
+    def forward(self, x):
+        x = F.relu(self.bn1(self.depthwise(x)))
+        return F.relu(self.bn2(self.pointwise(x)))
+
+
+class FastBlurDetectionModel(nn.Module):
+    """
+        CPU variant of BlurDetectionModel: a full 3x3 stem at full
+        resolution (blur lives in the finest details) and depthwise
+        separable stages that halve the resolution, with the same global
+        average pooled head and output.
+    """
+    def __init__(self):
+        super(FastBlurDetectionModel, self).__init__()
+        self.stem = nn.Conv2d(3, 16, kernel_size=3, stride=1, padding=1, bias=False)
+        self.bn = nn.BatchNorm2d(16)
+        self.stages = nn.Sequential(
+            SeparableConv(16, 32, stride=2),
+            SeparableConv(32, 64, stride=2),
+            SeparableConv(64, 128, stride=2),
+            SeparableConv(128, 128, stride=2),
+        )
+        self.gap = nn.AdaptiveAvgPool2d(1)
+        self.dropout = nn.Dropout(0.2)
+        self.fc = nn.Linear(128, 1)
+
+    def forward(self, x):
+        x = F.relu(self.bn(self.stem(x)))
+        x = self.stages(x)
+        x = torch.flatten(self.gap(x), 1)
+        x = self.dropout(x)
+        x = torch.sigmoid(self.fc(x))
+        return x
+
+
+# Model classes by name, for the command line tools and load_model
+ARCHITECTURES = {
+    'cnn': BlurDetectionModel,
+    'fast': FastBlurDetectionModel,
+}
+
+
+def quantize_dynamic(model):
+    """
+        quantize_dynamic: int8 dynamic quantization of the Linear layers
+                        (weights stored as int8, activations quantized on
+                        the fly). Convolutions stay float32, dynamic
+                        quantization does not cover them.
+    """
+    return torch.ao.quantization.quantize_dynamic(model.eval(), {nn.Linear}, dtype=torch.qint8)
+
+
+def save_model(architecture='cnn', path="blur_detection_model.pth"):
+    model = ARCHITECTURES[architecture]()
+    torch.save(model.state_dict(), path)
     print("Model saved successfully.")
 
 if __name__ == "__main__":
-    save_model()
+    parser = argparse.ArgumentParser(description="Save an initialized blur detection model.")
+    parser.add_argument('--architecture', choices=sorted(ARCHITECTURES), default='cnn')
+    parser.add_argument('-o', '--output', default="blur_detection_model.pth")
+    args = parser.parse_args()
+    save_model(args.architecture, args.output)
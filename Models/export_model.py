@@ -0,0 +1,101 @@
+# export_model.py
+
+import argparse
+
+import numpy as np
+
+# Input the exported graphs are traced with; batch, height and width stay
+# dynamic in the ONNX graph
+EXAMPLE_SHAPE = (1, 3, 224, 224)
+
+
+def export_torchscript(model, path):
+    """
+        export_torchscript: save the model as TorchScript, which
+                        torch.jit.load runs without the model classes and
+                        without importing mlflow. Works for int8 quantized
+                        models too.
+    """
+    import torch
+
+    with torch.inference_mode():
+        scripted = torch.jit.trace(model.eval(), torch.rand(EXAMPLE_SHAPE))
+    scripted.save(path)
+    return path
+
+
+def export_onnx(model, path):
+    """
+        export_onnx: save the (float) model as ONNX for onnxruntime, with
+                    dynamic batch size and image size. The weights are
+                    kept inside the one .onnx file.
+    """
+    import torch
+
+    torch.onnx.export(model.eval(), (torch.rand(EXAMPLE_SHAPE),), path, input_names=['image'],
+                      output_names=['score'], dynamic_axes={'image': {0: 'batch', 2: 'height', 3: 'width'},
+                                                            'score': {0: 'batch'}},
+                      external_data=False, verbose=False)
+    return path
+
+
+class OnnxBlurModel:
+    """
+        onnxruntime session that can be used like the torch model: called
+        with a (N, 3, H, W) tensor, returns the (N, 1) scores as a tensor.
+        run does the same on numpy arrays, without importing torch, which
+        is how BlurInferenceServer uses it.
+
+        Params:
+            - path: ONNX file from export_onnx
+            - num_threads: intra-op threads, onnxruntime's default when None
+    """
+    def __init__(self, path, num_threads=None):
+        import onnxruntime
+
+        options = onnxruntime.SessionOptions()
+        if num_threads:
+            options.intra_op_num_threads = num_threads
+        self.session = onnxruntime.InferenceSession(path, options, providers=['CPUExecutionProvider'])
+        self.input_name = self.session.get_inputs()[0].name
+
+    def eval(self):
+        return self
+
+    def run(self, images):
+        scores, = self.session.run(None, {self.input_name: np.ascontiguousarray(images, dtype=np.float32)})
+        return scores
+
+    def __call__(self, images):
+        import torch
+
+        return torch.from_numpy(self.run(images.numpy()))
+
+
+def main():
+    from blur_detection_model import ARCHITECTURES, quantize_dynamic
+
+    parser = argparse.ArgumentParser(description="Export a blur detection model to TorchScript and/or ONNX.")
+    parser.add_argument('--architecture', choices=sorted(ARCHITECTURES), default='cnn')
+    parser.add_argument('--weights', help="state dict (.pth); the MLflow model when not given")
+    parser.add_argument('--quantize', action='store_true', help="int8 dynamic quantization (TorchScript only)")
+    parser.add_argument('--torchscript', help="TorchScript file to write (.pt)")
+    parser.add_argument('--onnx', help="ONNX file to write (.onnx)")
+    args = parser.parse_args()
+    if not args.torchscript and not args.onnx:
+        parser.error("give --torchscript and/or --onnx")
+    if args.quantize and args.onnx:
+        parser.error("quantized models are exported to TorchScript only")
+
+    from inference_server import load_model
+    model = load_model(weights_path=args.weights, architecture=args.architecture)
+    if args.quantize:
+        model = quantize_dynamic(model)
+    if args.torchscript:
+        print(f"TorchScript -> {export_torchscript(model, args.torchscript)}")
+    if args.onnx:
+        print(f"ONNX -> {export_onnx(model, args.onnx)}")
+
+
+if __name__ == "__main__":
+    main()
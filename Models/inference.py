@@ -1,47 +1,50 @@
 # inference.py
 
-import torch
-from torchvision import transforms
-from PIL import Image
-import mlflow.pytorch
-from blur_detection_model import BlurDetectionModel
-
-def process_image(image_path):
-    # Load and transform the image
-    transform = transforms.Compose([
-    transforms.Resize((224, 224)),
-    transforms.RandomHorizontalFlip(),  # Keep existing augmentations
-    transforms.RandomRotation(10),
-    transforms.GaussianBlur(kernel_size=5),  # Simulate blur
-    transforms.ToTensor(),
-    ])
-    
-    image = Image.open(image_path)
-    image = transform(image).unsqueeze(0)
-
-    # Load the model from MLflow
-    logged_model = 'runs:/0bf9391ec64a403e91b3d49880c27c4f/blur_detection_model'
-    model = mlflow.pytorch.load_model(logged_model)
-
-    # Set the model to evaluation mode
-    model.eval()
-
-    # Run inference
-    with torch.no_grad():
-        output = model(image)
-    
+import argparse
+import sys
+
+from inference_server import THRESHOLD, default_logger, get_server
+
+DEFAULT_IMAGES = ['..//Dataset//Non_Blurry_folder//image_34.jpg']
+
+def process_image(image_path, server=None):
+    # The model is loaded once per process and shared by every call; the
+    # server batches concurrent calls and logs aggregates to MLflow. main()
+    # passes the server of its command line options
+    if server is None:
+        server = get_server()
+    score = server.predict(image_path)
+
     # Process the output
-    threshold = 0.6  # You can tune this
-    prediction = (output >= threshold).item() # 0 or 1 for blur detection
+    prediction = int(score >= server.threshold) # 0 or 1 for blur detection
     if prediction:
         print("The image is blurry.")
     else:
         print("The image is not blurry.")
-    
-    # Log the result to MLflow
-    with mlflow.start_run():
-        mlflow.log_param("image_path", image_path)
-        mlflow.log_metric("blur_prediction", prediction)
-
-# Example usage
-process_image('..//Dataset//Non_Blurry_folder//image_34.jpg')
+    return prediction
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Tell whether images are blurry.")
+    parser.add_argument('images', nargs='*', default=DEFAULT_IMAGES, help="image files")
+    parser.add_argument('--weights', help="exported model (.onnx, .pt) or state dict (.pth); "
+                                          "the MLflow model when not given")
+    parser.add_argument('--architecture', default='cnn', help="model class of a .pth state dict ('cnn' or 'fast')")
+    parser.add_argument('--threshold', type=float, default=THRESHOLD, help="score at or above which an image is blurry")
+    parser.add_argument('--no-mlflow', action='store_true', help="do not log aggregates to MLflow")
+    args = parser.parse_args(argv)
+
+    # torch, onnxruntime and mlflow are only imported for the model that is
+    # actually used: an ONNX model with --no-mlflow needs neither torch nor mlflow
+    server = get_server(weights_path=args.weights, architecture=args.architecture, threshold=args.threshold,
+                        logger=None if args.no_mlflow else default_logger())
+    try:
+        for path in args.images:
+            print(f"{path}: ", end='')
+            process_image(path, server)
+    finally:
+        # flushes the last MLflow aggregates before the process exits
+        server.close()
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
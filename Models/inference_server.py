@@ -0,0 +1,334 @@
+# inference_server.py
+
+import importlib.util
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+import numpy as np
+from PIL import Image
+
+# torch is imported by the functions that need it: a server on an ONNX
+# model runs on numpy and onnxruntime alone and starts without it
+from export_model import OnnxBlurModel
+
+# Model logged by log_model_mlflow.py, the one inference.py always used
+MODEL_URI = 'runs:/0bf9391ec64a403e91b3d49880c27c4f/blur_detection_model'
+THRESHOLD = 0.6
+# helper.detect_blur threshold the pipeline compares Laplacian variance to
+BLUR_THRESHOLD = 100
+
+# Input size of the blur detection models
+INFERENCE_SIZE = (224, 224)
+
+
+def preprocess(image):
+    """
+        preprocess: deterministic preprocessing of a PIL image, the same
+                    (3, 224, 224) float32 values in [0, 1] that
+                    transforms.Resize((224, 224)) and ToTensor give, without
+                    importing torchvision. The random flips, rotations and
+                    blur inference.py used are training augmentations and
+                    made predictions vary from call to call.
+    """
+    array = np.asarray(image.convert('RGB').resize(INFERENCE_SIZE[::-1], Image.BILINEAR), dtype=np.float32)
+    return np.ascontiguousarray(array.transpose(2, 0, 1)) / np.float32(255)
+
+
+def load_model(model_uri=MODEL_URI, weights_path=None, architecture='cnn'):
+    """
+        load_model: load the blur detection model once, in evaluation mode.
+
+        Exported models (export_model.py) start fastest: TorchScript needs
+        neither the model classes nor mlflow, ONNX runs on onnxruntime.
+
+        Params:
+            - model_uri: MLflow model URI, used when weights_path is None
+            - weights_path: TorchScript (.pt), ONNX (.onnx) or a state dict
+            saved by blur_detection_model.py (.pth)
+            - architecture: model class of a state dict ('cnn' or 'fast')
+
+        returns:
+            - the model on CPU
+    """
+    if weights_path is not None and weights_path.endswith('.onnx'):
+        return OnnxBlurModel(weights_path)
+    import torch
+
+    if weights_path is not None and weights_path.endswith(('.pt', '.ptl')):
+        return torch.jit.load(weights_path, map_location='cpu').eval()
+    if weights_path is not None:
+        from blur_detection_model import ARCHITECTURES
+        model = ARCHITECTURES[architecture]()
+        model.load_state_dict(torch.load(weights_path, map_location='cpu'))
+    else:
+        import mlflow.pytorch
+        model = mlflow.pytorch.load_model(model_uri, map_location='cpu')
+    return model.eval()
+
+
+def forward(model, batch):
+    """
+        forward: blur scores of a (N, 3, H, W) float32 batch as a flat
+                numpy array.
+    """
+    if isinstance(model, OnnxBlurModel):
+        return model.run(batch).reshape(-1)
+    import torch
+
+    with torch.inference_mode():
+        return model(torch.from_numpy(batch)).reshape(-1).numpy()
+
+
+def configure_threads(num_threads=None):
+    """
+        configure_threads: intra-op threads for the batched forward pass.
+                        Batches run one at a time, so they get every core;
+                        inter-op parallelism only adds contention here.
+    """
+    import torch
+
+    torch.set_num_threads(num_threads or os.cpu_count() or 1)
+    try:
+        torch.set_num_interop_threads(1)
+    except RuntimeError:
+        # can only be set before the first parallel work has started
+        pass
+
+
+class MLflowAggregator:
+    """
+        Collects predictions and logs aggregate metrics to one MLflow run
+        from a background thread, instead of starting a run per image.
+
+        Params:
+            - experiment: MLflow experiment name
+            - flush_interval: seconds between logged aggregates
+    """
+    def __init__(self, experiment='Blur Detection Inference', flush_interval=30.0):
+        self.experiment = experiment
+        self.flush_interval = flush_interval
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name='mlflow-aggregator', daemon=True)
+        self._thread.start()
+
+    def record(self, scores, predictions, batch_size, seconds):
+        self._queue.put((scores, predictions, batch_size, seconds))
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
+
+    def _run(self):
+        import mlflow
+
+        mlflow.set_experiment(self.experiment)
+        with mlflow.start_run(run_name='inference-server'):
+            step = 0
+            pending = []
+            deadline = time.monotonic() + self.flush_interval
+            while True:
+                try:
+                    item = self._queue.get(timeout=max(0.0, deadline - time.monotonic()))
+                except queue.Empty:
+                    item = False
+                if item:
+                    pending.append(item)
+                if item is None or time.monotonic() >= deadline:
+                    if pending:
+                        self._flush(mlflow, pending, step)
+                        step += 1
+                        pending = []
+                    deadline = time.monotonic() + self.flush_interval
+                if item is None:
+                    return
+
+    @staticmethod
+    def _flush(mlflow, pending, step):
+        scores = np.concatenate([scores for scores, _, _, _ in pending])
+        predictions = np.concatenate([predictions for _, predictions, _, _ in pending])
+        mlflow.log_metrics({
+            'images': float(len(scores)),
+            'blurry_fraction': float(predictions.mean()),
+            'mean_score': float(scores.mean()),
+            'mean_batch_size': float(np.mean([batch_size for _, _, batch_size, _ in pending])),
+            'mean_batch_seconds': float(np.mean([seconds for _, _, _, seconds in pending])),
+        }, step=step)
+
+
+def default_logger():
+    """
+        default_logger: an MLflowAggregator when mlflow is installed, None
+                        otherwise (its thread would die on the import).
+    """
+    if importlib.util.find_spec('mlflow') is None:
+        return None
+    return MLflowAggregator()
+
+
+class BlurInferenceServer:
+    """
+        Long-lived blur detection: the model is loaded once and concurrent
+        requests are coalesced into micro-batches. A batch runs as soon as it
+        has max_batch_size images, or max_wait_ms after its first image
+        arrived, whichever comes first.
+
+        Params:
+            - model: blur detection model from load_model, in evaluation mode
+            - threshold: score at or above which an image is blurry
+            - max_batch_size: largest batch per forward pass
+            - max_wait_ms: how long the first image of a batch waits for more
+            - num_threads: torch intra-op threads, all cores when None (torch
+            models; an ONNX session has its own)
+            - logger: MLflowAggregator, or None to not log
+    """
+    def __init__(self, model, threshold=THRESHOLD, max_batch_size=16, max_wait_ms=5.0,
+                 num_threads=None, logger=None):
+        self.model = model.eval()
+        self.threshold = threshold
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.0
+        self.logger = logger
+        if not isinstance(model, OnnxBlurModel):
+            configure_threads(num_threads)
+        self._queue = queue.Queue()
+        # guards closed, so no image is queued behind the stop marker
+        self._lock = threading.Lock()
+        self.closed = False
+        self._thread = threading.Thread(target=self._run, name='blur-inference', daemon=True)
+        self._thread.start()
+
+    def submit(self, image):
+        """
+            submit: queue one image.
+
+            Params:
+                - image: PIL image, RGB numpy array or image path
+
+            returns:
+                - Future resolving to the blur score (probability of blur)
+
+            Raises RuntimeError once the server is closed.
+        """
+        if isinstance(image, np.ndarray):
+            image = Image.fromarray(image)
+        elif not isinstance(image, Image.Image):
+            with Image.open(image) as opened:
+                image = opened.convert('RGB')
+        # preprocessing runs on the caller's thread, in parallel with the
+        # batch being computed
+        array = preprocess(image)
+        future = Future()
+        with self._lock:
+            if self.closed:
+                raise RuntimeError("the inference server is closed")
+            self._queue.put((array, future))
+        return future
+
+    def predict(self, image):
+        return self.submit(image).result()
+
+    def predict_many(self, images):
+        futures = [self.submit(image) for image in images]
+        return [future.result() for future in futures]
+
+    def is_blurry(self, image):
+        return self.predict(image) >= self.threshold
+
+    def detect_blur(self, image_np):
+        """
+            detect_blur: drop-in replacement for helper.detect_blur.
+
+            The blur score is mapped onto the Laplacian variance scale so
+            that lower means blurrier and the model threshold lands on
+            BLUR_THRESHOLD: a score of 0 gives BLUR_THRESHOLD / (1 -
+            threshold), a score of 1 gives 0.
+
+            Params:
+                - image_np: Numpy array of the image (RGB)
+
+            return:
+                - Blurness of the image
+        """
+        score = self.predict(image_np)
+        return BLUR_THRESHOLD * (1.0 - score) / (1.0 - self.threshold)
+
+    def close(self):
+        with self._lock:
+            if self.closed:
+                return
+            self.closed = True
+            self._queue.put(None)
+        self._thread.join()
+        if self.logger is not None:
+            self.logger.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _next_batch(self):
+        first = self._queue.get()
+        if first is None:
+            return None, True
+        batch = [first]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if item is None:
+                return batch, True
+            batch.append(item)
+        return batch, False
+
+    def _run(self):
+        stop = False
+        while not stop:
+            batch, stop = self._next_batch()
+            if not batch:
+                continue
+            futures = [future for _, future in batch]
+            start = time.perf_counter()
+            try:
+                scores = forward(self.model, np.stack([array for array, _ in batch]))
+            except Exception as e:
+                for future in futures:
+                    future.set_exception(e)
+                continue
+            seconds = time.perf_counter() - start
+            for future, score in zip(futures, scores):
+                future.set_result(float(score))
+            if self.logger is not None:
+                self.logger.record(scores, scores >= self.threshold, len(batch), seconds)
+
+
+_servers = {}
+_server_lock = threading.Lock()
+
+
+def get_server(**options):
+    """
+        get_server: the process-wide BlurInferenceServer of these options,
+                started on first use with the model from MODEL_URI (or
+                load_model options). Calls with other options get a server
+                of their own; a closed server is started again.
+    """
+    key = tuple(sorted(options.items()))
+    with _server_lock:
+        server = _servers.get(key)
+        if server is None or server.closed:
+            model_options = {name: options.pop(name) for name in ('model_uri', 'weights_path', 'architecture')
+                             if name in options}
+            if 'logger' not in options:
+                options['logger'] = default_logger()
+            server = _servers[key] = BlurInferenceServer(load_model(**model_options), **options)
+        return server
@@ -0,0 +1,252 @@
+# shard_dataset.py
+
+import argparse
+import json
+import os
+import sys
+
+import numpy as np
+import torch
+from torch.utils.data import Dataset
+from PIL import Image
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp', '.tif', '.tiff', '.webp')
+
+# Images per shard file and the side images are stored at, the input size
+# of BlurDetectionModel and inference_server.preprocess
+SHARD_SIZE = 1024
+IMAGE_SIZE = 224
+
+INDEX_FILE = 'index.json'
+LABELS_FILE = 'labels.npy'
+PATHS_FILE = 'paths.txt'
+
+
+def shard_file(number):
+    return f'shard-{number:05d}.npy'
+
+
+def find_images(root, classes=None):
+    """
+        find_images: (path, label) of every image in a folder with one
+                    sub-folder per class, the layout torchvision's
+                    ImageFolder reads.
+
+        Params:
+            - root: dataset folder, e.g. ../Dataset_blurred/train
+            - classes: class folder names in label order, by default the
+            sorted sub-folders (ImageFolder's labels)
+
+        returns:
+            - list of class names and a sorted list of (path, label)
+    """
+    if classes is None:
+        classes = sorted(entry.name for entry in os.scandir(root) if entry.is_dir())
+    samples = []
+    for label, name in enumerate(classes):
+        for folder, dirs, files in os.walk(os.path.join(root, name)):
+            dirs.sort()
+            for file_name in sorted(files):
+                if file_name.lower().endswith(IMAGE_EXTENSIONS):
+                    samples.append((os.path.join(folder, file_name), label))
+    return list(classes), samples
+
+
+def load_resized(path, size=IMAGE_SIZE):
+    """
+        load_resized: RGB uint8 array of an image resized to size x size,
+                    the same pixels transforms.Resize((size, size)) gives.
+    """
+    with Image.open(path) as image:
+        image = image.convert('RGB').resize((size, size), Image.BILINEAR)
+    return np.asarray(image)
+
+
+def read_index(directory):
+    """
+        read_index: the index of a packed dataset (image size, classes and
+                    images per shard), its labels and source paths.
+    """
+    with open(os.path.join(directory, INDEX_FILE), 'r') as f:
+        index = json.load(f)
+    count = index['count']
+    labels = np.load(os.path.join(directory, LABELS_FILE))[:count]
+    with open(os.path.join(directory, PATHS_FILE), 'r') as f:
+        paths = [line.rstrip('\n') for _, line in zip(range(count), f)]
+    return index, labels, paths
+
+
+def _write_index(directory, index, labels):
+    # labels first, the index (with the count readers trust) last and
+    # atomically, so an interrupted append leaves the old dataset readable
+    np.save(os.path.join(directory, LABELS_FILE + '.part.npy'), labels)
+    os.replace(os.path.join(directory, LABELS_FILE + '.part.npy'), os.path.join(directory, LABELS_FILE))
+    tmp_path = os.path.join(directory, INDEX_FILE + '.part')
+    with open(tmp_path, 'w') as f:
+        json.dump(index, f, indent=2)
+    os.replace(tmp_path, os.path.join(directory, INDEX_FILE))
+
+
+def pack(root, directory, classes=None, size=IMAGE_SIZE, shard_size=SHARD_SIZE, log=print):
+    """
+        pack: decode and resize the images of an ImageFolder layout once
+            and store them in fixed-size uint8 shards, appending to the
+            dataset in directory when it exists. Images already in the
+            dataset (same source path) are skipped, so packing a folder
+            again only adds its new images.
+
+        Shards are .npy files of shard_size x size x size x 3 bytes written
+        through memory maps; the last one is filled up by later appends.
+
+        Params:
+            - root: dataset folder with one sub-folder per class
+            - directory: packed dataset folder
+            - classes: class folder names in label order (see find_images)
+            - size: side of the stored images
+            - shard_size: images per shard
+            - log: function used for progress and error lines
+
+        returns:
+            - number of images added
+    """
+    os.makedirs(directory, exist_ok=True)
+    if os.path.exists(os.path.join(directory, INDEX_FILE)):
+        index, labels, paths = read_index(directory)
+        if classes is not None and list(classes) != index['classes']:
+            raise ValueError(f"{directory} has classes {index['classes']}, not {list(classes)}")
+        # labels of an existing dataset stay as they are
+        classes, samples = find_images(root, index['classes'])
+        size, shard_size = index['image_size'], index['shard_size']
+    else:
+        classes, samples = find_images(root, classes)
+        index = {'image_size': size, 'shard_size': shard_size, 'classes': classes, 'count': 0}
+        labels, paths = np.empty(0, dtype=np.int64), []
+
+    known = set(paths)
+    samples = [(path, label) for path, label in samples if path not in known]
+    count = index['count']
+    new_labels = []
+    shard, shard_number = None, None
+    paths_path = os.path.join(directory, PATHS_FILE)
+    if os.path.exists(paths_path):
+        # drop paths an interrupted append wrote past the count
+        offset = 0
+        with open(paths_path, 'rb') as f:
+            for _ in paths:
+                offset += len(f.readline())
+        os.truncate(paths_path, offset)
+    with open(paths_path, 'a') as paths_file:
+        for path, label in samples:
+            try:
+                image = load_resized(path, size)
+            except Exception as e:
+                log(f"SKIPPED {path}: {type(e).__name__}: {e}")
+                continue
+            number, row = divmod(count, shard_size)
+            if number != shard_number:
+                if shard is not None:
+                    shard.flush()
+                shard_path = os.path.join(directory, shard_file(number))
+                if os.path.exists(shard_path):
+                    shard = np.load(shard_path, mmap_mode='r+')
+                else:
+                    shard = np.lib.format.open_memmap(shard_path, mode='w+', dtype=np.uint8,
+                                                      shape=(shard_size, size, size, 3))
+                shard_number = number
+            shard[row] = image
+            paths_file.write(path + '\n')
+            new_labels.append(label)
+            count += 1
+            if count % shard_size == 0:
+                log(f"{count} images packed")
+    if shard is not None:
+        shard.flush()
+        del shard
+
+    index['count'] = count
+    _write_index(directory, index, np.concatenate([labels, np.asarray(new_labels, dtype=np.int64)]))
+    return len(new_labels)
+
+
+class ShardedImageDataset(Dataset):
+    """
+        PyTorch Dataset over a packed dataset: random access to any image
+        without decoding, read straight from the memory mapped shards.
+
+        Shards are opened lazily in the process that reads them, so
+        DataLoader workers each map the same files and share their pages
+        through the OS page cache instead of copying the data.
+
+        Params:
+            - directory: packed dataset folder (see pack)
+            - transform: applied to the (3, H, W) float tensor in [0, 1]
+            (what ToTensor gives), None to leave it as is
+            - raw: return the (H, W, 3) uint8 array instead, e.g. for
+            augmentations on the uint8 image
+
+        returns (per item):
+            - image tensor and label
+    """
+    def __init__(self, directory, transform=None, raw=False):
+        self.directory = directory
+        self.transform = transform
+        self.raw = raw
+        index, labels, paths = read_index(directory)
+        self.classes = index['classes']
+        self.shard_size = index['shard_size']
+        self.image_size = index['image_size']
+        self.labels = labels
+        self.paths = paths
+        self._shards = {}
+
+    def __len__(self):
+        return len(self.labels)
+
+    def __getstate__(self):
+        # memory maps are not sent to DataLoader workers, they reopen them
+        state = self.__dict__.copy()
+        state['_shards'] = {}
+        return state
+
+    def _shard(self, number):
+        shard = self._shards.get(number)
+        if shard is None:
+            shard = np.load(os.path.join(self.directory, shard_file(number)), mmap_mode='r')
+            self._shards[number] = shard
+        return shard
+
+    def __getitem__(self, item):
+        if item < 0:
+            item += len(self)
+        if not 0 <= item < len(self):
+            raise IndexError(f"index {item} out of range for {len(self)} images")
+        number, row = divmod(item, self.shard_size)
+        image = np.array(self._shard(number)[row])
+        label = int(self.labels[item])
+        if self.raw:
+            return image, label
+        tensor = torch.from_numpy(image).permute(2, 0, 1).float().div_(255)
+        if self.transform is not None:
+            tensor = self.transform(tensor)
+        return tensor, label
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Pack an image folder dataset into memory mapped shards.")
+    parser.add_argument('root', help="dataset folder with one sub-folder per class")
+    parser.add_argument('output', help="packed dataset folder; an existing one is appended to")
+    parser.add_argument('--classes', nargs='+', help="class folders in label order (default: sorted)")
+    parser.add_argument('--size', type=int, default=IMAGE_SIZE, help="side of the stored images")
+    parser.add_argument('--shard-size', type=int, default=SHARD_SIZE, help="images per shard")
+    args = parser.parse_args(argv)
+
+    added = pack(args.root, args.output, args.classes, args.size, args.shard_size,
+                 log=lambda line: print(line, file=sys.stderr))
+    index, labels, _ = read_index(args.output)
+    counts = ', '.join(f"{name}: {int((labels == label).sum())}" for label, name in enumerate(index['classes']))
+    print(f"{added} images added, {index['count']} in {args.output} ({counts})")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,277 @@
+"""
+    batch_enhance: headless batch enhancement over directories, globs,
+                file lists or S3/GCS prefixes, spread over a process pool.
+
+    Usage:
+        cd app
+        python batch_enhance.py ../Dataset/catalog -o ../OutputImages
+        python batch_enhance.py "../Dataset/**/*.jpg" -o ../OutputImages -j 8
+        python batch_enhance.py s3://bucket/catalog -o s3://bucket/enhanced
+        python batch_enhance.py ../Dataset/catalog -o ../OutputImages --fast
+
+    Outputs that already exist are skipped, so an interrupted run can be
+    started again with the same arguments and only does the missing work.
+    --fast takes the fast path of the strategy section: the fast_name
+    recommendation, no denoising or deblurring.
+"""
+import argparse
+import glob
+import os
+import sys
+import threading
+import time
+
+from utility.image_io import decode, encode, output_settings
+from utility.config import load_thresholds
+from utility.pipeline import enhance_image
+from utility.storage import STATS, LocalStorage, Uploader, is_url, open_storage, prefetch, storage_settings
+from utility.strategies import fast_path_thresholds
+from utility.workers import process_pool, run_bounded, worker_state
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp', '.tif', '.tiff', '.webp')
+
+
+def glob_root(pattern):
+    # the leading path components of a glob pattern without wildcards
+    parts = []
+    for part in pattern.replace(os.sep, '/').split('/'):
+        if glob.has_magic(part):
+            break
+        parts.append(part)
+    return '/'.join(parts) or ('/' if pattern.startswith('/') else '.')
+
+
+def iter_inputs(inputs):
+    """
+        iter_inputs: expand directories, glob patterns and files into
+                    (source path, relative output name) pairs.
+
+        Params:
+            - inputs: list of directories, glob patterns or file paths
+
+        returns:
+            - generator of (source path, relative output name) tuples
+    """
+    for item in inputs:
+        if os.path.isdir(item):
+            for root, dirs, files in os.walk(item):
+                dirs.sort()
+                for name in sorted(files):
+                    if name.lower().endswith(IMAGE_EXTENSIONS):
+                        path = os.path.join(root, name)
+                        yield path, os.path.relpath(path, item)
+        elif glob.has_magic(item):
+            # names relative to the folder before the first wildcard, so
+            # "**/*.jpg" keeps a/x.jpg and b/x.jpg apart
+            root = glob_root(item)
+            for path in sorted(glob.iglob(item, recursive=True)):
+                if os.path.isfile(path) and path.lower().endswith(IMAGE_EXTENSIONS):
+                    yield path, os.path.relpath(path, root)
+        else:
+            yield item, os.path.basename(item)
+
+
+def output_key_for(relative_name):
+    # enhanced images are always written as JPEG, like the Streamlit app
+    return os.path.splitext(relative_name)[0].replace(os.sep, '/') + '.jpg'
+
+
+def iter_sources(inputs, settings):
+    """
+        iter_sources: iter_inputs for storage locations too.
+
+        Params:
+            - inputs: list of directories, glob patterns, file paths or
+            storage URLs (s3://bucket/prefix, gs://bucket/prefix), every
+            image under a URL prefix being an input
+            - settings: storage_settings
+
+        returns:
+            - generator of (storage, key, relative output name) tuples
+    """
+    local = LocalStorage(settings=settings)
+    for item in inputs:
+        if is_url(item):
+            storage = open_storage(item, settings)
+            for key in storage.list():
+                if key.lower().endswith(IMAGE_EXTENSIONS):
+                    yield storage, key, key
+        else:
+            for path, relative_name in iter_inputs([item]):
+                yield local, path, relative_name
+
+
+def process_one(source, image_bytes, quality):
+    """
+        process_one: enhance a single image inside a worker process. The
+                    main process reads the input and writes the output, so
+                    workers never wait on storage.
+
+        Params:
+            - source: name of the input, for the summary
+            - image_bytes: encoded input image
+            - quality: JPEG quality
+
+        returns:
+            - (source, encoded JPEG or None, megapixels, seconds, error
+            message or None)
+    """
+    start = time.perf_counter()
+    megapixels = 0.0
+    try:
+        thresholds = worker_state()
+        settings = output_settings(thresholds, quality)
+        image, metadata = decode(image_bytes, settings['max_pixels'])
+        del image_bytes
+        megapixels = image.width * image.height / 1e6
+        adjusted_image, _ = enhance_image(image, thresholds)
+        del image
+        encoded = encode(adjusted_image, settings=settings, metadata=metadata)
+    except Exception as e:
+        return source, None, megapixels, time.perf_counter() - start, f"{type(e).__name__}: {e}"
+    return source, encoded, megapixels, time.perf_counter() - start, None
+
+
+def run_batch(inputs, output_dir, thresholds, workers, max_in_flight, quality=95, overwrite=False, log=print):
+    """
+        run_batch: enhance every input image with a bounded process pool.
+
+        Inputs are read ahead of the workers on a thread pool (storage
+        'prefetch' reads in flight) and outputs written back by an Uploader
+        ('upload_workers' writes in flight), both through the pooled clients
+        of utility.storage.
+
+        Params:
+            - inputs: list of directories, glob patterns, file paths or
+            storage URLs
+            - output_dir: root folder or storage URL for enhanced images
+            - thresholds: thresholds dictionary
+            - workers: number of worker processes
+            - max_in_flight: max number of images submitted but not finished
+            - quality: JPEG quality of the outputs
+            - overwrite: re-process images whose output already exists
+            - log: function used for progress and error lines
+
+        returns:
+            - summary dictionary with counts, failures, throughput and the
+            storage counters of the run by backend
+    """
+    summary = {'processed': 0, 'skipped': 0, 'failed': 0, 'megapixels': 0.0, 'failures': []}
+    start = time.perf_counter()
+    settings = storage_settings(thresholds)
+    output = open_storage(output_dir, settings)
+    stats_before = STATS.snapshot()
+    # one listing instead of an exists request per input
+    done_keys = set() if overwrite else set(output.list())
+    lock = threading.Lock()
+
+    def failed(source, error):
+        with lock:
+            summary['failed'] += 1
+            summary['failures'].append((source, error))
+        log(f"FAILED {source}: {error}")
+
+    def to_do():
+        seen_keys = set()
+        for storage, key, relative_name in iter_sources(inputs, settings):
+            output_key = output_key_for(relative_name)
+            # two inputs with one output would overwrite each other
+            if output_key in seen_keys:
+                failed(storage.url(key), f"output {output_key} already belongs to another input")
+                continue
+            seen_keys.add(output_key)
+            if output_key in done_keys:
+                summary['skipped'] += 1
+                continue
+            yield storage, key, output_key
+
+    def uploaded(megapixels):
+        def callback(output_key, error):
+            if error is not None:
+                failed(output.url(output_key), error)
+                return
+            with lock:
+                summary['processed'] += 1
+                summary['megapixels'] += megapixels
+        return callback
+
+    def tasks():
+        for (storage, key, output_key), image_bytes, error in prefetch(to_do(), lambda item: item[0].read(item[1]),
+                                                                        settings['prefetch']):
+            if error is not None:
+                failed(storage.url(key), f"{type(error).__name__}: {error}")
+                continue
+            yield (storage.url(key), output_key), process_one, (storage.url(key), image_bytes, quality)
+            del image_bytes
+
+    with process_pool(workers, thresholds) as pool, Uploader(output, settings['upload_workers']) as uploader:
+        def collect(future, tag):
+            source, output_key = tag
+            try:
+                source, encoded, megapixels, seconds, error = future.result()
+            except Exception as e:
+                # the worker process itself died (e.g. out of memory)
+                encoded, error = None, f"{type(e).__name__}: {e}"
+            if error is not None:
+                failed(source, error)
+                return
+            uploader.submit(output_key, encoded, uploaded(megapixels))
+
+        run_bounded(pool, tasks(), max_in_flight, collect)
+
+    elapsed = time.perf_counter() - start
+    summary['seconds'] = elapsed
+    summary['images_per_second'] = summary['processed'] / elapsed if elapsed > 0 else 0.0
+    summary['megapixels_per_second'] = summary['megapixels'] / elapsed if elapsed > 0 else 0.0
+    summary['storage'] = {}
+    for backend, totals in STATS.snapshot().items():
+        before = stats_before.get(backend, {})
+        summary['storage'][backend] = {key: value - before.get(key, 0) for key, value in totals.items()}
+    return summary
+
+
+def main(argv=None):
+    current_dir = os.path.dirname(os.path.abspath(__file__))
+    parser = argparse.ArgumentParser(description="Enhance many images without the Streamlit UI.")
+    parser.add_argument('inputs', nargs='+', help="directories, glob patterns, image files or "
+                                                    "s3:// / gs:// prefixes")
+    parser.add_argument('-o', '--output-dir', required=True, help="folder or s3:// / gs:// prefix for the "
+                                                                     "enhanced images")
+    parser.add_argument('-c', '--config', default=os.path.join(current_dir, 'config', 'thersholds.yaml'),
+                        help="thresholds yaml file")
+    parser.add_argument('-j', '--workers', type=int, default=os.cpu_count() or 1, help="worker processes")
+    parser.add_argument('--max-in-flight', type=int, default=None,
+                        help="max images queued at once (default: 2 x workers)")
+    parser.add_argument('-q', '--quality', type=int, default=95, help="JPEG quality of the outputs")
+    parser.add_argument('--overwrite', action='store_true', help="re-process images that already have an output")
+    parser.add_argument('--fast', action='store_true', help="fast path: the strategy's fast_name recommendation, "
+                                                            "no denoising or deblurring")
+    args = parser.parse_args(argv)
+
+    thresholds = load_thresholds(args.config)
+    if args.fast:
+        thresholds = fast_path_thresholds(thresholds)
+    max_in_flight = args.max_in_flight or 2 * args.workers
+    summary = run_batch(args.inputs, args.output_dir, thresholds, args.workers, max_in_flight,
+                        quality=args.quality, overwrite=args.overwrite,
+                        log=lambda line: print(line, file=sys.stderr))
+
+    print(f"Processed: {summary['processed']}")
+    print(f"Skipped (already done): {summary['skipped']}")
+    print(f"Failed: {summary['failed']}")
+    print(f"Elapsed: {summary['seconds']:.2f}s")
+    print(f"Throughput: {summary['images_per_second']:.2f} images/s, "
+          f"{summary['megapixels_per_second']:.2f} MP/s")
+    for backend, totals in sorted(summary['storage'].items()):
+        # per stream rates: the seconds add up every transfer
+        for direction in ('read', 'write'):
+            if totals[f'{direction}_count']:
+                megabytes = totals[f'{direction}_bytes'] / 1e6
+                rate = megabytes / totals[f'{direction}_seconds'] if totals[f'{direction}_seconds'] else 0.0
+                print(f"Storage {backend} {direction}: {totals[f'{direction}_count']} objects, {megabytes:.1f} MB, "
+                      f"{rate:.1f} MB/s per stream, {totals[f'{direction}_errors']} errors")
+    return 1 if summary['failed'] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
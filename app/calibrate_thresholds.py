@@ -0,0 +1,366 @@
+"""
+    calibrate_thresholds: learn the low/high thresholds and the
+                recommend_value upper bounds from an image corpus.
+
+    Usage:
+        cd app
+        python calibrate_thresholds.py ../Dataset -o config/calibrated.yaml
+        python calibrate_thresholds.py "../Dataset/**/*.jpg" -o calibrated.yaml --state calibration.json -j 8
+        python calibrate_thresholds.py -o calibrated.yaml --merge machine1.json machine2.json
+
+    The corpus is cut into shards of --shard-size images (in the sorted
+    order iter_inputs lists them); a process pool measures every shard on
+    draft-decoded thumbnails (like dataset_metrics.py) and returns one
+    quantile sketch per metric (utility.sketch), which the parent merges.
+    Memory stays small however large the corpus is: only sketches and a
+    16 character key per finished image are kept.
+
+    With --state the sketches and finished images are checkpointed to a
+    JSON file; running the same command again skips those images, so an
+    interrupted run resumes where it stopped, and images added to the
+    corpus since are measured once, whatever shards they fall in. State files of runs over
+    different parts of a corpus (e.g. on several machines) combine with
+    --merge.
+
+    The output is the base config (-c) with the metric sections replaced:
+    low_threshold, high_threshold and upper_bound at the --low, --high and
+    --upper percentiles. Everything else in the file, comments included,
+    is kept.
+"""
+import argparse
+import hashlib
+import itertools
+import json
+import os
+import sys
+import time
+
+import numpy as np
+import yaml
+
+from batch_enhance import iter_inputs
+from utility.analysis import open_analysis_proxy
+from utility.batch_metrics import analyze_many, renormalize_table
+from utility.config import METRIC_NAMES, load_thresholds
+from utility.pipeline import analysis_settings, memory_budget
+from utility.sketch import QuantileSketch
+from utility.workers import process_pool, run_bounded
+
+# Metrics the sketches are kept for: the thresholded ones plus the noise
+# estimates, for reference
+SKETCHED_METRICS = METRIC_NAMES + ('noise', 'noise_sigma')
+
+# Percentiles printed in the report
+REPORT_PERCENTILES = (1, 5, 25, 50, 75, 95, 99)
+
+STATE_VERSION = 2
+
+
+def path_key(path):
+    # what the state records of a finished image
+    return hashlib.sha1(path.encode()).hexdigest()[:16]
+
+
+def iter_shards(inputs, shard_size, done=()):
+    """
+        iter_shards: (keys, paths) of consecutive groups of the input
+                    images not in done. Finished images are recorded one
+                    by one (path_key), not by shard, so adding or removing
+                    images never makes a resumed run measure an image
+                    twice.
+    """
+    paths = (path for path, _ in iter_inputs(inputs) if path_key(path) not in done)
+    while True:
+        shard = list(itertools.islice(paths, shard_size))
+        if not shard:
+            return
+        yield [path_key(path) for path in shard], shard
+
+
+def _thumbnails(paths, max_pixels, failures):
+    for path in paths:
+        try:
+            proxy, scale = open_analysis_proxy(path, max_pixels)
+            yield path, np.asarray(proxy), scale
+        except Exception as e:
+            failures.append((path, f"{type(e).__name__}: {e}"))
+
+
+def measure_shard(paths, max_pixels, sharpness_exponent, accuracy, budget):
+    """
+        measure_shard: metric sketches of one shard, in a worker process.
+
+        returns:
+            - ({metric: sketch state}, images measured, list of (path,
+            error) of the images that could not be read)
+    """
+    failures = []
+    images, scales = itertools.tee(_thumbnails(paths, max_pixels, failures), 2)
+    table = analyze_many((image for _, image, _ in images), scales=(scale for _, _, scale in scales),
+                         memory_budget=budget)
+    table = renormalize_table(table, sharpness_exponent)
+    sketches = {}
+    for name in SKETCHED_METRICS:
+        sketch = QuantileSketch(accuracy)
+        sketch.add_many(table[name])
+        sketches[name] = sketch.to_dict()
+    return sketches, len(table), failures
+
+
+def new_state(settings):
+    return {'version': STATE_VERSION, 'settings': settings, 'done': [], 'images': 0, 'failed': 0,
+            'sketches': {name: QuantileSketch(settings['accuracy']).to_dict() for name in SKETCHED_METRICS}}
+
+
+def load_state(path, settings=None):
+    """
+        load_state: read a state file; with settings, a missing file gives
+                    a new state and a file written with other settings is
+                    an error (its sketches would not be comparable).
+    """
+    if settings is not None and not os.path.exists(path):
+        return new_state(settings)
+    with open(path, 'r') as f:
+        state = json.load(f)
+    if state.get('version') != STATE_VERSION:
+        raise ValueError(f"{path}: unsupported state version {state.get('version')!r}")
+    if settings is not None and state['settings'] != settings:
+        raise ValueError(f"{path} was written with {state['settings']}, not {settings}; "
+                         f"use another --state file or the same settings")
+    return state
+
+
+def save_state(state, path):
+    # write then rename, a killed run never leaves a half written state
+    tmp_path = path + '.part'
+    with open(tmp_path, 'w') as f:
+        json.dump(state, f)
+    os.replace(tmp_path, path)
+
+
+def merge_state(state, other):
+    """
+        merge_state: fold another state (images measured elsewhere) into
+                    state. Images both have measured would be counted
+                    twice, so overlapping states are refused.
+    """
+    if other['settings']['accuracy'] != state['settings']['accuracy']:
+        raise ValueError("states with different sketch accuracy cannot be merged")
+    overlap = set(state['done']) & set(other['done'])
+    if overlap:
+        raise ValueError(f"{len(overlap)} images were measured in both states")
+    for name in SKETCHED_METRICS:
+        merged = QuantileSketch.from_dict(state['sketches'][name]).merge(
+            QuantileSketch.from_dict(other['sketches'][name]))
+        state['sketches'][name] = merged.to_dict()
+    state['done'] = state['done'] + other['done']
+    state['images'] += other['images']
+    state['failed'] += other['failed']
+    return state
+
+
+def run_calibration(inputs, settings, workers, shard_size, state=None, state_path=None,
+                    checkpoint_seconds=30, budget=None, log=print):
+    """
+        run_calibration: measure every shard not yet in the state with a
+                    bounded process pool and merge the sketches.
+
+        Params:
+            - inputs: list of directories, glob patterns or file paths
+            - settings: max_pixels, sharpness_exponent and accuracy of
+            the measurement (a state only continues with the same)
+            - workers: number of worker processes
+            - shard_size: images per shard
+            - state: state to continue, a new one when None
+            - state_path: file the state is checkpointed to, or None
+            - checkpoint_seconds: minimum time between checkpoints
+            - budget: working memory per worker in bytes
+            - log: function used for progress and error lines
+
+        returns:
+            - the updated state
+    """
+    state = state or new_state(settings)
+    done = set(state['done'])
+    sketches = {name: QuantileSketch.from_dict(state['sketches'][name]) for name in SKETCHED_METRICS}
+    start = last_checkpoint = time.perf_counter()
+    measured = 0
+
+    def checkpoint():
+        state['sketches'] = {name: sketch.to_dict() for name, sketch in sketches.items()}
+        state['done'] = sorted(done)
+        if state_path:
+            save_state(state, state_path)
+
+    def collect(future, keys):
+        nonlocal measured, last_checkpoint
+        shard_sketches, count, failures = future.result()
+        for name, sketch in shard_sketches.items():
+            sketches[name].merge(QuantileSketch.from_dict(sketch))
+        # sketches and the finished images are saved together, so a resumed
+        # run never counts an image twice
+        done.update(keys)
+        state['images'] += count
+        state['failed'] += len(failures)
+        measured += count
+        for path, error in failures:
+            log(f"SKIPPED {path}: {error}")
+        if time.perf_counter() - last_checkpoint >= checkpoint_seconds:
+            checkpoint()
+            elapsed = time.perf_counter() - start
+            log(f"{state['images']} images measured ({measured / elapsed:.1f} images/s this run)")
+            last_checkpoint = time.perf_counter()
+
+    tasks = ((keys, measure_shard, (paths, settings['max_pixels'], settings['sharpness_exponent'],
+                                    settings['accuracy'], budget))
+             for keys, paths in iter_shards(inputs, shard_size, done))
+    with process_pool(workers) as pool:
+        run_bounded(pool, tasks, 2 * workers, collect)
+    checkpoint()
+    return state
+
+
+def _round(value):
+    # four significant digits, thresholds are not that precise
+    return float(f"{value:.4g}")
+
+
+def calibrated_sections(state, low, high, upper):
+    """
+        calibrated_sections: metric sections of the thresholds file from
+                    the sketches: the low, high and upper percentiles.
+    """
+    sections = {}
+    for name in METRIC_NAMES:
+        sketch = QuantileSketch.from_dict(state['sketches'][name])
+        if not sketch.count:
+            raise ValueError("no image was measured")
+        sections[name] = {'low_threshold': _round(sketch.percentile(low)),
+                          'high_threshold': _round(sketch.percentile(high)),
+                          'upper_bound': _round(sketch.percentile(upper))}
+    return sections
+
+
+def replace_sections(text, sections):
+    """
+        replace_sections: yaml text with its top level sections named in
+                    sections replaced; the other sections and every
+                    comment are kept as written, new sections go first.
+    """
+    blocks = []
+    current = None
+    for line in text.splitlines(keepends=True):
+        is_key = line[:1] not in ('', ' ', '\t', '#', '\n') and ':' in line
+        if is_key or current is None:
+            current = [line.split(':', 1)[0] if is_key else None, []]
+            blocks.append(current)
+        current[1].append(line)
+
+    def dump(name):
+        return yaml.safe_dump({name: sections[name]}, sort_keys=False, default_flow_style=False)
+
+    def update(name, lines):
+        # the section's key lines get the new values in place, so the
+        # comments between them stay; nested values are dumped whole
+        values = sections[name]
+        if not isinstance(values, dict) or any(isinstance(value, (dict, list)) for value in values.values()):
+            return [dump(name)]
+        updated = [lines[0]]
+        seen = set()
+        for line in lines[1:]:
+            key = line.strip().split(':', 1)[0]
+            if line.startswith(' ') and not line.lstrip().startswith('#') and ':' in line:
+                if key not in values:
+                    continue
+                indent = line[:len(line) - len(line.lstrip())]
+                line = indent + yaml.safe_dump({key: values[key]}, default_flow_style=False)
+                seen.add(key)
+            updated.append(line)
+        updated.extend(f"  {yaml.safe_dump({key: value}, default_flow_style=False)}"
+                       for key, value in values.items() if key not in seen)
+        return updated
+
+    written = set()
+    output = []
+    for name, lines in blocks:
+        if name in sections:
+            # comments trailing a replaced section belong to the next one
+            trailing = []
+            while lines and lines[-1].lstrip().startswith('#') and not lines[-1].startswith(' '):
+                trailing.insert(0, lines.pop())
+            output.extend(update(name, lines))
+            output.extend(trailing)
+            written.add(name)
+        else:
+            output.extend(lines)
+    missing = ''.join(dump(name) for name in sections if name not in written)
+    return missing + ''.join(output)
+
+
+def print_report(state, sections):
+    print(f"{state['images']} images measured, {state['failed']} unreadable")
+    header = ' '.join(f"{'p' + str(p):>9}" for p in REPORT_PERCENTILES)
+    print(f"{'metric':>12} {header}")
+    for name in SKETCHED_METRICS:
+        sketch = QuantileSketch.from_dict(state['sketches'][name])
+        values = ' '.join(f"{sketch.percentile(p):>9.2f}" for p in REPORT_PERCENTILES)
+        print(f"{name:>12} {values}")
+    print()
+    for name, section in sections.items():
+        print(f"{name:>12} low {section['low_threshold']:g}, high {section['high_threshold']:g}, "
+              f"upper bound {section['upper_bound']:g}")
+
+
+def main(argv=None):
+    current_dir = os.path.dirname(os.path.abspath(__file__))
+    parser = argparse.ArgumentParser(description="Calibrate the thresholds from an image corpus.")
+    parser.add_argument('inputs', nargs='*', help="directories, glob patterns or image files")
+    parser.add_argument('-o', '--output', required=True, help="calibrated thresholds yaml to write")
+    parser.add_argument('-c', '--config', default=os.path.join(current_dir, 'config', 'thersholds.yaml'),
+                        help="base thresholds yaml, also the analysis settings of the measurement")
+    parser.add_argument('--state', help="checkpoint file; an existing one is resumed")
+    parser.add_argument('--merge', nargs='+', default=[], help="state files of other runs to combine")
+    parser.add_argument('--low', type=float, default=25, help="percentile of the low thresholds")
+    parser.add_argument('--high', type=float, default=75, help="percentile of the high thresholds")
+    parser.add_argument('--upper', type=float, default=99, help="percentile of the upper bounds")
+    parser.add_argument('--max-pixels', type=int, default=250000, help="thumbnail size the metrics are measured at")
+    parser.add_argument('--accuracy', type=float, default=0.005, help="relative accuracy of the sketches")
+    parser.add_argument('--shard-size', type=int, default=256, help="images per shard")
+    parser.add_argument('-j', '--workers', type=int, default=os.cpu_count() or 1, help="worker processes")
+    parser.add_argument('--checkpoint-seconds', type=float, default=30, help="time between state checkpoints")
+    args = parser.parse_args(argv)
+    if not args.inputs and not args.merge:
+        parser.error("give inputs to measure or state files to --merge")
+    if not args.low < args.high <= args.upper:
+        parser.error("percentiles must satisfy --low < --high <= --upper")
+
+    thresholds = load_thresholds(args.config)
+    settings = {'max_pixels': args.max_pixels, 'accuracy': args.accuracy,
+                'sharpness_exponent': analysis_settings(thresholds)['sharpness_exponent']}
+
+    state = load_state(args.state, settings) if args.state else new_state(settings)
+    if args.inputs:
+        state = run_calibration(args.inputs, settings, args.workers, args.shard_size, state, args.state,
+                                args.checkpoint_seconds, memory_budget(thresholds), log=lambda line: print(line, file=sys.stderr))
+    for path in args.merge:
+        state = merge_state(state, load_state(path))
+
+    try:
+        sections = calibrated_sections(state, args.low, args.high, args.upper)
+    except ValueError as e:
+        print(f"Nothing to calibrate: {e}", file=sys.stderr)
+        return 1
+    try:
+        with open(args.config, 'r') as f:
+            text = f.read()
+    except FileNotFoundError:
+        text = ''
+    with open(args.output, 'w') as f:
+        f.write(replace_sections(text, sections))
+    print_report(state, sections)
+    print(f"-> {args.output}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,101 @@
+"""
+    dataset_metrics: metrics table of a whole image collection, for tuning
+                the thresholds in config/thersholds.yaml.
+
+    Usage:
+        cd app
+        python dataset_metrics.py ../Dataset -o metrics.parquet
+        python dataset_metrics.py "../Dataset/**/*.jpg" -o metrics.csv --max-pixels 250000 -j 8
+
+    Every image is decoded straight to a thumbnail of at most --max-pixels
+    (JPEG draft mode) on a thread pool, the thumbnails are bucketed by
+    shape and analysed a stack at a time (utility.batch_metrics), and the
+    sharpness/blur/noise_sigma columns are renormalized to full resolution
+    like proxy analysis does. The table (.parquet, .csv or .npy) has one
+    row per image; the percentiles printed at the end are a starting point
+    for the low/high thresholds.
+"""
+import argparse
+import concurrent.futures
+import itertools
+import os
+import sys
+import time
+
+import numpy as np
+
+from batch_enhance import iter_inputs
+from utility.analysis import open_analysis_proxy
+from utility.batch_metrics import analyze_many, renormalize_table, write_table
+from utility.config import METRIC_NAMES, load_thresholds
+from utility.pipeline import analysis_settings, memory_budget
+
+
+def _load(path, max_pixels):
+    try:
+        proxy, scale = open_analysis_proxy(path, max_pixels)
+        return np.asarray(proxy), scale
+    except Exception as e:
+        print(f"SKIPPED {path}: {type(e).__name__}: {e}", file=sys.stderr)
+        return None, None
+
+
+def iter_thumbnails(paths, max_pixels, workers):
+    """
+        iter_thumbnails: (path, thumbnail array, scale) of every readable
+                    image, decoded on a thread pool (Pillow releases the
+                    GIL while decoding) with a bounded read-ahead.
+    """
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        pending = []
+        for path in paths:
+            pending.append((path, pool.submit(_load, path, max_pixels)))
+            if len(pending) >= 4 * workers:
+                path, future = pending.pop(0)
+                image, scale = future.result()
+                if image is not None:
+                    yield path, image, scale
+        for path, future in pending:
+            image, scale = future.result()
+            if image is not None:
+                yield path, image, scale
+
+
+def main(argv=None):
+    current_dir = os.path.dirname(os.path.abspath(__file__))
+    parser = argparse.ArgumentParser(description="Compute the metrics table of an image collection.")
+    parser.add_argument('inputs', nargs='+', help="directories, glob patterns or image files")
+    parser.add_argument('-o', '--output', required=True, help="table file: .parquet, .csv or .npy")
+    parser.add_argument('-c', '--config', default=os.path.join(current_dir, 'config', 'thersholds.yaml'),
+                        help="thresholds yaml file")
+    parser.add_argument('--max-pixels', type=int, default=250000, help="thumbnail size the metrics are measured at")
+    parser.add_argument('-j', '--workers', type=int, default=os.cpu_count() or 1, help="decode threads")
+    args = parser.parse_args(argv)
+
+    thresholds = load_thresholds(args.config)
+    settings = analysis_settings(thresholds)
+
+    start = time.perf_counter()
+    thumbnails = iter_thumbnails((path for path, _ in iter_inputs(args.inputs)), args.max_pixels, args.workers)
+    # analyze_many reads image, name and scale of an item in lockstep, so
+    # the tee never holds more than one item
+    images, names, scales = itertools.tee(thumbnails, 3)
+    table = analyze_many((image for _, image, _ in images), names=(path for path, _, _ in names),
+                         scales=(scale for _, _, scale in scales), memory_budget=memory_budget(thresholds))
+    table = renormalize_table(table, settings['sharpness_exponent'])
+    if not len(table):
+        print("No images could be analysed.", file=sys.stderr)
+        return 1
+    write_table(table, args.output)
+    elapsed = time.perf_counter() - start
+
+    print(f"{len(table)} images in {elapsed:.1f}s ({len(table) / elapsed:.1f} images/s) -> {args.output}")
+    print(f"{'metric':>12} {'p10':>10} {'p25':>10} {'p50':>10} {'p75':>10} {'p90':>10}")
+    for name in METRIC_NAMES + ('blur', 'noise', 'noise_sigma'):
+        p10, p25, p50, p75, p90 = np.percentile(table[name], [10, 25, 50, 75, 90])
+        print(f"{name:>12} {p10:>10.2f} {p25:>10.2f} {p50:>10.2f} {p75:>10.2f} {p90:>10.2f}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
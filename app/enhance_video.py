@@ -0,0 +1,83 @@
+"""
+    enhance_video: enhance a video file or an image sequence frame by frame
+                (utility/video.py), reusing the analysis within each scene.
+
+    Usage:
+        cd app
+        python enhance_video.py ../Dataset/clip.mp4 -o ../OutputImages/clip.mp4
+        python enhance_video.py "../Dataset/burst/*.jpg" -o ../OutputImages/burst
+        python enhance_video.py ../Dataset/clip.mp4 -o ../OutputImages/clip.mp4 --fast -j 4
+
+    A video file (or an OpenCV sequence pattern such as frame_%04d.png) is
+    read through VideoCapture; folders and glob patterns are read as an
+    image sequence in name order. Outputs ending in a video extension are
+    written with VideoWriter, any other output is a folder of numbered JPEG
+    frames. The summary reports the sustained frames per second.
+    Unreadable images of a sequence are skipped and counted; the exit code
+    is 1 when a frame was skipped or the run failed.
+"""
+import argparse
+import os
+import sys
+
+from batch_enhance import IMAGE_EXTENSIONS, iter_inputs
+from utility.config import load_thresholds
+from utility.strategies import fast_path_thresholds
+from utility.video import run_stream
+
+
+def main(argv=None):
+    current_dir = os.path.dirname(os.path.abspath(__file__))
+    parser = argparse.ArgumentParser(description="Enhance a video or image sequence frame by frame.")
+    parser.add_argument('inputs', nargs='+', help="video file or sequence pattern, or folders, glob patterns "
+                                                  "and image files of one sequence")
+    parser.add_argument('-o', '--output', required=True, help="video file (.mp4, .avi, ...) or folder for "
+                                                              "JPEG frames")
+    parser.add_argument('-c', '--config', default=os.path.join(current_dir, 'config', 'thersholds.yaml'),
+                        help="thresholds yaml file")
+    parser.add_argument('-j', '--workers', type=int, default=None, help="worker processes (video section)")
+    parser.add_argument('--executor', choices=('process', 'thread'), default=None,
+                        help="worker pool type (video section)")
+    parser.add_argument('--max-frames', type=int, default=None, help="stop after this many frames")
+    parser.add_argument('--fast', action='store_true', help="fast path: the strategy's fast_name recommendation, "
+                                                            "no denoising or deblurring")
+    args = parser.parse_args(argv)
+
+    thresholds = load_thresholds(args.config)
+    if args.fast:
+        thresholds = fast_path_thresholds(thresholds)
+    video = args.inputs[0]
+    is_video = '%' in video or os.path.isfile(video) and not video.lower().endswith(IMAGE_EXTENSIONS)
+    if len(args.inputs) == 1 and is_video:
+        source = video
+    else:
+        source = [path for path, _ in iter_inputs(args.inputs)]
+        if not source:
+            parser.error("no frames found in the inputs")
+
+    try:
+        summary = run_stream(source, args.output, thresholds, max_frames=args.max_frames,
+                             log=lambda line: print(line, file=sys.stderr), workers=args.workers,
+                             executor=args.executor)
+    except Exception as e:
+        print(f"FAILED {video if is_video else 'sequence'}: {type(e).__name__}: {e}", file=sys.stderr)
+        return 1
+    if not summary['frames']:
+        print(f"FAILED {video if is_video else 'sequence'}: no frame could be read", file=sys.stderr)
+        return 1
+
+    print(f"Frames: {summary['frames']}")
+    if summary['skipped']:
+        print(f"Skipped: {summary['skipped']} unreadable frames")
+    print(f"Scenes: {summary['scenes']} ({summary['analyses']} analyses, {summary['drifts']} within scenes)")
+    print(f"Elapsed: {summary['seconds']:.2f}s")
+    print(f"Throughput: {summary['fps']:.2f} fps, sustained {summary['sustained_fps']:.2f} fps "
+          f"({summary['workers']} {summary['executor']} workers)")
+    stages = ', '.join(f"{name} {seconds / max(summary['frames'], 1) * 1000:.1f}"
+                       for name, seconds in summary['stage_seconds'].items())
+    print(f"Per frame ms: {stages}")
+    return 1 if summary['skipped'] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,367 @@
+"""
+    evaluate_quality: speed and output quality of pipeline configurations
+                over an image corpus, to pick the fastest configuration
+                that meets a quality floor.
+
+    Usage:
+        cd app
+        python evaluate_quality.py ../Dataset/catalog
+        python evaluate_quality.py "../Dataset/**/*.jpg" --configs configs.yaml -j 8 -o report.md
+        python evaluate_quality.py ../Dataset --min-ssim 0.98 --min-psnr 35 --rows rows.csv
+
+    A configuration is a set of overrides of the thresholds yaml (-c), by
+    section: {'denoise': {'mode': 'legacy'}} runs the pipeline with the
+    legacy denoiser and everything else as configured. --configs reads
+    them from a yaml file of name: overrides; the built-in CONFIGURATIONS
+    are used otherwise. Every image is enhanced once per configuration in
+    the same worker process (decode, enhance_image and JPEG encode timed)
+    and each output is scored against the output of the --reference
+    configuration: PSNR, SSIM (on a downscaled copy or on full resolution
+    tiles, --ssim) and the Hellinger and earth mover's distances of the
+    channel histograms. Outputs of another size (output max_pixels) are
+    resized to the reference size first.
+
+    The report has one row per configuration: median seconds per image,
+    megapixels per second, speedup over the reference, mean PSNR, mean
+    and worst SSIM and mean histogram distances, by throughput. Every
+    worker first runs each configuration once on a small synthetic image,
+    untimed, and the configurations take turns at running first from one
+    image to the next. Configurations whose mean PSNR and SSIM meet
+    --min-psnr and --min-ssim are marked, the one with the highest
+    throughput is the pick. -o writes the table (.csv or .md), --rows the
+    per image scores (.csv).
+"""
+import argparse
+import csv
+import os
+import sys
+import time
+import zlib
+
+import numpy as np
+import yaml
+
+from batch_enhance import iter_inputs
+from utility.image_io import decode, encode, output_settings
+from utility.config import load_thresholds
+from utility.pipeline import enhance_image
+from utility.quality import channel_histograms, histogram_distances, psnr, ssim, tiled_ssim
+from utility.workers import process_pool, run_bounded, worker_state
+
+# Configurations evaluated without --configs. 'default' is the yaml as
+# is, the output users get today and the default reference; 'legacy' is
+# the pipeline as it first shipped, metrics on every pixel and full NLM
+# whenever the image is noisy.
+CONFIGURATIONS = {
+    'default': {},
+    'legacy': {'analysis': {'mode': 'full'}, 'denoise': {'mode': 'legacy'}},
+    'blur_map': {'blur_map': {'mode': 'map'}},
+    'fast_denoise': {'denoise': {'mode': 'tiered', 'moderate_method': 'bilateral', 'heavy_method': 'chroma_nlm'}},
+    'no_denoise': {'denoise': {'mode': 'tiered', 'light_method': 'none', 'moderate_method': 'none',
+                               'heavy_method': 'none'}},
+    'output_4mp': {'output': {'max_pixels': 4000000}},
+}
+
+# Columns of the per image rows
+ROW_FIELDS = ('path', 'configuration', 'megapixels', 'seconds', 'psnr', 'ssim', 'hellinger', 'emd', 'error')
+
+# Side of the synthetic image every worker enhances once per configuration,
+# untimed, before its first image
+WARMUP_SIZE = 512
+
+_warmed_up = False
+
+def configure(thresholds, overrides):
+    """
+        configure: the thresholds with a configuration's overrides applied
+                section by section (keys not overridden keep their value).
+    """
+    configured = dict(thresholds)
+    for section, values in overrides.items():
+        if isinstance(values, dict):
+            configured[section] = dict(thresholds.get(section) or {}, **values)
+        else:
+            configured[section] = values
+    return configured
+
+
+def _enhance(image_bytes, thresholds):
+    # what batch_enhance does for one image, minus the file I/O
+    settings = output_settings(thresholds)
+    image, metadata = decode(image_bytes, settings['max_pixels'])
+    megapixels = image.width * image.height / 1e6
+    adjusted_image, _ = enhance_image(image, thresholds)
+    return encode(adjusted_image, settings=settings, metadata=metadata), megapixels
+
+
+def _warm_up(configurations):
+    # first calls pay for lazy imports, OpenCV and allocator warm-up; a
+    # worker runs every configuration once before anything is timed
+    global _warmed_up
+    if _warmed_up:
+        return
+    _warmed_up = True
+    from PIL import Image
+
+    rng = np.random.default_rng(0)
+    image = Image.fromarray(rng.integers(0, 256, (WARMUP_SIZE, WARMUP_SIZE, 3), dtype=np.uint8))
+    image_bytes = encode(image)
+    for thresholds in configurations.values():
+        try:
+            _enhance(image_bytes, thresholds)
+        except Exception:
+            # the configuration fails on the real images as well
+            pass
+
+
+def evaluate_image(path):
+    """
+        evaluate_image: enhance one image with every configuration inside
+                        a worker process and score the outputs against the
+                        reference configuration's.
+
+        The configurations run in an order rotated by image, so none is
+        always timed first (or right after the heaviest one); the outputs
+        are scored once they have all run.
+
+        returns:
+            - list of row dictionaries (ROW_FIELDS), one per configuration
+    """
+    import cv2
+
+    state = worker_state()
+    _warm_up(state['configurations'])
+    rows = []
+    try:
+        with open(path, 'rb') as f:
+            image_bytes = f.read()
+    except OSError as e:
+        error = f"{type(e).__name__}: {e}"
+        return [dict.fromkeys(ROW_FIELDS, None) | {'path': path, 'configuration': name, 'error': error}
+                for name in state['configurations']]
+
+    names = sorted(state['configurations'])
+    shift = zlib.crc32(path.encode()) % len(names)
+    outputs = {}
+    for name in names[shift:] + names[:shift]:
+        row = dict.fromkeys(ROW_FIELDS, None) | {'path': path, 'configuration': name}
+        try:
+            start = time.perf_counter()
+            outputs[name], row['megapixels'] = _enhance(image_bytes, state['configurations'][name])
+            row['seconds'] = time.perf_counter() - start
+        except Exception as e:
+            row['error'] = f"{type(e).__name__}: {e}"
+        rows.append(row)
+
+    reference = reference_histograms = None
+    # the reference first, every other output is scored against it
+    rows.sort(key=lambda row: (row['configuration'] != state['reference'], row['configuration']))
+    for row in rows:
+        name = row['configuration']
+        if row['error']:
+            continue
+        try:
+            output = np.asarray(decode(outputs.pop(name))[0])
+            if name == state['reference']:
+                reference, reference_histograms = output, channel_histograms(output)
+                row.update(psnr=float('inf'), ssim=1.0, hellinger=0.0, emd=0.0)
+                continue
+            if reference is None:
+                raise RuntimeError(f"reference configuration {state['reference']!r} failed")
+            if output.shape != reference.shape:
+                output = cv2.resize(output, (reference.shape[1], reference.shape[0]), interpolation=cv2.INTER_LINEAR)
+            row['psnr'] = psnr(reference, output)
+            if state['ssim'] == 'tiles':
+                row['ssim'] = tiled_ssim(reference, output, tile_size=state['tile_size'], tiles=state['tiles'])
+            else:
+                row['ssim'] = ssim(reference, output, max_pixels=state['ssim_max_pixels'])
+            distances = histogram_distances(reference_histograms, channel_histograms(output))
+            row.update(hellinger=distances['hellinger'], emd=distances['emd'])
+        except Exception as e:
+            row['error'] = f"{type(e).__name__}: {e}"
+    return rows
+
+
+def run_evaluation(inputs, thresholds, configurations, reference, workers, ssim_mode='downsampled',
+                   ssim_max_pixels=1000000, tile_size=256, tiles=16, log=print):
+    """
+        run_evaluation: evaluate every configuration on every input image
+                        with a bounded process pool.
+
+        Params:
+            - inputs: list of directories, glob patterns or file paths
+            - thresholds: thresholds dictionary the configurations override
+            - configurations: {name: overrides}, reference among them
+            - reference: name of the configuration outputs are scored against
+            - workers: number of worker processes
+            - ssim_mode: 'downsampled' (SSIM of copies of at most
+            ssim_max_pixels) or 'tiles' (tiled_ssim of tiles full resolution
+            windows of tile_size)
+            - log: function used for progress and error lines
+
+        returns:
+            - list of row dictionaries (ROW_FIELDS), one per image and
+            configuration
+    """
+    if reference not in configurations:
+        raise ValueError(f"reference configuration {reference!r} is not among {sorted(configurations)}")
+    state = {'configurations': {name: configure(thresholds, overrides) for name, overrides in configurations.items()},
+             'reference': reference, 'ssim': ssim_mode, 'ssim_max_pixels': ssim_max_pixels,
+             'tile_size': tile_size, 'tiles': tiles}
+    rows = []
+
+    def collect(future, path):
+        for row in future.result():
+            if row['error']:
+                log(f"FAILED {path} ({row['configuration']}): {row['error']}")
+            rows.append(row)
+
+    with process_pool(workers, state) as pool:
+        run_bounded(pool, ((path, evaluate_image, (path,)) for path, _ in iter_inputs(inputs)), 2 * workers, collect)
+    return rows
+
+
+def summarize(rows, reference, min_psnr=None, min_ssim=None):
+    """
+        summarize: one report row per configuration, highest throughput
+                (megapixels per second) first, over the images the
+                reference configuration enhanced.
+
+        Params:
+            - rows: run_evaluation rows
+            - reference: name of the reference configuration
+            - min_psnr, min_ssim: quality floor on the mean scores, None
+            for no floor
+
+        returns:
+            - list of dictionaries (configuration, images, failed,
+            median_seconds, megapixels_per_second, speedup, psnr, ssim,
+            worst_ssim, hellinger, emd, meets_floor, pick)
+    """
+    # images the reference could not enhance (unreadable files) are left
+    # out, they say nothing about the other configurations
+    unusable = {row['path'] for row in rows if row['configuration'] == reference and row['error']}
+    by_configuration = {}
+    for row in rows:
+        if row['path'] not in unusable:
+            by_configuration.setdefault(row['configuration'], []).append(row)
+    reference_seconds = sum(row['seconds'] for row in by_configuration.get(reference, ()) if not row['error'])
+
+    summary = []
+    for name, configuration_rows in by_configuration.items():
+        ok = [row for row in configuration_rows if not row['error']]
+        seconds = np.array([row['seconds'] for row in ok])
+        megapixels = sum(row['megapixels'] for row in ok)
+        finite_psnr = [row['psnr'] for row in ok if np.isfinite(row['psnr'])]
+        item = {
+            'configuration': name,
+            'images': len(ok),
+            'failed': len(configuration_rows) - len(ok),
+            'median_seconds': float(np.median(seconds)) if ok else float('nan'),
+            'megapixels_per_second': megapixels / seconds.sum() if ok and seconds.sum() > 0 else float('nan'),
+            'speedup': reference_seconds / seconds.sum() if ok and seconds.sum() > 0 else float('nan'),
+            'psnr': float(np.mean(finite_psnr)) if finite_psnr else float('inf'),
+            'ssim': float(np.mean([row['ssim'] for row in ok])) if ok else float('nan'),
+            'worst_ssim': float(min(row['ssim'] for row in ok)) if ok else float('nan'),
+            'hellinger': float(np.mean([row['hellinger'] for row in ok])) if ok else float('nan'),
+            'emd': float(np.mean([row['emd'] for row in ok])) if ok else float('nan'),
+        }
+        # a configuration that failed on any image cannot be picked
+        item['meets_floor'] = bool(ok) and not item['failed'] and \
+            (min_psnr is None or item['psnr'] >= min_psnr) and (min_ssim is None or item['ssim'] >= min_ssim)
+        summary.append(item)
+
+    # ranked and picked by the same figure: throughput over all images
+    summary.sort(key=lambda item: -item['megapixels_per_second'] if np.isfinite(item['megapixels_per_second'])
+                 else float('inf'))
+    pick = next((item for item in summary if item['meets_floor']), None)
+    for item in summary:
+        item['pick'] = item is pick
+    return summary
+
+
+REPORT_COLUMNS = (('configuration', 'configuration', '{}'), ('images', 'images', '{}'), ('failed', 'failed', '{}'),
+                  ('median_seconds', 'median s', '{:.3f}'), ('megapixels_per_second', 'MP/s', '{:.2f}'),
+                  ('speedup', 'speedup', '{:.2f}x'), ('psnr', 'PSNR', '{:.2f}'), ('ssim', 'SSIM', '{:.4f}'),
+                  ('worst_ssim', 'worst SSIM', '{:.4f}'), ('hellinger', 'Hellinger', '{:.4f}'),
+                  ('emd', 'EMD', '{:.3f}'))
+
+
+def format_report(summary, markdown=False):
+    """
+        format_report: the summarize rows as an aligned text table, or a
+                    Markdown table; 'floor' marks the configurations that
+                    meet the quality floor, 'pick' the fastest of them.
+    """
+    header = [title for _, title, _ in REPORT_COLUMNS] + ['floor']
+    lines = [[fmt.format(item[key]) for key, _, fmt in REPORT_COLUMNS] +
+             [('pick' if item['pick'] else 'yes') if item['meets_floor'] else '']
+             for item in summary]
+    if markdown:
+        table = ['| ' + ' | '.join(header) + ' |', '|' + '---|' * len(header)]
+        table += ['| ' + ' | '.join(line) + ' |' for line in lines]
+        return '\n'.join(table) + '\n'
+    widths = [max(len(cell) for cell in column) for column in zip(header, *lines)]
+    return '\n'.join(' '.join(cell.rjust(width) for cell, width in zip(line, widths))
+                     for line in [header] + lines) + '\n'
+
+
+def write_csv(path, rows, fields):
+    with open(path, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=fields, extrasaction='ignore')
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+def main(argv=None):
+    current_dir = os.path.dirname(os.path.abspath(__file__))
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('inputs', nargs='+', help="directories, glob patterns or image files")
+    parser.add_argument('-c', '--config', default=os.path.join(current_dir, 'config', 'thersholds.yaml'),
+                        help="thresholds yaml file the configurations override")
+    parser.add_argument('--configs', help="yaml file of configuration name: overrides (default: CONFIGURATIONS)")
+    parser.add_argument('--reference', default='default', help="configuration the outputs are scored against")
+    parser.add_argument('-j', '--workers', type=int, default=os.cpu_count() or 1, help="worker processes")
+    parser.add_argument('--ssim', choices=('downsampled', 'tiles'), default='downsampled',
+                        help="SSIM on a downscaled copy or on full resolution tiles")
+    parser.add_argument('--ssim-max-pixels', type=int, default=1000000, help="size of the downscaled copy")
+    parser.add_argument('--tile-size', type=int, default=256, help="side of the SSIM tiles")
+    parser.add_argument('--tiles', type=int, default=16, help="SSIM tiles per image")
+    parser.add_argument('--min-psnr', type=float, default=None, help="quality floor: mean PSNR in dB")
+    parser.add_argument('--min-ssim', type=float, default=0.95, help="quality floor: mean SSIM")
+    parser.add_argument('-o', '--output', help="report table file (.csv or .md)")
+    parser.add_argument('--rows', help="per image scores file (.csv)")
+    args = parser.parse_args(argv)
+
+    thresholds = load_thresholds(args.config)
+    configurations = CONFIGURATIONS
+    if args.configs:
+        with open(args.configs, 'r') as f:
+            configurations = yaml.safe_load(f) or {}
+
+    start = time.perf_counter()
+    rows = run_evaluation(args.inputs, thresholds, configurations, args.reference, args.workers,
+                          ssim_mode=args.ssim, ssim_max_pixels=args.ssim_max_pixels, tile_size=args.tile_size,
+                          tiles=args.tiles, log=lambda line: print(line, file=sys.stderr))
+    if not rows:
+        print("No images found.", file=sys.stderr)
+        return 1
+    summary = summarize(rows, args.reference, args.min_psnr, args.min_ssim)
+    print(format_report(summary), end='')
+    pick = next((item['configuration'] for item in summary if item['pick']), None)
+    print(f"Fastest configuration meeting the floor: {pick or 'none'} "
+          f"({len(rows) // len(configurations)} images in {time.perf_counter() - start:.1f}s)")
+
+    if args.output:
+        if args.output.endswith('.md'):
+            with open(args.output, 'w') as f:
+                f.write(format_report(summary, markdown=True))
+        else:
+            write_csv(args.output, summary, [key for key, _, _ in REPORT_COLUMNS] + ['meets_floor', 'pick'])
+    if args.rows:
+        write_csv(args.rows, rows, ROW_FIELDS)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
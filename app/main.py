@@ -1,114 +1,96 @@
 import streamlit as st
-from PIL import Image, ImageEnhance
-import numpy as np
-import yaml
-import sys
+import importlib.util
+import os
+import time
 import traceback
 
-# Try to import OpenCV, but provide a fallback if it's not available
-try:
-    import cv2
-    OPENCV_AVAILABLE = True
-except ImportError:
-    OPENCV_AVAILABLE = False
+from utility.cache import CachedResult, ResultCache, cache_key
+from utility.config import DEFAULT_THRESHOLDS, load_thresholds
+from utility.profiling import tracer_from_config, export_metrics
+from utility.image_io import decode, output_settings, to_array
+
+# OpenCV is imported by the processing modules on the first upload; looking
+# it up here does not load it
+OPENCV_AVAILABLE = importlib.util.find_spec('cv2') is not None
+if not OPENCV_AVAILABLE:
     st.warning("OpenCV (cv2) is not available. Some image processing features will be limited.")
 
-# Import helper functions with error handling
-try:
-    from utility.helper import get_image_metrics, detect_blur, detect_noise, remove_blur, remove_noise, recommend_value, apply_adjustments
-except ImportError as e:
-    st.error(f"Error importing helper functions: {e}")
-    traceback.print_exc()
-    
-    # Define fallback functions if imports fail
-    def get_image_metrics(image):
-        return 1.0, 1.0, 1.0, 1.0  # Default values
-        
-    def recommend_value(current, low_threshold, high_threshold):
-        return current  # Return same value
-        
-    def apply_adjustments(image, sat, bright, cont, sharp):
-        return image  # Return original image
-    
-    # These functions need OpenCV, so they'll be limited without it
-    def detect_blur(image_np):
-        return 200  # Default value (not blurry)
-        
-    def detect_noise(image_np):
-        return 0  # Default value (no noise)
-        
-    def remove_blur(image_np):
-        return image_np  # Return original image
-        
-    def remove_noise(image_np):
-        return image_np  # Return original image
 
-def load_thresholds(file_path):
-    """Function to load the yaml configuration file with error handling"""
+def fallback_pipeline():
+    """Pass-through stand-ins for the processing functions, used when they cannot be imported"""
+    from collections import namedtuple
+    from types import SimpleNamespace
+
+    # the fields of utility.analysis.ImageMetrics, which cannot be imported
+    ImageMetrics = namedtuple('ImageMetrics', ['saturation', 'brightness', 'contrast', 'sharpness', 'blur', 'noise',
+                                               'noise_sigma', 'blur_map', 'statistics'], defaults=(0.0, None, None))
+
+    def preview_settings(thresholds):
+        return {'enabled': False, 'max_pixels': None}  # No preview
+
+    def result_cache_from_config(thresholds):
+        return ResultCache()
+
+    def enhance_bytes(image_bytes, thresholds, cache=None, quality=None, key=None, progress=None, **reused):
+        metrics = ImageMetrics(1.0, 1.0, 1.0, 1.0, 200, 0)  # Default values (not blurry, no noise)
+        recommended = dict(zip(metrics._fields, metrics[:4]))  # Same values
+        # Original image
+        return CachedResult(key, metrics, recommended, to_array(decode(image_bytes)[0]), image_bytes)
+
+    return SimpleNamespace(ImageMetrics=ImageMetrics, preview_settings=preview_settings,
+                           result_cache_from_config=result_cache_from_config, enhance_bytes=enhance_bytes)
+
+
+def load_pipeline():
+    """
+    The processing functions. They are imported on the first upload, not
+    when the page is first shown: they pull in OpenCV and the analysis code,
+    which the empty page does not need. Later reruns get them from sys.modules.
+    """
     try:
-        with open(file_path, 'r') as file:
-            thresholds = yaml.safe_load(file)
-            return thresholds
-    except FileNotFoundError:
-        st.error(f"Threshold configuration file not found at: {file_path}")
-        # Return default thresholds
-        return {
-            'saturation': {'low_threshold': 30, 'high_threshold': 70},
-            'brightness': {'low_threshold': 100, 'high_threshold': 200},
-            'contrast': {'low_threshold': 50, 'high_threshold': 100},
-            'sharpness': {'low_threshold': 2000, 'high_threshold': 4500}
-        }
-    except Exception as e:
-        st.error(f"Error loading threshold configuration: {e}")
-        # Return default thresholds
-        return {
-            'saturation': {'low_threshold': 30, 'high_threshold': 70},
-            'brightness': {'low_threshold': 100, 'high_threshold': 200},
-            'contrast': {'low_threshold': 50, 'high_threshold': 100},
-            'sharpness': {'low_threshold': 2000, 'high_threshold': 4500}
-        }
-
-# Load thresholds from the YAML file
-import os
+        from utility import pipeline
+    except ImportError as e:
+        st.error(f"Error importing helper functions: {e}")
+        traceback.print_exc()
+        return fallback_pipeline()
+    return pipeline
+
 
 # Get the absolute path to the config file
 current_dir = os.path.dirname(os.path.abspath(__file__))
 config_path = os.path.join(current_dir, 'config', 'thersholds.yaml')
 
-# Check if file exists and log the path
+# The file is parsed and validated once; reruns get it from memory until it
+# changes on disk
 if not os.path.exists(config_path):
-    st.error(f"Config file not found at: {config_path}")
-    # Create a default config if it doesn't exist
-    os.makedirs(os.path.dirname(config_path), exist_ok=True)
-    default_config = """saturation:
-  low_threshold: 30
-  high_threshold: 70
-brightness:
-  low_threshold: 100
-  high_threshold: 200
-contrast:
-  low_threshold: 50
-  high_threshold: 100
-sharpness:
-  low_threshold: 2000
-  high_threshold: 4500
-"""
-    with open(config_path, 'w') as f:
-        f.write(default_config)
-    st.info(f"Created default config file at {config_path}")
-
-# Load the thresholds
-thresholds = load_thresholds(config_path)
-
-# Extract the values
-saturation_low_threshold = thresholds['saturation']['low_threshold']
-saturation_high_threshold = thresholds['saturation']['high_threshold']
-brightness_low_threshold = thresholds['brightness']['low_threshold']
-brightness_high_threshold = thresholds['brightness']['high_threshold']
-contrast_low_threshold = thresholds['contrast']['low_threshold']
-contrast_high_threshold = thresholds['contrast']['high_threshold']
-sharpness_low_threshold = thresholds['sharpness']['low_threshold']
-sharpness_high_threshold = thresholds['sharpness']['high_threshold']
+    st.warning(f"Config file not found at: {config_path}, using the default thresholds")
+try:
+    thresholds = load_thresholds(config_path)
+except Exception as e:
+    st.error(f"Error loading threshold configuration: {e}")
+    thresholds = DEFAULT_THRESHOLDS
+
+@st.cache_resource
+def get_result_cache(thresholds):
+    """One result cache per process, shared by every rerun and session"""
+    return load_pipeline().result_cache_from_config(thresholds)
+
+@st.cache_resource
+def get_job_runner(workers):
+    """Background full resolution runs, shared by every rerun and session"""
+    from utility.jobs import JobRunner
+    return JobRunner(workers)
+
+def run_full_resolution(image_bytes, thresholds, progress, **options):
+    """The full resolution pipeline of an upload, run by the job runner, with its slowest stages"""
+    # Time every pipeline stage when the profiling section enables it
+    tracer = tracer_from_config(thresholds, name='upload')
+    with tracer:
+        entry = pipeline.enhance_bytes(image_bytes, thresholds, progress=progress, **options)
+    export_metrics(thresholds)
+    return entry, tracer.slowest(8) if tracer.records else None
+
+output = output_settings(thresholds)
 
 # Streamlit app
 st.title('Image Enhancement Tool')
@@ -116,98 +98,146 @@ st.title('Image Enhancement Tool')
 uploaded_file = st.file_uploader("Choose an image...", type=["jpg", "png", "jpeg"])
 
 if uploaded_file:
-    st.write("Processing the image, please wait...")
-
-    # Initialize progress bar
-    progress_bar = st.progress(0.0)
-    
-    # Simulate processing steps
-    steps = 4  # Total number of steps in processing
-    step_size = 1.0 / steps
-    
+    pipeline = load_pipeline()
+    result_cache = get_result_cache(thresholds)
+    preview = pipeline.preview_settings(thresholds)
+    jobs = get_job_runner(preview.get('workers'))
+    if not OPENCV_AVAILABLE:
+        st.info("OpenCV is not available. Skipping image analysis, denoising and deblurring.")
+
     with st.spinner('Processing...'):
-        # Load the image
-        image_01 = Image.open(uploaded_file)
-        image_np = np.array(image_01)
-        
-        # Step 1: Get current metrics
-        progress_bar.progress(step_size)
-        saturation_value, brightness_value, contrast_value, sharpness_value = get_image_metrics(image_01)
-        
-        # Step 2: Detect noise and blur
-        progress_bar.progress(2 * step_size)
-        if OPENCV_AVAILABLE:
-            try:
-                noise_level = detect_noise(image_np)
-                blur_level = detect_blur(image_np)
-            except Exception as e:
-                st.warning(f"Error in image analysis: {e}")
-                noise_level = 0
-                blur_level = 200  # Default values
-        else:
-            st.info("OpenCV is not available. Skipping image analysis steps.")
-            noise_level = 0
-            blur_level = 200  # Default values
-
-        # Step 3: Apply denoising and deblurring if necessary
-        if OPENCV_AVAILABLE:
-            if noise_level > 10:
-                image_np = remove_noise(image_np)
-            if blur_level < 100:
-                image_np = remove_blur(image_np)
-        else:
-            st.info("OpenCV is not available. Skipping denoising and deblurring steps.")
-
-        # Step 4: Convert back to PIL image
-        image = Image.fromarray(image_np)
-
-        # Step 5: Recommend values
-        progress_bar.progress(3 * step_size)
-        recommended_saturation = recommend_value(saturation_value, saturation_low_threshold, saturation_high_threshold)
-        recommended_brightness = recommend_value(brightness_value, brightness_low_threshold, brightness_high_threshold)
-        recommended_contrast = recommend_value(contrast_value, contrast_low_threshold, contrast_high_threshold)
-        recommended_sharpness = recommend_value(sharpness_value, sharpness_low_threshold, sharpness_high_threshold)
-
-        # Step 6: Apply adjustments
-        adjusted_image = apply_adjustments(image, recommended_saturation, recommended_brightness, recommended_contrast, recommended_sharpness)
-
-        # Update progress bar to 100%
-        progress_bar.progress(1.0)
+        # The upload is only decoded when its result is not cached yet
+        image_bytes = uploaded_file.getvalue()
+
+        # Every widget interaction reruns this script; the same upload with
+        # the same config is served from the cache instead of recomputed.
+        # The full resolution run reuses the preview's analysis, so its
+        # results are kept apart from those of other preview settings
+        key = cache_key(image_bytes, thresholds, quality=output['quality'],
+                        preview=preview if preview['enabled'] else None)
+        cached = result_cache.get(key)
 
         # Display results side by side
         col1, col2 = st.columns(2)
 
         with col1:
             st.subheader("Original Image")
-            st.image(image_01, use_container_width=True)
+            # the uploaded bytes are shown as they are, without decoding
+            st.image(image_bytes, use_container_width=True)
 
         with col2:
             st.subheader("Adjusted Image")
-            st.image(adjusted_image, use_container_width=True)
+            adjusted_slot = st.empty()
+
+        if cached is None:
+            # A rerun while the full resolution run is busy picks it up again
+            job = jobs.get(key)
+            if job is None:
+                analysis = recommended = preview_image = None
+                if preview['enabled']:
+                    # Phase 1: a preview sized copy goes through the same
+                    # analysis, recommendations and adjustments
+                    analysis, recommended, preview_image = pipeline.preview_bytes(image_bytes, thresholds,
+                                                                                  output['quality'])
+                # Phase 2: the full resolution run in the background, with
+                # the preview's analysis and recommended values
+                job = jobs.submit(key, run_full_resolution, image_bytes, thresholds, preview=preview_image,
+                                  cache=result_cache, quality=output['quality'], analysis=analysis,
+                                  recommended=recommended, key=key)
+            if job.preview is not None:
+                adjusted_slot.image(job.preview, caption="Preview, the full resolution image follows",
+                                    use_container_width=True)
+
+            # Progress of the pipeline stages as they run
+            progress_bar = st.progress(0.0)
+            while not job.done():
+                progress_bar.progress(job.fraction, text=f"Full resolution: {job.stage}")
+                time.sleep(0.1)
+            jobs.pop(key)
+            progress_bar.empty()
+            try:
+                cached, stage_records = job.result()
+            except Exception as e:
+                st.error(f"Error processing the image: {e}")
+                traceback.print_exc()
+                st.stop()
+
+            # keep the stage timings of this upload for the reruns served
+            # from the cache
+            if stage_records:
+                st.session_state['stage_records'] = (key, stage_records)
+
+        # Results, freshly computed or from the cache
+        saturation_value, brightness_value, contrast_value, sharpness_value = cached.metrics[:4]
+        noise_level = cached.metrics.noise
+        blur_level = cached.metrics.blur
+        recommended_saturation = cached.recommended['saturation']
+        recommended_brightness = cached.recommended['brightness']
+        recommended_contrast = cached.recommended['contrast']
+        recommended_sharpness = cached.recommended['sharpness']
+        byte_im = cached.output
+
+        # The full resolution image replaces the preview
+        adjusted_slot.image(byte_im, use_container_width=True)
 
         # Print current and recommended values
         st.write(f"Current Saturation: {saturation_value:.2f}")
         st.write(f"Current Brightness: {brightness_value:.2f}")
         st.write(f"Current Contrast: {contrast_value:.2f}")
         st.write(f"Current Sharpness: {sharpness_value:.2f}")
+        if cached.metrics.blur_map is not None:
+            st.write(f"Blurry regions: {cached.metrics.blur_map.blurry.mean():.0%} of the image")
         st.write(f"Recommended Saturation: {recommended_saturation:.2f}")
         st.write(f"Recommended Brightness: {recommended_brightness:.2f}")
         st.write(f"Recommended Contrast: {recommended_contrast:.2f}")
         st.write(f"Recommended Sharpness: {recommended_sharpness:.2f}")
-        
+
+        # Manual adjustments: sliders over a memoized stage graph of this
+        # result, rendered on a screen sized proxy until they are applied
+        if OPENCV_AVAILABLE and st.toggle("Adjust manually", key='manual_mode'):
+            from utility.image_io import read_metadata
+            from utility.pipeline import memory_budget
+            from utility.stage_graph import ADJUSTMENT_STAGES, adjustment_graph, set_adjustments
+
+            # one graph per session, for the current upload
+            graph_key, graph = st.session_state.get('adjustment_graph', (None, None))
+            if graph_key != key:
+                graph = adjustment_graph(cached.restored, cached.recommended, thresholds, output,
+                                         read_metadata(image_bytes), memory_budget(thresholds))
+                st.session_state['adjustment_graph'] = (key, graph)
+            values = {name: st.slider(name.capitalize(), 0.0, 10.0, float(cached.recommended[name]), 0.1,
+                                      key=f"{key}-{name}") for name in ADJUSTMENT_STAGES}
+            set_adjustments(graph, values)
+            runs = dict(graph.runs)
+            start = time.perf_counter()
+            display = graph.get('display')
+            elapsed = time.perf_counter() - start
+            st.image(display, use_container_width=True)
+            recomputed = [name for name in ADJUSTMENT_STAGES + ('display',) if graph.runs[name] != runs.get(name, 0)]
+            st.caption(f"Rendered in {elapsed * 1000:.0f} ms, recomputed: {', '.join(recomputed) or 'nothing'}")
+
+            if st.button("Apply at full resolution"):
+                st.session_state['committed_adjustments'] = (key, values)
+            committed_key, committed = st.session_state.get('committed_adjustments', (None, None))
+            if committed_key == key:
+                # the downloads below get the committed values
+                with st.spinner('Applying at full resolution...'):
+                    graph.set('full', **committed)
+                    byte_im = graph.get('full')
+                recommended_saturation = committed['saturation']
+                recommended_brightness = committed['brightness']
+                recommended_contrast = committed['contrast']
+                recommended_sharpness = committed['sharpness']
+                adjusted_slot.image(byte_im, caption="Manual adjustments", use_container_width=True)
+                st.success("Manual adjustments applied at full resolution.")
+
         # Add download button for the adjusted image
-        import io
         import os
         import datetime
         
         # Create download section
         st.subheader("Download Options")
         
-        # Prepare image for download
-        buf = io.BytesIO()
-        adjusted_image.save(buf, format="JPEG")
-        byte_im = buf.getvalue()
-        
         # Create two columns for download buttons
         dl_col1, dl_col2 = st.columns(2)
         
@@ -272,7 +302,27 @@ Date Processed: {current_time}
                 os.makedirs(output_dir, exist_ok=True)
                 timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
                 save_path = os.path.join(output_dir, f"enhanced_{timestamp}.jpg")
-                adjusted_image.save(save_path)
+                # the cached JPEG is written as is, nothing is re-encoded
+                with open(save_path, 'wb') as f:
+                    f.write(byte_im)
                 st.success(f"Image saved to {save_path}")
             except Exception as e:
                 st.error(f"Failed to save image: {e}")
+
+        # Result cache counters
+        stats = result_cache.stats()
+        st.caption(f"Result cache: {stats['hits']} hits, {stats['disk_hits']} disk hits, "
+                   f"{stats['misses']} misses, {stats['entries']} entries "
+                   f"({stats['bytes'] / (1024 * 1024):.1f} MB)")
+
+        # Slowest pipeline stages of this upload, when profiling is enabled
+        stage_records = st.session_state.get('stage_records')
+        if stage_records and stage_records[0] == key:
+            with st.expander("Slowest stages"):
+                st.table([{
+                    'stage': '  ' * record.depth + record.name,
+                    'wall (ms)': f"{record.wall * 1000:.1f}",
+                    'CPU (ms)': f"{record.cpu * 1000:.1f}",
+                    'megapixels': f"{record.megapixels:.2f}" if record.megapixels else '',
+                    'allocated (MB)': f"{record.bytes_allocated / (1024 * 1024):.1f}" if record.bytes_allocated is not None else ''
+                } for record in stage_records[1]])
@@ -1,29 +1,33 @@
 import streamlit as st
 from PIL import Image, ImageEnhance
 import numpy as np
-from skimage.metrics import mean_squared_error, structural_similarity as ssim
-import matplotlib.pyplot as plt
+import os
+
+from utility.analysis import image_statistics, statistics_metrics
+from utility.config import DEFAULT_THRESHOLDS, load_thresholds
+from utility.quality import channel_histograms, histogram_distances, mse, ssim
+from utility.strategies import STRATEGIES, strategy_settings, subtle_factor, value_to_factor
+
+# SSIM is computed on copies of at most this many pixels, full size SSIM
+# took seconds on camera images
+SSIM_MAX_PIXELS = 1000000
+
+config_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'config', 'thersholds.yaml')
+try:
+    thresholds = load_thresholds(config_path)
+except Exception as e:
+    st.warning(f"Error loading threshold configuration: {e}, using the default thresholds")
+    thresholds = DEFAULT_THRESHOLDS
  
-# Function to calculate enhancement factors based on histogram analysis
-def calculate_enhancement_factors(histogram):
-    # Calculate brightness factor based on mean value
-    mean_brightness = np.mean(histogram)
-    brightness_factor = 1 + (0.5 - mean_brightness / 255) * 0.2  # Subtle adjustment
-   
-    # Calculate contrast factor based on histogram spread
-    contrast_factor = 1 + (np.std(histogram) / 128 - 1) * 0.2  # Subtle adjustment
-   
-    # Calculate sharpness factor based on edge contrast (approximate using histogram edges)
-    sharpness_factor = 1 + (np.mean(histogram[-10:]) - np.mean(histogram[:10])) / 255 * 0.2  # Subtle adjustment
-   
-    # Calculate saturation factor based on color intensity distribution
-    saturation_factor = 1 + (np.percentile(histogram, 95) - np.percentile(histogram, 5)) / 255 * 0.2  # Subtle adjustment
-   
-    # Ensure factors are within a reasonable range
-    brightness_factor = np.clip(brightness_factor, 0.9, 1.1)
-    contrast_factor = np.clip(contrast_factor, 0.9, 1.3)
-    sharpness_factor = np.clip(sharpness_factor, 0.9, 1.1)
-    saturation_factor = np.clip(saturation_factor, 0.9, 1.3)
+
+def strategy_enhancement_factors(analysis, strategy):
+    # Function to calculate enhancement factors: the configured strategy's
+    # recommended values as ImageEnhance factors, kept within the subtle
+    # ranges whatever the strategy
+    recommended = strategy.recommend(analysis, thresholds)
+    brightness_factor, contrast_factor, sharpness_factor, saturation_factor = (
+        subtle_factor(name, value_to_factor(recommended[name]))
+        for name in ('brightness', 'contrast', 'sharpness', 'saturation'))
 
     print("Brightness value: ", brightness_factor)
     print("Contrast value: ", contrast_factor)
@@ -43,12 +47,17 @@ if uploaded_file is not None:
     # Load the image
     image = Image.open(uploaded_file)
  
-    # Convert to grayscale for histogram analysis
-    grayscale_image = image.convert("L")
-    histogram = np.array(grayscale_image.histogram())
+    oringinal_img = np.array(image.convert("RGB"))
+
+    # One pass gathers what the strategy reads (the gray histogram for the
+    # histogram strategy) and the channel histograms of the comparison
+    settings = strategy_settings(thresholds)
+    strategy = STRATEGIES[settings['main_01'] or settings['name']]
+    original_statistics = image_statistics(oringinal_img, parts=tuple(sorted(set(strategy.parts) | {'channels'})))
  
     # Calculate enhancement factors
-    brightness_factor, contrast_factor, sharpness_factor, saturation_factor = calculate_enhancement_factors(histogram)
+    brightness_factor, contrast_factor, sharpness_factor, saturation_factor = strategy_enhancement_factors(
+        statistics_metrics(original_statistics), strategy)
  
     # Apply enhancements based on calculated values
     enhancer = ImageEnhance.Brightness(image)
@@ -63,28 +72,24 @@ if uploaded_file is not None:
     enhancer = ImageEnhance.Color(enhanced_image)
     enhanced_image = enhancer.enhance(saturation_factor)
 
-    oringinal_img = np.array(image)
-    enh_img = np.array(enhanced_image)
+    enh_img = np.array(enhanced_image.convert("RGB"))
     # Calculate Mean Squared Error (MSE)
-    mse_value = mean_squared_error(oringinal_img, enh_img)
+    mse_value = mse(oringinal_img, enh_img)
 
-    # Convert both images to numpy arrays for histogram comparison
-    original_array = np.array(image)
-    enhanced_array = np.array(enhanced_image)
-    
-    # Histogram Comparison
-    plt.figure(figsize=(10, 6))
-    plt.hist(original_array.flatten(), bins=256, color='blue', alpha=0.5, label='Original')
-    plt.hist(enhanced_array.flatten(), bins=256, color='red', alpha=0.5, label='Enhanced')
-    plt.title('Histogram Comparison')
-    plt.legend()
-    st.pyplot(plt)
- 
-    # # Calculate Structural Similarity Index (SSIM)
-    # ssim_value, _ = ssim(oringinal_img, enh_img, full=True, multichannel=True)
+    # Histogram Comparison: per channel counts, the original's from the
+    # statistics above, summed to the histogram of all the flattened values
+    original_histograms = original_statistics.channel_histograms
+    enhanced_histograms = channel_histograms(enh_img)
+    st.subheader("Histogram Comparison")
+    st.line_chart({'Original': original_histograms.sum(axis=0), 'Enhanced': enhanced_histograms.sum(axis=0)})
+
+    # Calculate Structural Similarity Index (SSIM)
+    ssim_value = ssim(oringinal_img, enh_img, max_pixels=SSIM_MAX_PIXELS)
+    distances = histogram_distances(original_histograms, enhanced_histograms)
 
     print("Mean squared error: ", mse_value)
-    # print("ssim_value : ",ssim_value)
+    print("ssim_value : ", ssim_value)
+    print("Histogram distances: ", distances)
  
     # Display original and enhanced images side by side
     col1, col2 = st.columns(2)
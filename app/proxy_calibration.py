@@ -0,0 +1,148 @@
+"""
+    proxy_calibration: measure how far proxy analysis drifts from full
+                resolution analysis on a sample set, and fit the
+                sharpness_exponent used to renormalize sharpness and blur.
+
+    Usage:
+        cd app
+        python proxy_calibration.py ../Dataset/samples --limit 200
+        python proxy_calibration.py "../Dataset/**/*.jpg" --max-pixels 1000000 -o proxy_report.md
+
+    The report is markdown: drift per metric, how often the proxy puts a
+    metric in the same threshold band (below low / between / above high)
+    as the full image, and the analysis speedup. Copy the fitted exponent
+    into the analysis section of config/thersholds.yaml.
+
+    The proxy is made the way analysis mode 'proxy' makes it
+    (analysis_proxy, Pillow's box reduce of the decoded image), since that
+    is the downsampler the exponent corrects. --proxy draft measures the
+    JPEG draft decode of the UI preview (open_analysis_proxy) instead.
+"""
+import argparse
+import itertools
+import math
+import os
+import sys
+import time
+
+import numpy as np
+from PIL import Image
+
+from batch_enhance import iter_inputs
+from utility.analysis import analysis_proxy, analyze_image, open_analysis_proxy, renormalize_metrics
+from utility.config import METRIC_NAMES, load_thresholds
+from utility.pipeline import analysis_settings, NOISE_THRESHOLD, BLUR_THRESHOLD
+
+
+def _band(value, low, high):
+    return 0 if value < low else 2 if value > high else 1
+
+
+def measure(path, max_pixels, proxy='reduce'):
+    """
+        measure: full resolution and raw (not renormalized) proxy metrics
+                of one image, with the time each took including decode.
+                proxy is 'reduce' (analysis_proxy of the decoded image, as
+                analyze_proxy does) or 'draft' (open_analysis_proxy).
+    """
+    start = time.perf_counter()
+    with Image.open(path) as image:
+        full = analyze_image(image.convert('RGB'))
+    full_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    if proxy == 'draft':
+        proxy_image, scale = open_analysis_proxy(path, max_pixels)
+    else:
+        with Image.open(path) as image:
+            proxy_image, scale = analysis_proxy(image.convert('RGB'), max_pixels)
+    proxy = analyze_image(proxy_image)
+    proxy_seconds = time.perf_counter() - start
+    return full, proxy, scale, full_seconds, proxy_seconds
+
+
+def fit_sharpness_exponent(samples):
+    # median of log(proxy / full) / log(scale) over downscaled images
+    exponents = [math.log(proxy.sharpness / full.sharpness) / math.log(scale)
+                 for full, proxy, scale, _, _ in samples
+                 if scale > 1.0 and full.sharpness > 0 and proxy.sharpness > 0]
+    return float(np.median(exponents)) if exponents else None
+
+
+def build_report(samples, thresholds, max_pixels, configured_exponent, proxy='reduce'):
+    fitted_exponent = fit_sharpness_exponent(samples)
+    exponent = fitted_exponent if fitted_exponent is not None else configured_exponent
+    lines = [
+        "# Proxy analysis calibration",
+        "",
+        f"- images: {len(samples)}, downscaled: {sum(1 for s in samples if s[2] > 1.0)}",
+        f"- proxy budget: {max_pixels} pixels, {proxy} proxy",
+        f"- configured sharpness_exponent: {configured_exponent}",
+        f"- fitted sharpness_exponent: {'n/a' if fitted_exponent is None else f'{fitted_exponent:.3f}'}",
+        "",
+        f"Drift with the fitted exponent ({exponent:.3f}); relative drift is |proxy - full| / |full|.",
+        "",
+        "| metric | median drift | p90 drift | max drift | same threshold band |",
+        "|---|---|---|---|---|",
+    ]
+    renormalized = [(full, renormalize_metrics(proxy, scale, exponent)) for full, proxy, scale, _, _ in samples]
+    for name in METRIC_NAMES + ('blur', 'noise'):
+        drift = np.array([abs(getattr(proxy, name) - getattr(full, name)) / max(abs(getattr(full, name)), 1e-9)
+                          for full, proxy in renormalized])
+        if name in thresholds:
+            low, high = thresholds[name]['low_threshold'], thresholds[name]['high_threshold']
+            agree = np.mean([_band(getattr(full, name), low, high) == _band(getattr(proxy, name), low, high)
+                             for full, proxy in renormalized])
+        elif name == 'blur':
+            agree = np.mean([(full.blur < BLUR_THRESHOLD) == (proxy.blur < BLUR_THRESHOLD) for full, proxy in renormalized])
+        else:
+            agree = np.mean([(full.noise > NOISE_THRESHOLD) == (proxy.noise > NOISE_THRESHOLD) for full, proxy in renormalized])
+        lines.append(f"| {name} | {np.median(drift):.2%} | {np.percentile(drift, 90):.2%} | {drift.max():.2%} | {agree:.1%} |")
+
+    full_seconds = sum(s[3] for s in samples)
+    proxy_seconds = sum(s[4] for s in samples)
+    lines += [
+        "",
+        f"Decode + analysis time: full {full_seconds:.2f}s, proxy {proxy_seconds:.2f}s "
+        f"({full_seconds / max(proxy_seconds, 1e-9):.1f}x faster).",
+    ]
+    return "\n".join(lines) + "\n"
+
+
+def main(argv=None):
+    current_dir = os.path.dirname(os.path.abspath(__file__))
+    parser = argparse.ArgumentParser(description="Compare proxy and full resolution metrics on sample images.")
+    parser.add_argument('inputs', nargs='+', help="directories, glob patterns or image files")
+    parser.add_argument('-c', '--config', default=os.path.join(current_dir, 'config', 'thersholds.yaml'),
+                        help="thresholds yaml file")
+    parser.add_argument('--max-pixels', type=int, default=None, help="proxy budget (default: from the config)")
+    parser.add_argument('--proxy', choices=('reduce', 'draft'), default='reduce',
+                        help="proxy of analysis mode 'proxy' (reduce) or of the UI preview's draft decode (draft)")
+    parser.add_argument('--limit', type=int, default=None, help="max number of images to measure")
+    parser.add_argument('-o', '--output', default=None, help="write the markdown report to this file")
+    args = parser.parse_args(argv)
+
+    thresholds = load_thresholds(args.config)
+    settings = analysis_settings(thresholds)
+    max_pixels = args.max_pixels or settings['proxy_max_pixels']
+
+    samples = []
+    for path, _ in itertools.islice(iter_inputs(args.inputs), args.limit):
+        try:
+            samples.append(measure(path, max_pixels, args.proxy))
+        except Exception as e:
+            print(f"SKIPPED {path}: {type(e).__name__}: {e}", file=sys.stderr)
+    if not samples:
+        print("No images could be measured.", file=sys.stderr)
+        return 1
+
+    report = build_report(samples, thresholds, max_pixels, settings['sharpness_exponent'], args.proxy)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(report)
+    print(report)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
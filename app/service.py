@@ -0,0 +1,252 @@
+"""
+    service: HTTP enhancement service (FastAPI / ASGI).
+
+    Usage:
+        cd app
+        uvicorn service:app --host 0.0.0.0 --port 8000
+
+        curl -F file=@photo.jpg http://localhost:8000/enhance -o enhanced.jpg
+        curl --data-binary @photo.jpg -H "Content-Type: image/jpeg" \\
+            "http://localhost:8000/enhance?format=json"
+
+    POST /enhance takes a multipart upload (field 'file') or the raw image
+    bytes as the body. By default it answers with the enhanced JPEG and the
+    metrics as JSON in the X-Enhancement-Metrics header; format=json returns
+    one JSON document with the metrics and the base64 encoded image.
+    fast=true takes the fast path for high volume traffic: the strategy's
+    fast_name recommendation, no denoising or deblurring.
+
+    The pipeline runs in a process pool so the event loop never blocks. At
+    most workers + max_queue requests are admitted at a time, the rest get
+    429 at once; bodies over max_request_mb get 413 before they are read
+    into memory, and so do images over max_pixels before they are decoded.
+    GET /metrics serves the per-stage timings when profiling is enabled.
+"""
+import asyncio
+import base64
+import concurrent.futures
+import contextlib
+import json
+import os
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, PlainTextResponse, Response
+from PIL import Image, UnidentifiedImageError
+
+from utility.analysis import metrics_to_dict
+from utility.config import load_thresholds
+from utility.pipeline import enhance_bytes
+from utility.profiling import REGISTRY, export_metrics, tracer_from_config
+from utility.strategies import fast_path_thresholds
+from utility.workers import process_pool, worker_state
+
+CONFIG_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'config', 'thersholds.yaml')
+
+# Service settings used when the yaml has no 'service' section
+DEFAULT_SERVICE = {
+    'workers': None,
+    'max_queue': 16,
+    'max_request_mb': 50,
+    'max_pixels': 100000000,
+    'executor': 'process'
+}
+
+class ImageTooLarge(Exception):
+    pass
+
+
+def service_settings(thresholds, **overrides):
+    """
+        service_settings: the 'service' section of the thresholds with
+                        defaults filled in and the overrides applied.
+    """
+    settings = dict(DEFAULT_SERVICE)
+    settings.update(thresholds.get('service') or {})
+    settings.update(overrides)
+    settings['workers'] = settings['workers'] or os.cpu_count() or 1
+    if settings['executor'] not in ('process', 'thread'):
+        raise ValueError(f"service executor must be 'process' or 'thread', not {settings['executor']!r}")
+    return settings
+
+
+def enhance_request(image_bytes, max_pixels, thresholds=None, fast=False):
+    """
+        enhance_request: worker side of one request.
+
+        Params:
+            - image_bytes: uploaded image
+            - max_pixels: largest image accepted, checked from the header
+            before anything is decoded
+            - thresholds: thresholds dictionary, the one the worker was
+            started with when None
+            - fast: take the fast path (fast_path_thresholds)
+
+        returns:
+            - enhanced JPEG bytes, a JSON-ready metrics dictionary and the
+            StageRecords of the request (empty unless profiling is enabled)
+    """
+    import io
+
+    with Image.open(io.BytesIO(image_bytes)) as image:
+        width, height = image.size
+    if width * height > max_pixels:
+        raise ImageTooLarge(f"image has {width * height} pixels, the limit is {max_pixels}")
+
+    thresholds = thresholds or worker_state()
+    if fast:
+        thresholds = fast_path_thresholds(thresholds)
+    # the records go back to the server process, which owns the registry
+    with tracer_from_config(thresholds, name='enhance', registry=None) as tracer:
+        result = enhance_bytes(image_bytes, thresholds)
+    metrics = {
+        'width': width,
+        'height': height,
+        'metrics': metrics_to_dict(result.metrics),
+        'recommended': {name: float(value) for name, value in result.recommended.items()},
+    }
+    return result.output, metrics, tracer.records
+
+
+def header_metrics(metrics):
+    """
+        header_metrics: the metrics of a response without the per-tile
+                        grids of the blur map, which grow with the image
+                        (about 120 KB at 24MP) past the 8-16 KB header
+                        limits of common proxies; tile size and blurry
+                        share are kept, format=json returns the grids.
+    """
+    blur_map = metrics['metrics'].get('blur_map')
+    if blur_map is None:
+        return metrics
+    summary = {key: blur_map[key] for key in ('tile_size', 'blurry_fraction')}
+    return dict(metrics, metrics=dict(metrics['metrics'], blur_map=summary))
+
+
+class _Admission:
+    """
+        Counts admitted requests; the event loop is single threaded so a
+        plain counter is enough.
+    """
+    def __init__(self, limit):
+        self.limit = limit
+        self.active = 0
+
+    def try_acquire(self):
+        if self.active >= self.limit:
+            return False
+        self.active += 1
+        return True
+
+    def release(self):
+        self.active -= 1
+
+
+async def _read_body(request, max_bytes):
+    # stream the body and stop as soon as it goes over the limit
+    chunks = []
+    size = 0
+    async for chunk in request.stream():
+        size += len(chunk)
+        if size > max_bytes:
+            return None
+        chunks.append(chunk)
+    return b''.join(chunks)
+
+
+def create_app(thresholds=None, **overrides):
+    """
+        create_app: build the FastAPI application.
+
+        Params:
+            - thresholds: thresholds dictionary, loaded from
+            config/thersholds.yaml when None
+            - overrides: service settings that win over the yaml (workers,
+            max_queue, max_request_mb, max_pixels, executor)
+
+        returns:
+            - the FastAPI app
+    """
+    if thresholds is None:
+        thresholds = load_thresholds(CONFIG_PATH)
+    settings = service_settings(thresholds, **overrides)
+    max_request_bytes = int(settings['max_request_mb'] * 1024 * 1024)
+    admission = _Admission(settings['workers'] + settings['max_queue'])
+    state = {}
+
+    @contextlib.asynccontextmanager
+    async def lifespan(app):
+        if settings['executor'] == 'process':
+            state['executor'] = process_pool(settings['workers'], thresholds)
+        else:
+            state['executor'] = concurrent.futures.ThreadPoolExecutor(max_workers=settings['workers'])
+        try:
+            yield
+        finally:
+            state['executor'].shutdown(wait=True, cancel_futures=True)
+
+    app = FastAPI(title='Image Enhancement Service', lifespan=lifespan)
+
+    @app.get('/healthz')
+    async def healthz():
+        return {'status': 'ok', 'active': admission.active, 'limit': admission.limit}
+
+    @app.get('/metrics')
+    async def metrics():
+        # per-stage timings in the Prometheus text format (profiling section)
+        return PlainTextResponse(REGISTRY.prometheus_text(), media_type='text/plain; version=0.0.4')
+
+    @app.post('/enhance')
+    async def enhance(request: Request, format: str = 'image', fast: bool = False):
+        content_length = request.headers.get('content-length')
+        if content_length is not None:
+            try:
+                content_length = int(content_length)
+            except ValueError:
+                return JSONResponse({'detail': 'invalid Content-Length header'}, status_code=400)
+            if content_length > max_request_bytes:
+                return JSONResponse({'detail': 'request body too large'}, status_code=413)
+        if not admission.try_acquire():
+            return JSONResponse({'detail': 'server busy, retry later'}, status_code=429, headers={'Retry-After': '1'})
+        try:
+            content_type = request.headers.get('content-type', '')
+            if content_type.startswith('multipart/form-data'):
+                if content_length is None:
+                    return JSONResponse({'detail': 'multipart uploads need a Content-Length'}, status_code=411)
+                form = await request.form()
+                upload = form.get('file')
+                if upload is None or isinstance(upload, str):
+                    return JSONResponse({'detail': "multipart upload needs a 'file' field"}, status_code=400)
+                image_bytes = await upload.read()
+            else:
+                image_bytes = await _read_body(request, max_request_bytes)
+                if image_bytes is None:
+                    return JSONResponse({'detail': 'request body too large'}, status_code=413)
+            if not image_bytes:
+                return JSONResponse({'detail': 'empty request body'}, status_code=400)
+
+            loop = asyncio.get_running_loop()
+            # process workers use the thresholds they were started with
+            worker_thresholds = thresholds if settings['executor'] == 'thread' else None
+            try:
+                output, metrics, records = await loop.run_in_executor(
+                    state['executor'], enhance_request, image_bytes, settings['max_pixels'], worker_thresholds, fast)
+            except ImageTooLarge as e:
+                return JSONResponse({'detail': str(e)}, status_code=413)
+            except (UnidentifiedImageError, OSError, ValueError) as e:
+                return JSONResponse({'detail': f"cannot process image: {e}"}, status_code=400)
+        finally:
+            admission.release()
+
+        for record in records:
+            REGISTRY.observe(record)
+        export_metrics(thresholds)
+
+        if format == 'json':
+            return JSONResponse(dict(metrics, image=base64.b64encode(output).decode('ascii')))
+        return Response(output, media_type='image/jpeg',
+                        headers={'X-Enhancement-Metrics': json.dumps(header_metrics(metrics))})
+
+    return app
+
+
+app = create_app()
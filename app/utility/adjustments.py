@@ -0,0 +1,175 @@
+from PIL import Image, ImageEnhance, ImageStat
+import numpy as np
+import cv2
+
+from utility.tiling import band_rows
+
+
+def adjustment_factors(saturation_value, brightness_value, contrast_value, sharpness_value):
+    """
+        adjustment_factors: map recommended values (0-10, 5 = unchanged)
+                        to the enhancement factors apply_adjustments uses.
+
+        returns:
+            - saturation, brightness and contrast factor and sharpness alpha
+    """
+    saturation_factor = max(1.0, min(2.0, 1.0 + (saturation_value - 5) * 0.2))
+    brightness_factor = max(1.0, min(2.0, 1.0 + (brightness_value - 5) * 0.2))
+    contrast_factor = max(1.0, min(2.0, 1.0 + (contrast_value - 5) * 0.2))
+    sharpness_alpha = max(0.0, min(2.0, (sharpness_value - 5) * 0.2))
+    return saturation_factor, brightness_factor, contrast_factor, sharpness_alpha
+
+
+def sharpen_kernel(alpha):
+    # sharpening kernel of apply_adjustments
+    return np.array([[-1, -1, -1], [-1, 9 + alpha, -1], [-1, -1, -1]])
+
+
+def apply_adjustments_chain(image, saturation_value, brightness_value, contrast_value, sharpness_value):
+    """
+        apply_adjustments_chain: reference implementation of apply_adjustments
+                        with three ImageEnhance passes and a filter2D pass.
+                        Kept to check and benchmark the fused engine.
+    """
+    saturation_factor, brightness_factor, contrast_factor, sharpness_alpha = adjustment_factors(
+        saturation_value, brightness_value, contrast_value, sharpness_value)
+    image = ImageEnhance.Color(image).enhance(saturation_factor)
+    image = ImageEnhance.Brightness(image).enhance(brightness_factor)
+    image = ImageEnhance.Contrast(image).enhance(contrast_factor)
+    image_np = cv2.filter2D(np.array(image), -1, sharpen_kernel(sharpness_alpha))
+    return Image.fromarray(image_np)
+
+
+def blend_lut(degenerate, factor):
+    """
+        blend_lut: lookup table of Image.blend(degenerate, image, factor)
+                for a constant degenerate value.
+
+        Pillow blends in float32 and truncates towards zero, the table does
+        the same so the result is identical to the ImageEnhance pass.
+    """
+    values = np.arange(256, dtype=np.float32)
+    blended = np.float32(degenerate) + np.float32(factor) * (values - np.float32(degenerate))
+    return np.clip(blended, 0, 255).astype(np.uint8)
+
+
+def saturate(image_np, saturation_factor):
+    """
+        saturate: the saturation pass of apply_adjustments on its own,
+                ImageEnhance.Color on an RGB array.
+    """
+    if saturation_factor == 1.0:
+        return image_np
+    return np.asarray(ImageEnhance.Color(Image.fromarray(image_np)).enhance(saturation_factor))
+
+
+def brighten(image_np, brightness_factor):
+    """
+        brighten: the brightness pass of apply_adjustments on its own, as a
+                lookup table (identical to ImageEnhance.Brightness).
+    """
+    if brightness_factor == 1.0:
+        return image_np
+    return cv2.LUT(image_np, blend_lut(0, brightness_factor))
+
+
+def contrast(image_np, contrast_factor):
+    """
+        contrast: the contrast pass of apply_adjustments on its own, a blend
+                towards the rounded luma mean as a lookup table (identical
+                to ImageEnhance.Contrast).
+    """
+    if contrast_factor == 1.0:
+        return image_np
+    mean = int(ImageStat.Stat(Image.fromarray(image_np).convert('L')).mean[0] + 0.5)
+    return cv2.LUT(image_np, blend_lut(mean, contrast_factor))
+
+
+def sharpen(image_np, sharpness_alpha):
+    """
+        sharpen: the sharpening pass of apply_adjustments on its own.
+    """
+    return cv2.filter2D(image_np, -1, sharpen_kernel(sharpness_alpha))
+
+
+def apply_adjustments_fused(image, saturation_value, brightness_value, contrast_value, sharpness_value,
+                            memory_budget=None):
+    """
+        apply_adjustments_fused: same result as apply_adjustments_chain,
+                        computed in two banded sweeps.
+
+        The first sweep runs the saturation blend, the brightness table and
+        the luma histogram contrast needs for its mean on one band at a
+        time. The second sweep applies the contrast table and the sharpening
+        kernel band by band and pastes the result into the output image.
+        Brightness and contrast are folded into lookup tables, every other
+        temporary is the size of one band, so besides the output image only
+        one full-size working frame is allocated (the chain makes about
+        eight).
+
+        Tolerance: the output is bit-identical to apply_adjustments_chain.
+        The saturation blend is Pillow's own, and the tables reproduce
+        Image.blend's float32 blend with truncation (checked on Pillow 10
+        to 12). Should a Pillow build round the blend differently, values
+        before sharpening can move by 1 level at most.
+
+        Params:
+            - image: RGB PIL image or RGB numpy array (uint8)
+            - saturation_value, brightness_value, contrast_value,
+            sharpness_value: recommended values
+            - memory_budget: working memory in bytes, sets the band height
+
+        returns:
+            - the enhanced PIL image
+    """
+    if isinstance(image, Image.Image) and image.mode != 'RGB':
+        # alpha and palette images keep the reference behaviour
+        return apply_adjustments_chain(image, saturation_value, brightness_value, contrast_value, sharpness_value)
+
+    saturation_factor, brightness_factor, contrast_factor, sharpness_alpha = adjustment_factors(
+        saturation_value, brightness_value, contrast_value, sharpness_value)
+    brightness_table = blend_lut(0, brightness_factor).tolist() * 3
+
+    is_array = not isinstance(image, Image.Image)
+    if is_array:
+        height, width = image.shape[:2]
+    else:
+        width, height = image.size
+    rows = band_rows(width, 'adjust', memory_budget, halo=1)
+
+    work = np.empty((height, width, 3), dtype=np.uint8)
+    luma_histogram = [0] * 256
+    for top in range(0, height, rows):
+        bottom = min(height, top + rows)
+        # arrays are converted one band at a time, never as a whole frame
+        band = Image.fromarray(image[top:bottom]) if is_array else image.crop((0, top, width, bottom))
+        if saturation_factor != 1.0:
+            band = ImageEnhance.Color(band).enhance(saturation_factor)
+        if brightness_factor != 1.0:
+            band = band.point(brightness_table)
+        if contrast_factor != 1.0:
+            luma_histogram = [total + count for total, count in zip(luma_histogram, band.convert('L').histogram())]
+        work[top:bottom] = np.asarray(band)
+
+    if contrast_factor != 1.0:
+        # mean of the luma image, rounded like ImageEnhance.Contrast
+        mean = int(ImageStat.Stat(luma_histogram).mean[0] + 0.5)
+        contrast_lut = blend_lut(mean, contrast_factor)
+    else:
+        contrast_lut = None
+
+    kernel = sharpen_kernel(sharpness_alpha)
+    output = Image.new('RGB', (width, height))
+    for top in range(0, height, rows):
+        bottom = min(height, top + rows)
+        # one halo row on each side for the 3x3 kernel; at the image edges
+        # the band itself is the border, as it is for the full frame
+        halo_top = max(0, top - 1)
+        halo_bottom = min(height, bottom + 1)
+        band = work[halo_top:halo_bottom]
+        if contrast_lut is not None:
+            band = cv2.LUT(band, contrast_lut)
+        sharpened = cv2.filter2D(band, -1, kernel)
+        output.paste(Image.fromarray(sharpened[top - halo_top:top - halo_top + bottom - top]), (0, top))
+
+    return output
@@ -0,0 +1,510 @@
+from collections import namedtuple
+import math
+
+from PIL import Image
+import numpy as np
+import cv2
+
+from utility.tiling import band_rows
+from utility.profiling import traced
+
+# All metrics the pipeline needs from one image. sharpness and blur are the
+# same Laplacian variance, it is computed once and reported under both names
+# so callers of get_image_metrics and detect_blur keep their meaning.
+# noise is the global standard deviation detect_noise has always returned,
+# noise_sigma a robust estimate of the actual sensor noise (see below).
+# blur_map is a BlurMap when the pipeline runs in blur map mode, else None.
+# statistics is the ImageStatistics the metrics were derived from, for the
+# recommendation strategies (None for metrics from other sources); metrics
+# whose statistics were not computed are nan.
+ImageMetrics = namedtuple('ImageMetrics', ['saturation', 'brightness', 'contrast', 'sharpness', 'blur', 'noise',
+                                           'noise_sigma', 'blur_map', 'statistics'], defaults=(0.0, None, None))
+
+# The numeric ImageMetrics fields, one float each
+SCALAR_METRICS = ImageMetrics._fields[:7]
+
+# What one pass over the pixels gathers, every metric is a moment of it.
+# channel_histograms is (3, 256) counts of R, G and B, gray_histogram the
+# 256 counts of the gray image, saturation_histogram and value_histogram
+# those of the HSV S and V planes, laplacian the (count, sum, sum of
+# squares) of the 3x3 Laplacian of every channel and residual_histogram the
+# counts of |NOISE_KERNEL response| of the gray image. Parts that were not
+# asked for are None.
+ImageStatistics = namedtuple('ImageStatistics', ['pixels', 'channel_histograms', 'gray_histogram',
+                                                 'saturation_histogram', 'value_histogram', 'laplacian',
+                                                 'residual_histogram'])
+
+# Parts image_statistics can compute, and the ones each metric reads
+STATISTICS_PARTS = ('channels', 'gray', 'hsv', 'laplacian', 'residual')
+METRIC_PARTS = {
+    'saturation': 'hsv',
+    'brightness': 'hsv',
+    'contrast': 'gray',
+    'sharpness': 'laplacian',
+    'blur': 'laplacian',
+    'noise': 'channels',
+    'noise_sigma': 'residual',
+}
+
+# Sharpness of every tile_size x tile_size tile (full resolution pixels,
+# the last row and column of tiles may be smaller): Laplacian variance on
+# the scale of the blur metric and gray standard deviation on the scale of
+# the contrast metric. Tiles without contrast are flat (sky, walls), not
+# blurry, so blurry only marks tiles below the blur threshold that have
+# some detail to lose.
+BlurMap = namedtuple('BlurMap', ['sharpness', 'contrast', 'blurry', 'tile_size'])
+
+# High-pass kernel of Immerkaer's noise estimator. It cancels flat areas and
+# linear gradients, so on natural images the median of its absolute
+# response is dominated by noise; its L2 norm is 6.
+NOISE_KERNEL = np.array([[1, -2, 1], [-2, 4, -2], [1, -2, 1]], dtype=np.float32)
+# |response| of a uint8 gray image is at most 16 * 255
+_NOISE_BINS = 16 * 255 + 1
+# cv2.calcHist counts in float32, exact up to 2 ** 24 per call
+_HISTOGRAM_MAX_PIXELS = 1 << 24
+_LEVELS = np.arange(256, dtype=np.int64)
+
+# Laplacian variance on a proxy downscaled by a linear factor s is taken as
+# s ** SHARPNESS_EXPONENT times the full resolution value. Scale invariant
+# (sharp) scenes are close to 0, soft camera originals closer to 2; use
+# proxy_calibration.py to fit it on your own images.
+SHARPNESS_EXPONENT = 1.0
+
+
+class _MomentAccumulator:
+    """
+        Exact streaming mean/variance over integer samples, using Python
+        int sums so nothing overflows or loses precision on huge images.
+    """
+    def __init__(self):
+        self.count = 0
+        self.total = 0
+        self.total_sq = 0
+
+    def add(self, values):
+        values = values.reshape(-1)
+        self.count += values.size
+        self.total += int(values.sum(dtype=np.int64))
+        wide = values.astype(np.int64)
+        self.total_sq += int(np.dot(wide, wide))
+
+    def mean(self):
+        return self.total / self.count if self.count else 0.0
+
+    def var(self):
+        if not self.count:
+            return 0.0
+        return (self.count * self.total_sq - self.total * self.total) / (self.count * self.count)
+
+    def std(self):
+        return float(np.sqrt(self.var()))
+
+
+def _histogram(image, channel=0):
+    # 256 bin counts of one channel of a uint8 band, exact whatever its
+    # size: calcHist is about 6x faster than np.bincount, which widens
+    # every pixel to 64 bits
+    counts = np.zeros(256, dtype=np.int64)
+    rows = max(1, _HISTOGRAM_MAX_PIXELS // max(1, image.shape[1]))
+    for top in range(0, image.shape[0], rows):
+        counts += np.rint(cv2.calcHist([image[top:top + rows]], [channel], None, [256], [0, 256]).ravel()).astype(
+            np.int64)
+    return counts
+
+
+def histogram_moments(histogram):
+    """
+        histogram_moments: exact (count, sum, sum of squares) of the 8-bit
+                        values counted in a 256 bin histogram.
+    """
+    histogram = np.asarray(histogram, dtype=np.int64)
+    return int(histogram.sum()), int(np.dot(_LEVELS, histogram)), int(np.dot(_LEVELS * _LEVELS, histogram))
+
+
+def _moments_var(count, total, total_sq):
+    # same formula as _MomentAccumulator.var, so the metrics do not change
+    if not count:
+        return 0.0
+    return (count * total_sq - total * total) / (count * count)
+
+
+@traced()
+def image_statistics(image, memory_budget=None, parts=STATISTICS_PARTS):
+    """
+        image_statistics: gather the ImageStatistics of the image in one
+                    pass over horizontal bands, sharing the intermediates.
+                    Only the parts asked for are computed, so a consumer
+                    that needs less (the histogram strategy) pays less.
+
+        Params:
+            - image: PIL image or RGB numpy array (uint8)
+            - memory_budget: working memory in bytes; only one band of
+            intermediates (HSV, gray, Laplacian) exists at a time
+            - parts: names from STATISTICS_PARTS
+
+        returns:
+            - ImageStatistics, None for the parts not computed
+    """
+    unknown = set(parts) - set(STATISTICS_PARTS)
+    if unknown:
+        raise ValueError(f"unknown statistics parts {sorted(unknown)}, choose from {', '.join(STATISTICS_PARTS)}")
+    image_np = np.asarray(image)
+    height, width = image_np.shape[:2]
+    rows = band_rows(width, 'analysis', memory_budget, halo=1)
+
+    channel_histograms = np.zeros((3, 256), dtype=np.int64) if 'channels' in parts else None
+    gray_histogram = np.zeros(256, dtype=np.int64) if 'gray' in parts else None
+    saturation_histogram = np.zeros(256, dtype=np.int64) if 'hsv' in parts else None
+    value_histogram = np.zeros(256, dtype=np.int64) if 'hsv' in parts else None
+    laplacian_moments = _MomentAccumulator() if 'laplacian' in parts else None
+    residual_histogram = np.zeros(_NOISE_BINS, dtype=np.int64) if 'residual' in parts else None
+
+    for top in range(0, height, rows):
+        bottom = min(height, top + rows)
+        band = image_np[top:bottom]
+
+        if channel_histograms is not None:
+            for channel in range(3):
+                channel_histograms[channel] += _histogram(band, channel)
+        if saturation_histogram is not None:
+            hsv = cv2.cvtColor(band, cv2.COLOR_RGB2HSV)
+            saturation_histogram += _histogram(hsv, 1)
+            value_histogram += _histogram(hsv, 2)
+
+        # The 3x3 filters need one row above and below the band. At the
+        # real image edges the band is used as is, so OpenCV applies the
+        # same border handling as on the full image.
+        halo_top = max(0, top - 1)
+        halo_bottom = min(height, bottom + 1)
+        inner = slice(top - halo_top, top - halo_top + bottom - top)
+        if laplacian_moments is not None:
+            # uint8 input gives integer Laplacian values in [-1020, 1020],
+            # so CV_16S is exact and a quarter of the CV_64F footprint
+            laplacian = cv2.Laplacian(image_np[halo_top:halo_bottom], cv2.CV_16S)
+            laplacian_moments.add(laplacian[inner])
+
+        if gray_histogram is not None or residual_histogram is not None:
+            gray = cv2.cvtColor(image_np[halo_top:halo_bottom], cv2.COLOR_RGB2GRAY)
+            if gray_histogram is not None:
+                gray_histogram += _histogram(gray[inner])
+            if residual_histogram is not None:
+                residual = cv2.filter2D(gray, cv2.CV_16S, NOISE_KERNEL)[inner]
+                residual_histogram += np.bincount(np.abs(residual).reshape(-1), minlength=_NOISE_BINS)
+
+    laplacian = None
+    if laplacian_moments is not None:
+        laplacian = (laplacian_moments.count, laplacian_moments.total, laplacian_moments.total_sq)
+    return ImageStatistics(height * width, channel_histograms, gray_histogram, saturation_histogram,
+                           value_histogram, laplacian, residual_histogram)
+
+
+def statistics_metrics(statistics):
+    """
+        statistics_metrics: the ImageMetrics of an ImageStatistics, nan for
+                        the metrics whose part was not computed.
+    """
+    pixels = statistics.pixels
+    nan = float('nan')
+    saturation = brightness = contrast = sharpness = noise = noise_sigma = nan
+    if statistics.saturation_histogram is not None:
+        saturation = histogram_moments(statistics.saturation_histogram)[1] / pixels
+        brightness = histogram_moments(statistics.value_histogram)[1] / pixels
+    if statistics.gray_histogram is not None:
+        contrast = float(np.sqrt(_moments_var(*histogram_moments(statistics.gray_histogram))))
+    if statistics.laplacian is not None:
+        sharpness = _moments_var(*statistics.laplacian)
+    if statistics.channel_histograms is not None:
+        # the moments of all the values, every channel together
+        count, total, total_sq = (sum(values) for values in
+                                  zip(*(histogram_moments(histogram) for histogram in statistics.channel_histograms)))
+        noise = float(np.sqrt(_moments_var(count, total, total_sq)))
+    if statistics.residual_histogram is not None:
+        noise_sigma = _histogram_median(statistics.residual_histogram) * 1.4826 / 6
+    return ImageMetrics(saturation=saturation, brightness=brightness, contrast=contrast, sharpness=sharpness,
+                        blur=sharpness, noise=noise, noise_sigma=noise_sigma, statistics=statistics)
+
+
+@traced()
+def analyze_image(image, memory_budget=None, parts=STATISTICS_PARTS):
+    """
+        analyze_image: compute every metric of the image in one pass over
+                    horizontal bands (image_statistics), sharing the
+                    intermediates.
+
+        Params:
+            - image: PIL image or RGB numpy array (uint8)
+            - memory_budget: working memory in bytes; only one band of
+            intermediates (HSV, gray, Laplacian) exists at a time
+            - parts: statistics to gather (STATISTICS_PARTS), the metrics
+            of the others are nan
+
+        returns:
+            - ImageMetrics with average saturation, average brightness,
+            contrast, sharpness, blur and noise level, and the statistics
+            they come from. The values match get_image_metrics,
+            detect_blur and detect_noise. noise_sigma is the median
+            absolute deviation of the NOISE_KERNEL response of the gray
+            image, scaled to the standard deviation of Gaussian noise in
+            8-bit levels.
+    """
+    return statistics_metrics(image_statistics(image, memory_budget, parts))
+
+
+def _histogram_median(histogram):
+    # lower median of the samples counted in an integer histogram
+    cumulative = np.cumsum(histogram)
+    if not cumulative[-1]:
+        return 0.0
+    return float(np.searchsorted(cumulative, (cumulative[-1] + 1) // 2))
+
+
+def analysis_proxy(image, max_pixels):
+    """
+        analysis_proxy: shrink the image by an integer factor so it has at
+                    most max_pixels pixels, using Pillow's fast box reduce.
+
+        Params:
+            - image: PIL image or RGB numpy array
+            - max_pixels: pixel budget of the proxy, None or 0 to disable
+
+        returns:
+            - the proxy (same type as the input) and the linear scale
+            factor between the full image and the proxy
+    """
+    if isinstance(image, Image.Image):
+        width, height = image.size
+    else:
+        height, width = image.shape[:2]
+    if not max_pixels or width * height <= max_pixels:
+        return image, 1.0
+    factor = math.ceil(math.sqrt(width * height / max_pixels))
+    if isinstance(image, Image.Image):
+        return image.reduce(factor), float(factor)
+    proxy_size = (max(1, width // factor), max(1, height // factor))
+    return cv2.resize(image, proxy_size, interpolation=cv2.INTER_AREA), float(factor)
+
+
+def open_analysis_proxy(fp, max_pixels):
+    """
+        open_analysis_proxy: decode an image file straight to an analysis
+                    proxy. JPEGs use draft mode, which lets libjpeg decode at
+                    1/2, 1/4 or 1/8 scale and skips most of the decode work.
+
+        Params:
+            - fp: file path or file object
+            - max_pixels: pixel budget of the proxy
+
+        returns:
+            - RGB proxy PIL image and the linear scale factor to the full
+            resolution image
+    """
+    image = Image.open(fp)
+    full_width, full_height = image.size
+    if image.format == 'JPEG' and max_pixels and full_width * full_height > max_pixels:
+        shrink = math.sqrt(full_width * full_height / max_pixels)
+        # draft never goes below the requested size, so ask for the budget
+        image.draft('RGB', (int(full_width / shrink), int(full_height / shrink)))
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+    image, _ = analysis_proxy(image, max_pixels)
+    return image, full_width / image.size[0]
+
+
+def renormalize_metrics(metrics, scale, sharpness_exponent=SHARPNESS_EXPONENT):
+    """
+        renormalize_metrics: bring metrics measured on a proxy back to the
+                    full resolution scale the thresholds are tuned for.
+                    Means and standard deviations are kept as they are
+                    and the Laplacian variance is divided by
+                    scale ** sharpness_exponent. The noise estimate is
+                    kept as well: real noise is not white, and scaling it
+                    by scale (the white noise rule) overshot it, so
+                    analyze_proxy measures it at full resolution instead.
+    """
+    if scale == 1.0:
+        return metrics
+    sharpness = metrics.sharpness / scale ** sharpness_exponent
+    return metrics._replace(sharpness=sharpness, blur=sharpness)
+
+
+def _center_crop(image, max_pixels):
+    # the central part of the image with at most max_pixels pixels, at full
+    # resolution
+    if isinstance(image, Image.Image):
+        width, height = image.size
+    else:
+        height, width = image.shape[:2]
+    shrink = math.sqrt(max_pixels / (width * height))
+    crop_width, crop_height = max(1, int(width * shrink)), max(1, int(height * shrink))
+    left, top = (width - crop_width) // 2, (height - crop_height) // 2
+    if isinstance(image, Image.Image):
+        return image.crop((left, top, left + crop_width, top + crop_height))
+    return image[top:top + crop_height, left:left + crop_width]
+
+
+@traced()
+def analyze_proxy(image, max_pixels, sharpness_exponent=SHARPNESS_EXPONENT, parts=STATISTICS_PARTS):
+    """
+        analyze_proxy: analyze_image on a downscaled proxy, renormalized
+                    to full resolution. Images within max_pixels are
+                    analyzed at full resolution. Downscaling averages
+                    noise away by an amount that depends on the noise, so
+                    noise_sigma is measured on a full resolution center
+                    crop of max_pixels pixels instead.
+
+        Params:
+            - image: PIL image or RGB numpy array
+            - max_pixels: pixel budget of the proxy
+            - sharpness_exponent: see SHARPNESS_EXPONENT
+            - parts: statistics to gather, see analyze_image
+
+        returns:
+            - ImageMetrics on the full resolution scale
+    """
+    proxy, scale = analysis_proxy(image, max_pixels)
+    metrics = renormalize_metrics(analyze_image(proxy, parts=parts), scale, sharpness_exponent)
+    if scale > 1 and METRIC_PARTS['noise_sigma'] in parts:
+        statistics = image_statistics(_center_crop(image, max_pixels), parts=(METRIC_PARTS['noise_sigma'],))
+        metrics = metrics._replace(noise_sigma=statistics_metrics(statistics).noise_sigma)
+    return metrics
+
+
+def _tile_sums(integral, edges_y, edges_x):
+    # sums over the tiles between consecutive edges, from an integral image
+    return (integral[np.ix_(edges_y[1:], edges_x[1:])] - integral[np.ix_(edges_y[:-1], edges_x[1:])]
+            - integral[np.ix_(edges_y[1:], edges_x[:-1])] + integral[np.ix_(edges_y[:-1], edges_x[:-1])])
+
+
+def _tile_edges(length, tile_size, scale=1.0):
+    # borders of the tile_size pixel tiles of an image scale times larger,
+    # in the pixels of this one; tiles are at least a pixel when tile_size
+    # is at least scale
+    edges = np.floor(np.arange(0, round(length * scale), tile_size) / scale + 0.5).astype(np.int64)
+    return np.append(edges[edges < length], length)
+
+
+def tile_statistics(image, tile_size, memory_budget=None, scale=1.0):
+    """
+        tile_statistics: Laplacian variance and gray standard deviation of
+                    every tile, the local versions of the blur and
+                    contrast metrics.
+
+        Per band, the Laplacian, its square and the gray image are turned
+        into integral images, and every tile sum is four lookups, so the
+        cost is O(pixels) whatever the tile size. The sums of integer
+        samples are exact in float64, a tile covering the whole image
+        gives analyze_image's sharpness and contrast.
+
+        Params:
+            - image: PIL image or RGB numpy array (uint8)
+            - tile_size: tile side in pixels
+            - memory_budget: working memory in bytes
+            - scale: linear factor between the image the tiles are laid
+            out on and this one; the tiles then cover rounded fractional
+            extents of this image
+
+        returns:
+            - sharpness and contrast arrays of shape (tile rows, tile cols)
+    """
+    image_np = np.asarray(image)
+    height, width = image_np.shape[:2]
+    edges_x = _tile_edges(width, tile_size, scale)
+    all_edges_y = _tile_edges(height, tile_size, scale)
+    # bands hold whole rows of tiles
+    tile_rows = max(1, band_rows(width, 'analysis', memory_budget, halo=1) // int(np.diff(all_edges_y).max()))
+    sharpness, contrast = [], []
+    for first in range(0, len(all_edges_y) - 1, tile_rows):
+        band_edges = all_edges_y[first:first + tile_rows + 1]
+        top, bottom = int(band_edges[0]), int(band_edges[-1])
+        halo_top = max(0, top - 1)
+        halo_bottom = min(height, bottom + 1)
+        inner = slice(top - halo_top, top - halo_top + bottom - top)
+        # same CV_16S Laplacian over the three channels as analyze_image;
+        # a channel sum fits int16 and a sum of squares float32 exactly
+        laplacian = cv2.Laplacian(image_np[halo_top:halo_bottom], cv2.CV_16S)[inner]
+        laplacian_sum = laplacian.sum(axis=2, dtype=np.int16)
+        laplacian_sq = np.square(laplacian, dtype=np.float32).sum(axis=2, dtype=np.float32)
+        gray = cv2.cvtColor(image_np[top:bottom], cv2.COLOR_RGB2GRAY)
+
+        edges_y = band_edges - top
+        pixels = np.outer(np.diff(edges_y), np.diff(edges_x))
+        total = _tile_sums(cv2.integral(laplacian_sum, sdepth=cv2.CV_64F), edges_y, edges_x)
+        total_sq = _tile_sums(cv2.integral(laplacian_sq, sdepth=cv2.CV_64F), edges_y, edges_x)
+        sharpness.append((3 * pixels * total_sq - total * total) / (3 * pixels) ** 2)
+        gray_integral, gray_integral_sq = cv2.integral2(gray, sdepth=cv2.CV_64F, sqdepth=cv2.CV_64F)
+        total = _tile_sums(gray_integral, edges_y, edges_x)
+        total_sq = _tile_sums(gray_integral_sq, edges_y, edges_x)
+        contrast.append(np.sqrt(np.maximum(pixels * total_sq - total * total, 0)) / pixels)
+    return np.concatenate(sharpness), np.concatenate(contrast)
+
+
+@traced()
+def blur_map(image, tile_size, threshold, min_contrast, max_pixels=None, sharpness_exponent=SHARPNESS_EXPONENT,
+             memory_budget=None, scale=1.0):
+    """
+        blur_map: where the image is blurry, tile by tile.
+
+        With max_pixels the map is measured on the analysis proxy: every
+        tile_size tile of the full resolution grid is measured on the proxy
+        pixels it covers (its edges rounded to the proxy), so the map lines
+        up with the full resolution tiles at any scale, and the tile
+        sharpness is renormalized like the global metric.
+
+        Params:
+            - image: PIL image or RGB numpy array
+            - tile_size: tile side in full resolution pixels
+            - threshold: tiles with a Laplacian variance below it are blurry
+            - min_contrast: tiles with a gray standard deviation below it
+            are flat and never blurry
+            - max_pixels: pixel budget of the proxy, None for full resolution
+            - sharpness_exponent: see SHARPNESS_EXPONENT
+            - memory_budget: working memory in bytes
+            - scale: linear factor between the full resolution image and
+            image, when image is already downscaled (a preview)
+
+        returns:
+            - BlurMap
+    """
+    proxy, proxy_scale = analysis_proxy(image, max_pixels)
+    scale *= proxy_scale
+    # a tile covers at least one proxy pixel
+    tile_size = max(tile_size, math.ceil(scale))
+    sharpness, contrast = tile_statistics(proxy, tile_size, memory_budget, scale)
+    sharpness /= scale ** sharpness_exponent
+    blurry = (sharpness < threshold) & (contrast >= min_contrast)
+    return BlurMap(sharpness, contrast, blurry, tile_size)
+
+
+def metrics_to_dict(metrics):
+    """
+        metrics_to_dict: JSON-ready dictionary of ImageMetrics; the blur
+                    map, when there is one, as tile size, blurry share and
+                    nested lists. The statistics are left out.
+    """
+    # metrics that were not computed (nan) are null
+    info = {name: None if math.isnan(getattr(metrics, name)) else float(getattr(metrics, name))
+            for name in SCALAR_METRICS}
+    if metrics.blur_map is not None:
+        blur_map = metrics.blur_map
+        info['blur_map'] = {
+            'tile_size': blur_map.tile_size,
+            'blurry_fraction': float(blur_map.blurry.mean()),
+            'sharpness': blur_map.sharpness.round(2).tolist(),
+            'contrast': blur_map.contrast.round(2).tolist(),
+            'blurry': blur_map.blurry.astype(int).tolist(),
+        }
+    return info
+
+
+def metrics_from_dict(info):
+    # ImageMetrics from metrics_to_dict
+    info = dict(info)
+    for name in SCALAR_METRICS:
+        if info.get(name, 0.0) is None:
+            info[name] = float('nan')
+    blur_map = info.pop('blur_map', None)
+    if blur_map is not None:
+        blur_map = BlurMap(np.array(blur_map['sharpness'], dtype=np.float64),
+                           np.array(blur_map['contrast'], dtype=np.float64),
+                           np.array(blur_map['blurry'], dtype=bool), blur_map['tile_size'])
+    return ImageMetrics(**info, blur_map=blur_map)
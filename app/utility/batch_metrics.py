@@ -0,0 +1,219 @@
+import csv
+
+import numpy as np
+import cv2
+
+from utility.analysis import SCALAR_METRICS, NOISE_KERNEL
+from utility.tiling import BYTES_PER_PIXEL, MEMORY_BUDGET
+
+# Columns of the metrics table: where the row came from, its size, the
+# proxy scale it was analysed at and every numeric ImageMetrics field
+METRICS_DTYPE = np.dtype([('index', np.int64), ('name', object), ('width', np.int32), ('height', np.int32),
+                          ('scale', np.float64)] + [(field, np.float64) for field in SCALAR_METRICS])
+
+
+def _variance(count, total, total_sq):
+    return (count * total_sq - total * total) / (count * count)
+
+
+def _pad_tall(stack):
+    # one pixel of BORDER_REFLECT_101 (OpenCV's default border) around
+    # every image, stacked into one tall image
+    pad = [(0, 0), (1, 1), (1, 1)] + [(0, 0)] * (stack.ndim - 3)
+    padded = np.pad(stack, pad, mode='reflect')
+    return padded.reshape((-1,) + padded.shape[2:])
+
+
+def stack_metrics(stack):
+    """
+        stack_metrics: every numeric ImageMetrics field of a stack of
+                    same-size images.
+
+        The filters run once for the whole stack viewed as one tall image:
+        colour conversions directly, the 3x3 Laplacian and noise kernel on
+        images padded with OpenCV's own border, so no filter reaches into
+        the neighbouring image. The per image reductions (sums and sums of
+        squares) are single OpenCV calls on views, the noise medians one
+        partition over the stack. Sums of integer samples are exact in
+        float64 below 2 ** 53, so the values equal analyze_image's on
+        each image up to the last bit of float rounding.
+
+        Params:
+            - stack: (N, H, W, 3) uint8 RGB array
+
+        returns:
+            - dictionary of SCALAR_METRICS field -> float64 array of length N
+    """
+    count, height, width = stack.shape[:3]
+    pixels = height * width
+    metrics = {field: np.empty(count) for field in SCALAR_METRICS}
+
+    hsv = cv2.cvtColor(stack.reshape(count * height, width, 3), cv2.COLOR_RGB2HSV).reshape(stack.shape)
+    laplacian = cv2.Laplacian(_pad_tall(stack), cv2.CV_16S).reshape(count, height + 2, width + 2, 3)
+    gray = cv2.cvtColor(_pad_tall(stack), cv2.COLOR_RGB2GRAY).reshape(count, height + 2, width + 2)
+    residual = np.abs(cv2.filter2D(gray.reshape(-1, width + 2), cv2.CV_16S, NOISE_KERNEL))
+    residual = residual.reshape(count, height + 2, width + 2)[:, 1:-1, 1:-1].reshape(count, pixels)
+    # lower median of every image in one call, the value
+    # analysis._histogram_median reads from the histogram
+    middle = (pixels + 1) // 2 - 1
+    metrics['noise_sigma'] = np.partition(residual, middle, axis=1)[:, middle] * 1.4826 / 6
+
+    for index in range(count):
+        _, saturation_sum, brightness_sum, _ = cv2.sumElems(hsv[index])
+        metrics['saturation'][index] = saturation_sum / pixels
+        metrics['brightness'][index] = brightness_sum / pixels
+        image = stack[index]
+        metrics['noise'][index] = _variance(pixels * 3, sum(cv2.sumElems(image)),
+                                            cv2.norm(image, cv2.NORM_L2SQR)) ** 0.5
+        inner = laplacian[index, 1:-1, 1:-1]
+        metrics['sharpness'][index] = _variance(pixels * 3, sum(cv2.sumElems(inner)),
+                                                cv2.norm(inner, cv2.NORM_L2SQR))
+        inner = gray[index, 1:-1, 1:-1]
+        metrics['contrast'][index] = _variance(pixels, cv2.sumElems(inner)[0],
+                                               cv2.norm(inner, cv2.NORM_L2SQR)) ** 0.5
+    metrics['blur'] = metrics['sharpness']
+    return metrics
+
+
+def chunk_size(height, width, memory_budget=None):
+    # images per vectorized pass that keep the temporaries in the budget
+    budget = memory_budget or MEMORY_BUDGET
+    return max(1, int(budget // (height * width * BYTES_PER_PIXEL['analysis'])))
+
+
+def _table(count):
+    table = np.zeros(count, dtype=METRICS_DTYPE)
+    table['scale'] = 1.0
+    return table
+
+
+def _fill(table, stack, indices, names, scales):
+    metrics = stack_metrics(stack)
+    table['index'] = indices
+    table['name'] = names
+    table['height'], table['width'] = stack.shape[1:3]
+    table['scale'] = scales
+    for field, values in metrics.items():
+        table[field] = values
+    return table
+
+
+def analyze_stack(stack, names=None, memory_budget=None):
+    """
+        analyze_stack: metrics table of an (N, H, W, 3) stack of same-size
+                    images, processed in chunks that fit the budget.
+
+        Params:
+            - stack: uint8 RGB array, e.g. thumbnails; a np.memmap works
+            and is only read one chunk at a time
+            - names: optional name per image
+            - memory_budget: working memory in bytes
+
+        returns:
+            - structured array with METRICS_DTYPE, one row per image
+    """
+    count, height, width = stack.shape[:3]
+    names = list(names) if names is not None else [None] * count
+    table = _table(count)
+    step = chunk_size(height, width, memory_budget)
+    for start in range(0, count, step):
+        stop = min(count, start + step)
+        _fill(table[start:stop], np.ascontiguousarray(stack[start:stop]), np.arange(start, stop),
+              names[start:stop], 1.0)
+    return table
+
+
+def analyze_many(images, names=None, scales=None, memory_budget=None):
+    """
+        analyze_many: metrics table of images of any sizes, e.g. from a
+                    generator. Images are bucketed by shape and every
+                    bucket is analysed with stack_metrics once it holds a
+                    chunk; the buffered images never exceed the budget.
+
+        Params:
+            - images: iterable of RGB uint8 arrays or PIL images
+            - names: optional iterable of names, one per image
+            - scales: optional iterable of proxy scales, one per image
+            (see renormalize_table)
+            - memory_budget: working memory in bytes
+
+        returns:
+            - structured array with METRICS_DTYPE, in input order
+    """
+    budget = memory_budget or MEMORY_BUDGET
+    names = iter(names) if names is not None else None
+    scales = iter(scales) if scales is not None else None
+    buckets = {}
+    buffered = 0
+    tables = []
+
+    def flush(shape):
+        nonlocal buffered
+        entries = buckets.pop(shape)
+        stack = np.stack([image for _, image, _, _ in entries])
+        buffered -= stack.nbytes
+        tables.append(_fill(_table(len(entries)), stack, [index for index, _, _, _ in entries],
+                            [name for _, _, name, _ in entries], [scale for _, _, _, scale in entries]))
+
+    for index, image in enumerate(images):
+        image = np.asarray(image)
+        if image.ndim == 2:
+            image = cv2.cvtColor(image, cv2.COLOR_GRAY2RGB)
+        elif image.shape[2] == 4:
+            image = image[:, :, :3]
+        name = next(names) if names is not None else None
+        scale = next(scales) if scales is not None else 1.0
+        bucket = buckets.setdefault(image.shape, [])
+        bucket.append((index, image, name, scale))
+        buffered += image.nbytes
+        if len(bucket) >= chunk_size(image.shape[0], image.shape[1], budget):
+            flush(image.shape)
+        elif buffered * BYTES_PER_PIXEL['analysis'] // 3 > budget:
+            # too many partial buckets: run the fullest one
+            flush(max(buckets, key=lambda shape: len(buckets[shape]) * shape[0] * shape[1]))
+    for shape in list(buckets):
+        flush(shape)
+
+    if not tables:
+        return _table(0)
+    table = np.concatenate(tables)
+    return table[np.argsort(table['index'], kind='stable')]
+
+
+def renormalize_table(table, sharpness_exponent):
+    """
+        renormalize_table: bring rows measured on proxies (scale > 1) back
+                    to the full resolution scale, as renormalize_metrics
+                    does for one image (noise_sigma stays the proxy's).
+    """
+    table = table.copy()
+    table['sharpness'] = table['sharpness'] / table['scale'] ** sharpness_exponent
+    table['blur'] = table['sharpness']
+    return table
+
+
+def to_dataframe(table):
+    # pandas view of the table, pandas is optional
+    import pandas as pd
+    return pd.DataFrame({name: table[name] for name in table.dtype.names})
+
+
+def write_table(table, path):
+    """
+        write_table: save the table as .npy, .csv or .parquet (pandas and
+                    pyarrow needed), chosen by the file extension.
+    """
+    extension = path.rsplit('.', 1)[-1].lower()
+    if extension == 'npy':
+        # names are Python objects, store them as unicode
+        dtype = [(name, 'U256' if name == 'name' else table.dtype[name]) for name in table.dtype.names]
+        np.save(path, table.astype(dtype))
+    elif extension == 'csv':
+        with open(path, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(table.dtype.names)
+            writer.writerows(row.tolist() for row in table)
+    elif extension == 'parquet':
+        to_dataframe(table).to_parquet(path, index=False)
+    else:
+        raise ValueError(f"unsupported table format {extension!r}, use npy, csv or parquet")
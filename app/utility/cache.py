@@ -0,0 +1,189 @@
+from collections import OrderedDict, namedtuple
+import hashlib
+import json
+import os
+import threading
+
+import numpy as np
+
+# Bump when a change to the pipeline changes its output, so results cached
+# by an older version are never served again.
+PIPELINE_VERSION = '2'
+
+# One cached enhancement: the metrics (ImageMetrics), the recommended
+# values, the denoised/deblurred array the adjustments started from and
+# the encoded output image.
+CachedResult = namedtuple('CachedResult', ['key', 'metrics', 'recommended', 'restored', 'output'])
+
+# The config sections that change a result: the metric thresholds, how the
+# image is analyzed, what is recommended, denoising and deblurring, and the
+# encoded output. The others (cache, profiling, service, storage, video,
+# interactive, ...) do not, and switching them keeps the cache valid; the
+# processing memory budget only changes how bands are cut, not the result.
+RESULT_SECTIONS = ('saturation', 'brightness', 'contrast', 'sharpness', 'analysis', 'strategy', 'denoise',
+                   'blur_map', 'output')
+
+
+def cache_key(image_bytes, thresholds, **options):
+    """
+        cache_key: content address of one enhancement run.
+
+        Params:
+            - image_bytes: the uploaded (encoded) image
+            - thresholds: thresholds dictionary, of which only the
+            RESULT_SECTIONS are hashed
+            - options: anything else that changes the output, e.g. quality
+
+        returns:
+            - hex sha256 of the image, the config and the pipeline version
+    """
+    config = {name: thresholds.get(name) for name in RESULT_SECTIONS}
+    digest = hashlib.sha256()
+    digest.update(PIPELINE_VERSION.encode())
+    digest.update(json.dumps([config, options], sort_keys=True, default=str).encode())
+    digest.update(hashlib.sha256(image_bytes).digest())
+    return digest.hexdigest()
+
+
+def _entry_size(entry):
+    return entry.restored.nbytes + len(entry.output)
+
+
+class ResultCache:
+    """
+        In-memory LRU cache of CachedResult entries bounded by bytes, with
+        an optional on-disk tier bounded by its own size cap. Safe to share
+        between Streamlit sessions (threads).
+
+        Params:
+            - max_bytes: memory tier capacity
+            - disk_dir: folder of the disk tier, None to disable it
+            - disk_max_bytes: disk tier capacity
+    """
+    def __init__(self, max_bytes=512 * 1024 * 1024, disk_dir=None, disk_max_bytes=1024 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.disk_dir = disk_dir
+        self.disk_max_bytes = disk_max_bytes
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        if disk_dir:
+            os.makedirs(disk_dir, exist_ok=True)
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry
+        entry = self._load(key) if self.disk_dir else None
+        with self._lock:
+            if entry is None:
+                self.misses += 1
+                return None
+            self.disk_hits += 1
+        self._remember(entry)
+        return entry
+
+    def put(self, entry):
+        # cached arrays are shared between reruns, nobody may modify them
+        entry.restored.setflags(write=False)
+        self._remember(entry)
+        if self.disk_dir:
+            self._store(entry)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+            }
+
+    def _remember(self, entry):
+        size = _entry_size(entry)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if entry.key in self._entries:
+                self._bytes -= _entry_size(self._entries.pop(entry.key))
+            self._entries[entry.key] = entry
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= _entry_size(evicted)
+                self.evictions += 1
+
+    # disk tier: <key>.json (metrics, recommended), <key>.npy, <key>.out
+
+    def _paths(self, key):
+        base = os.path.join(self.disk_dir, key)
+        return base + '.json', base + '.npy', base + '.out'
+
+    def _load(self, key):
+        from utility.analysis import metrics_from_dict
+
+        json_path, array_path, output_path = self._paths(key)
+        try:
+            with open(json_path) as f:
+                info = json.load(f)
+            restored = np.load(array_path)
+            with open(output_path, 'rb') as f:
+                output = f.read()
+        except (OSError, ValueError):
+            return None
+        for path in (json_path, array_path, output_path):
+            os.utime(path)
+        # as read-only as the entries put() keeps in memory
+        restored.setflags(write=False)
+        return CachedResult(key, metrics_from_dict(info['metrics']), info['recommended'], restored, output)
+
+    def _store(self, entry):
+        from utility.analysis import metrics_to_dict
+
+        json_path, array_path, output_path = self._paths(entry.key)
+        info = {
+            'metrics': metrics_to_dict(entry.metrics),
+            'recommended': {name: float(value) for name, value in entry.recommended.items()},
+        }
+        # the json is written last, a crash before it leaves no valid entry
+        with open(output_path, 'wb') as f:
+            f.write(entry.output)
+        with open(array_path, 'wb') as f:
+            np.save(f, entry.restored)
+        with open(json_path + '.part', 'w') as f:
+            json.dump(info, f)
+        os.replace(json_path + '.part', json_path)
+        self._trim_disk()
+
+    def _trim_disk(self):
+        files = []
+        for name in os.listdir(self.disk_dir):
+            path = os.path.join(self.disk_dir, name)
+            # other sessions and processes trim the same folder
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, path))
+        total = sum(size for _, size, _ in files)
+        # least recently used first; a hit touches all three files
+        for _, size, path in sorted(files):
+            if total <= self.disk_max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                # another trimmer removed it first, the space is free all the same
+                pass
+            except OSError:
+                continue
+            total -= size
@@ -0,0 +1,83 @@
+import os
+import threading
+
+import yaml
+
+# Metrics that recommend_value / apply_adjustments work on, in the order
+# apply_adjustments expects them.
+METRIC_NAMES = ('saturation', 'brightness', 'contrast', 'sharpness')
+
+# Default thresholds, used when config/thersholds.yaml is missing
+DEFAULT_THRESHOLDS = {
+    'saturation': {'low_threshold': 30, 'high_threshold': 70},
+    'brightness': {'low_threshold': 100, 'high_threshold': 200},
+    'contrast': {'low_threshold': 50, 'high_threshold': 100},
+    'sharpness': {'low_threshold': 2000, 'high_threshold': 4500, 'upper_bound': 9000}
+}
+
+# Parsed configurations by absolute path: (mtime_ns, size, thresholds)
+_loaded = {}
+_loaded_lock = threading.Lock()
+
+
+def validate_thresholds(thresholds, source='configuration'):
+    """
+        validate_thresholds: check the metric sections of a threshold
+                            configuration once, when it is loaded, instead
+                            of failing with a KeyError mid-pipeline.
+
+        Params:
+            - thresholds: parsed yaml
+            - source: name used in the error messages
+
+        returns:
+            - thresholds, unchanged
+    """
+    if not isinstance(thresholds, dict):
+        raise ValueError(f"{source}: expected a mapping of sections, got {type(thresholds).__name__}")
+    for name in METRIC_NAMES:
+        section = thresholds.get(name)
+        if not isinstance(section, dict):
+            raise ValueError(f"{source}: missing '{name}' section")
+        values = {}
+        for key in ('low_threshold', 'high_threshold', 'upper_bound'):
+            value = section.get(key)
+            if value is None and key == 'upper_bound':
+                continue
+            if isinstance(value, bool) or not isinstance(value, (int, float)):
+                raise ValueError(f"{source}: {name}.{key} must be a number, got {value!r}")
+            values[key] = value
+        if values['low_threshold'] > values['high_threshold']:
+            raise ValueError(f"{source}: {name}.low_threshold is above {name}.high_threshold")
+    return thresholds
+
+
+def load_thresholds(file_path):
+    """
+        load_thresholds: load the yaml threshold configuration without
+                        any UI side effects.
+
+        The file is parsed and validated once per process and served from
+        memory until its modification time or size changes, so callers
+        can load it on every request or Streamlit rerun. The returned
+        dictionary is shared: do not modify it.
+
+        Params:
+            - file_path: path of the thersholds.yaml file
+
+        returns:
+            - thresholds dictionary, the defaults if the file is missing
+    """
+    path = os.path.abspath(file_path)
+    try:
+        status = os.stat(path)
+    except FileNotFoundError:
+        return DEFAULT_THRESHOLDS
+    with _loaded_lock:
+        entry = _loaded.get(path)
+        if entry is not None and entry[:2] == (status.st_mtime_ns, status.st_size):
+            return entry[2]
+        with open(path, 'r') as file:
+            thresholds = validate_thresholds(yaml.safe_load(file), path)
+        _loaded[path] = (status.st_mtime_ns, status.st_size, thresholds)
+        return thresholds
@@ -0,0 +1,150 @@
+import cv2
+
+from utility.helper import NLM_H, NLM_HALO, remove_noise
+from utility.profiling import traced
+from utility.tiling import apply_banded, band_rows
+
+# Tier settings used when the yaml has no 'denoise' section. 'legacy' keeps
+# the old rule: full NLM whenever the global std (detect_noise) is above 10.
+DEFAULT_DENOISE = {
+    'mode': 'legacy',
+    'light_threshold': 1.0,
+    'moderate_threshold': 3.0,
+    'heavy_threshold': 6.0,
+    'light_method': 'bilateral',
+    'moderate_method': 'chroma_nlm',
+    'heavy_method': 'nlm'
+}
+
+_CHROMA_HALO = 2 * NLM_HALO + 2
+
+
+def denoise_none(image_np, sigma, memory_budget=None, out=None):
+    """
+        denoise_none: leave the image as it is.
+    """
+    if out is None or out is image_np:
+        return image_np
+    out[...] = image_np
+    return out
+
+
+def denoise_gaussian(image_np, sigma, memory_budget=None, out=None):
+    """
+        denoise_gaussian: 3x3 Gaussian blur, the cheapest tier.
+    """
+    rows = band_rows(image_np.shape[1], 'filter', memory_budget, halo=1)
+    return apply_banded(image_np, lambda band: cv2.GaussianBlur(band, (3, 3), 0), 1, rows, out=out)
+
+
+def denoise_bilateral(image_np, sigma, memory_budget=None, out=None):
+    """
+        denoise_bilateral: edge preserving 5x5 bilateral filter, with the
+                        colour range scaled to the estimated noise.
+    """
+    sigma_color = max(10.0, 3.0 * sigma)
+
+    def bilateral(band):
+        return cv2.bilateralFilter(band, 5, sigma_color, 3)
+
+    rows = band_rows(image_np.shape[1], 'filter', memory_budget, halo=2)
+    return apply_banded(image_np, bilateral, 2, rows, out=out)
+
+
+def denoise_chroma_nlm(image_np, sigma, memory_budget=None, out=None):
+    """
+        denoise_chroma_nlm: non-local means on the two chroma planes only,
+                        at half resolution, then upsampled and recombined
+                        with the luma, which only gets the bilateral filter
+                        of the light tier. Colour blotches are most of the
+                        visible noise at moderate levels, and this is
+                        several times cheaper than full colour NLM.
+    """
+    sigma_color = max(10.0, 3.0 * sigma)
+
+    def chroma_nlm(band):
+        ycrcb = cv2.cvtColor(band, cv2.COLOR_RGB2YCrCb)
+        ycrcb[:, :, 0] = cv2.bilateralFilter(ycrcb[:, :, 0], 5, sigma_color, 3)
+        height, width = band.shape[:2]
+        chroma = cv2.resize(ycrcb[:, :, 1:], (max(1, width // 2), max(1, height // 2)), interpolation=cv2.INTER_AREA)
+        chroma = cv2.fastNlMeansDenoising(chroma, None, h=NLM_H, templateWindowSize=7, searchWindowSize=21)
+        ycrcb[:, :, 1:] = cv2.resize(chroma, (width, height), interpolation=cv2.INTER_LINEAR)
+        return cv2.cvtColor(ycrcb, cv2.COLOR_YCrCb2RGB)
+
+    # even band starts keep the 2x2 downscale grid aligned across bands
+    rows = band_rows(image_np.shape[1], 'denoise', memory_budget, halo=_CHROMA_HALO)
+    return apply_banded(image_np, chroma_nlm, _CHROMA_HALO, rows + rows % 2, out=out)
+
+
+def denoise_nlm(image_np, sigma, memory_budget=None, out=None):
+    """
+        denoise_nlm: full colour non-local means, same as remove_noise.
+    """
+    return remove_noise(image_np, memory_budget, out=out)
+
+
+# Denoisers selectable in the 'denoise' section of the thresholds yaml.
+# Every denoiser takes (image_np, sigma, memory_budget, out).
+DENOISERS = {
+    'none': denoise_none,
+    'gaussian': denoise_gaussian,
+    'bilateral': denoise_bilateral,
+    'chroma_nlm': denoise_chroma_nlm,
+    'nlm': denoise_nlm,
+}
+
+
+def denoise_settings(thresholds):
+    """
+        denoise_settings: the 'denoise' section of the thresholds with
+                        defaults filled in and the methods checked.
+    """
+    settings = dict(DEFAULT_DENOISE)
+    settings.update(thresholds.get('denoise') or {})
+    if settings['mode'] not in ('legacy', 'tiered'):
+        raise ValueError(f"denoise mode must be 'legacy' or 'tiered', not {settings['mode']!r}")
+    for tier in ('light', 'moderate', 'heavy'):
+        if settings[f'{tier}_method'] not in DENOISERS:
+            raise ValueError(f"unknown {tier}_method {settings[tier + '_method']!r}, "
+                             f"choose from {', '.join(sorted(DENOISERS))}")
+    return settings
+
+
+def select_denoiser(noise_sigma, settings):
+    """
+        select_denoiser: pick the tier for an estimated noise level.
+
+        Params:
+            - noise_sigma: ImageMetrics.noise_sigma of the image
+            - settings: denoise_settings of the thresholds
+
+        returns:
+            - name of the denoiser in DENOISERS
+    """
+    if noise_sigma < settings['light_threshold']:
+        return 'none'
+    if noise_sigma < settings['moderate_threshold']:
+        return settings['light_method']
+    if noise_sigma < settings['heavy_threshold']:
+        return settings['moderate_method']
+    return settings['heavy_method']
+
+
+@traced()
+def denoise(image_np, noise_sigma, settings, memory_budget=None, out=None):
+    """
+        denoise: run the denoiser the tier settings choose for the noise
+                level.
+
+        Params:
+            - image_np: RGB numpy array
+            - noise_sigma: estimated noise (ImageMetrics.noise_sigma)
+            - settings: denoise_settings of the thresholds
+            - memory_budget: working memory in bytes
+            - out: output array, pass image_np to denoise in place
+
+        returns:
+            - the denoised array and the name of the denoiser used
+    """
+    method = select_denoiser(noise_sigma, settings)
+    return DENOISERS[method](image_np, noise_sigma, memory_budget, out=out), method
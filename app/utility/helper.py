@@ -1,7 +1,12 @@
-from PIL import Image, ImageEnhance
 import numpy as np
 import cv2
 
+from utility.analysis import analyze_image
+from utility.adjustments import apply_adjustments_fused
+from utility.profiling import traced
+from utility.tiling import apply_banded, band_rows
+
+@traced()
 def get_image_metrics(image):
     """
         get_image_metrics: Extract the brightness, saturation, contrast
@@ -13,28 +18,14 @@ def get_image_metrics(image):
         returns:
             - average saturation, average brightness, average contrast and
             average sharpness value.
+
+        Use analyze_image when blur and noise are needed as well, it
+        returns all of them from the same pass.
     """
-    image_np = np.array(image)
-    image_hsv = cv2.cvtColor(image_np, cv2.COLOR_RGB2HSV)
-    hsv_saturation = image_hsv[:, :, 1]
-    hsv_brightness = image_hsv[:, :, 2]
-    avg_saturation = np.mean(hsv_saturation)
-    avg_brightness = np.mean(hsv_brightness)
-    image_gray = cv2.cvtColor(image_np, cv2.COLOR_RGB2GRAY)
-    contrast = np.std(image_gray)
-
-    def compute_sharpness(img):
-        """
-            compute sharpness of the image
-        """
-        laplacian = cv2.Laplacian(img, cv2.CV_64F)
-        sharpness = np.var(laplacian)
-        return sharpness
-    
-    sharpness = compute_sharpness(image_np)
-    
-    return avg_saturation, avg_brightness, contrast, sharpness
+    metrics = analyze_image(image)
+    return metrics.saturation, metrics.brightness, metrics.contrast, metrics.sharpness
 
+@traced()
 def detect_noise(image_np):
     """
         detect_noise: detect the image contains
@@ -49,6 +40,7 @@ def detect_noise(image_np):
     noise_level = np.std(image_np)
     return noise_level
 
+@traced()
 def detect_blur(image_np):
     """
         detect_blur: detect the image contains
@@ -64,16 +56,115 @@ def detect_blur(image_np):
     variance = laplacian.var()
     return variance
 
-def remove_noise(image_np):
-    # remove noise from the image
-    return cv2.fastNlMeansDenoisingColored(image_np, None, h=10, hColor=10, templateWindowSize=7, searchWindowSize=21)
+# fastNlMeansDenoisingColored parameters of remove_noise
+NLM_H = 10
+NLM_TEMPLATE_WINDOW = 7
+NLM_SEARCH_WINDOW = 21
+# an output pixel depends on pixels up to this many rows away
+NLM_HALO = NLM_TEMPLATE_WINDOW // 2 + NLM_SEARCH_WINDOW // 2
+
+@traced()
+def remove_noise(image_np, memory_budget=None, out=None):
+    """
+        remove_noise: remove noise from the image with non-local means,
+                    band by band within the memory budget. The bands carry
+                    NLM_HALO rows of context so the result is identical to
+                    denoising the full frame.
+
+        Params:
+            - image_np: Numpy array of the image
+            - memory_budget: working memory in bytes (tiling.MEMORY_BUDGET
+            when None)
+            - out: output array, pass image_np to denoise in place
+
+        return:
+            - denoised image
+    """
+    def denoise(band):
+        return cv2.fastNlMeansDenoisingColored(band, None, h=NLM_H, hColor=NLM_H,
+                                               templateWindowSize=NLM_TEMPLATE_WINDOW,
+                                               searchWindowSize=NLM_SEARCH_WINDOW)
+
+    rows = band_rows(image_np.shape[1], 'denoise', memory_budget, halo=NLM_HALO)
+    return apply_banded(image_np, denoise, NLM_HALO, rows, out=out)
+
+@traced()
+def remove_blur(image_np, memory_budget=None, out=None):
+    """
+        remove_blur: remove blur from the image with a 3x3 kernel, band by
+                    band within the memory budget (same result as one
+                    filter2D call on the full frame).
+
+        Params:
+            - image_np: Numpy array of the image
+            - memory_budget: working memory in bytes
+            - out: output array, pass image_np to filter in place
 
-def remove_blur(image_np):
-    # remove blur from the image
+        return:
+            - deblurred image
+    """
     kernel = np.array([[0, -1, 0], [-1, 4, -1], [0, -1, 0]])
-    return cv2.filter2D(image_np, -1, kernel)
+    rows = band_rows(image_np.shape[1], 'filter', memory_budget, halo=1)
+    return apply_banded(image_np, lambda band: cv2.filter2D(band, -1, kernel), 1, rows, out=out)
+
+@traced()
+def remove_blur_regions(image_np, blurry, tile_size, out=None):
+    """
+        remove_blur_regions: remove_blur restricted to the blurry tiles of
+                    a blur map; every other pixel is left as it is.
+
+        Runs of neighbouring blurry tiles in a tile row are filtered as one
+        block with a one pixel halo, so inside the blurry tiles the result
+        is identical to remove_blur on the full frame, and the work is
+        proportional to the blurry area.
 
-def apply_adjustments(image, saturation_value, brightness_value, contrast_value, sharpness_value):
+        Params:
+            - image_np: Numpy array of the image
+            - blurry: boolean array (tile rows, tile cols), BlurMap.blurry
+            - tile_size: tile side in pixels, BlurMap.tile_size
+            - out: output array, pass image_np to filter in place
+
+        return:
+            - image with the blurry tiles deblurred
+    """
+    kernel = np.array([[0, -1, 0], [-1, 4, -1], [0, -1, 0]])
+    height, width = image_np.shape[:2]
+    if out is None:
+        out = image_np.copy()
+    elif out is not image_np:
+        out[...] = image_np
+    # the row above the current tile row as it was before filtering, the
+    # image holds filtered values there when working in place
+    above = None
+    for tile_row in range(min(blurry.shape[0], -(-height // tile_size))):
+        top = tile_row * tile_size
+        bottom = min(height, top + tile_size)
+        next_row = image_np[bottom - 1].copy() if bottom < height else None
+        flags = np.append(blurry[tile_row], False)
+        column = 0
+        while column < len(flags) - 1:
+            if not flags[column]:
+                column += 1
+                continue
+            run_end = column
+            while flags[run_end + 1]:
+                run_end += 1
+            left, right = column * tile_size, min(width, (run_end + 1) * tile_size)
+            column = run_end + 1
+            if left >= width:
+                break
+            halo_left, halo_right = max(0, left - 1), min(width, right + 1)
+            block = image_np[max(0, top - 1):min(height, bottom + 1), halo_left:halo_right]
+            if top > 0:
+                block = np.concatenate([above[None, halo_left:halo_right], block[1:]])
+            filtered = cv2.filter2D(block, -1, kernel)
+            offset = 1 if top > 0 else 0
+            out[top:bottom, left:right] = filtered[offset:offset + bottom - top, left - halo_left:right - halo_left]
+        above = next_row
+    return out
+
+@traced()
+def apply_adjustments(image, saturation_value, brightness_value, contrast_value, sharpness_value, memory_budget=None):
     """
         apply_adjustments: it will apply the enhancements to the image.
 
@@ -83,39 +174,20 @@ def apply_adjustments(image, saturation_value, brightness_value, contrast_value,
             - brightness_value: recommended value
             - contrast_value: recommended value
             - sharpness_value: recommended value
+            - memory_budget: working memory in bytes
 
         returns:
             - return the enhanced image
-    """
-    enhancer = ImageEnhance.Color(image)
-    saturation_factor = 1.0 + (saturation_value - 5) * 0.2
-    saturation_factor = max(1.0, min(2.0, saturation_factor))
-    image = enhancer.enhance(saturation_factor)
 
-    enhancer = ImageEnhance.Brightness(image)
-    brightness_factor = 1.0 + (brightness_value - 5) * 0.2
-    brightness_factor = max(1.0, min(2.0, brightness_factor))
-    image = enhancer.enhance(brightness_factor)
-    
-    enhancer = ImageEnhance.Contrast(image)
-    contrast_factor = 1.0 + (contrast_value - 5) * 0.2
-    contrast_factor = max(1.0, min(2.0, contrast_factor))
-    image = enhancer.enhance(contrast_factor)
-    
-    image_np = np.array(image)
-    
-    def apply_sharpness(img, alpha):
-        # apply the sharpness to the image
-        alpha = max(0.0, min(2.0, alpha))
-        kernel = np.array([[-1, -1, -1], [-1, 9 + alpha, -1], [-1, -1, -1]])
-        return cv2.filter2D(img, -1, kernel)
-
-    image_np = apply_sharpness(image_np, (sharpness_value - 5) * 0.2)
-    image = Image.fromarray(image_np)
-
-    return image
+        Runs the fused engine in utility.adjustments, which gives the same
+        result as the Color -> Brightness -> Contrast -> sharpen chain
+        with far fewer full-size copies.
+    """
+    return apply_adjustments_fused(image, saturation_value, brightness_value, contrast_value, sharpness_value,
+                                   memory_budget=memory_budget)
 
-def recommend_value(current_value, low_threshold, high_threshold):
+@traced()
+def recommend_value(current_value, low_threshold, high_threshold, upper_bound=255):
     """
         recommend_value: it will recommend the values for the metrics.
 
@@ -123,6 +195,9 @@ def recommend_value(current_value, low_threshold, high_threshold):
             - cuurent_value: current particular metric value
             - low_thershold: min value of the metric
             - high_thershold: max value of the metric
+            - upper_bound: largest value the metric takes in practice,
+            where the recommendation reaches 0 (255 suits the 8-bit
+            metrics, sharpness needs its own, see calibrate_thresholds.py)
 
         returns:
             - recommended enhanced value for the particualr metric.
@@ -130,7 +205,9 @@ def recommend_value(current_value, low_threshold, high_threshold):
     if current_value < low_threshold:
         return min(10, (current_value / low_threshold) * 10)
     elif current_value > high_threshold:
-        return max(0, 10 - ((current_value - high_threshold) / (255 - high_threshold)) * 10)
+        if upper_bound <= high_threshold:
+            return 0
+        return max(0, 10 - ((current_value - high_threshold) / (upper_bound - high_threshold)) * 10)
     else:
         return 5
     
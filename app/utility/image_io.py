@@ -0,0 +1,167 @@
+import io
+import math
+
+from PIL import Image
+import numpy as np
+
+from utility.tiling import band_rows
+
+# Pillow's default JPEG quality, what the app has always saved with
+JPEG_QUALITY = 75
+
+# Output settings used when the yaml has no 'output' section
+DEFAULT_OUTPUT = {
+    'quality': JPEG_QUALITY,
+    'progressive': False,
+    'optimize': False,
+    'preserve_metadata': True,
+    'max_pixels': None
+}
+
+# Metadata copied from the upload to the output. A JPEG APP1 segment holds
+# at most 65533 bytes of EXIF, longer blocks are dropped.
+METADATA_KEYS = ('exif', 'icc_profile')
+_MAX_EXIF_BYTES = 65533
+
+
+def output_settings(thresholds, quality=None):
+    """
+        output_settings: the 'output' section of the thresholds with
+                        defaults filled in; quality, when given, wins.
+    """
+    settings = dict(DEFAULT_OUTPUT)
+    settings.update(thresholds.get('output') or {})
+    if quality is not None:
+        settings['quality'] = quality
+    return settings
+
+
+def decode(source, max_pixels=None):
+    """
+        decode: open an image as RGB, keeping its EXIF and ICC profile.
+
+        When max_pixels is given and the image is larger, it is shrunk to
+        fit; JPEGs are then decoded at 1/2, 1/4 or 1/8 scale by libjpeg
+        (draft mode) before the final resample, which skips most of the
+        decode work and never holds the full size frame.
+
+        Params:
+            - source: encoded bytes, file path or file object
+            - max_pixels: pixel budget of the decoded image, None for the
+            full size
+
+        returns:
+            - RGB PIL image and a metadata dictionary (METADATA_KEYS found
+            in the file) for encode
+    """
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        source = io.BytesIO(source)
+    image = Image.open(source)
+    metadata = _metadata(image)
+    width, height = image.size
+    if max_pixels and width * height > max_pixels:
+        shrink = math.sqrt(width * height / max_pixels)
+        # thumbnail uses draft mode for JPEGs, then resamples the rest
+        image.thumbnail((max(1, int(width / shrink)), max(1, int(height / shrink))))
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+    image.load()
+    return image, metadata
+
+
+def _metadata(image):
+    return {key: image.info[key] for key in METADATA_KEYS if image.info.get(key)}
+
+
+def read_metadata(source):
+    """
+        read_metadata: the metadata dictionary decode gives, from the image
+                    header without decoding the pixels.
+    """
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        source = io.BytesIO(source)
+    with Image.open(source) as image:
+        return _metadata(image)
+
+
+def decoded_pixels(source, max_pixels=None):
+    """
+        decoded_pixels: number of pixels decode(source, max_pixels) gives,
+                        from the image header alone.
+    """
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        source = io.BytesIO(source)
+    with Image.open(source) as image:
+        width, height = image.size
+    if max_pixels:
+        return min(width * height, max_pixels)
+    return width * height
+
+
+def to_array(image, memory_budget=None):
+    """
+        to_array: writable RGB array of a PIL image with a single full size
+                copy.
+
+        np.array(image) goes through Image.tobytes, which collects the
+        whole frame in chunks, joins them and is then copied into the
+        array: three frames at the peak. Converting band by band writes
+        straight into the preallocated array.
+
+        Params:
+            - image: RGB PIL image
+            - memory_budget: working memory in bytes, sets the band height
+
+        returns:
+            - (H, W, 3) uint8 array
+    """
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+    width, height = image.size
+    image_np = np.empty((height, width, 3), dtype=np.uint8)
+    rows = band_rows(width, 'filter', memory_budget)
+    for top in range(0, height, rows):
+        bottom = min(height, top + rows)
+        image_np[top:bottom] = np.asarray(image.crop((0, top, width, bottom)))
+    return image_np
+
+
+def encode(image, fp=None, settings=None, metadata=None):
+    """
+        encode: write the image as JPEG straight into a stream or file.
+
+        Params:
+            - image: PIL image
+            - fp: file path or writable file object (a response or file
+            stream), None to return the encoded bytes
+            - settings: output_settings (quality, progressive, optimize,
+            preserve_metadata)
+            - metadata: metadata dictionary from decode, written to the
+            output when preserve_metadata is on
+
+        returns:
+            - the JPEG bytes when fp is None, otherwise None
+
+        Writing to fp is the copy-free path. With fp None the JPEG is built
+        in a BytesIO whose buffer getvalue() hands over (trimmed, not
+        duplicated); the callers that take bytes need an object of their
+        own: cache entries, results pickled back from pool workers, storage
+        uploads and the Streamlit download button.
+    """
+    settings = dict(DEFAULT_OUTPUT, **(settings or {}))
+    options = {
+        'quality': settings['quality'],
+        'progressive': settings['progressive'],
+        'optimize': settings['optimize'],
+    }
+    if settings['preserve_metadata'] and metadata:
+        options.update({key: value for key, value in metadata.items()
+                        if key != 'exif' or len(value) <= _MAX_EXIF_BYTES})
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+    if fp is not None:
+        image.save(fp, format='JPEG', **options)
+        return None
+    buffer = io.BytesIO()
+    image.save(buffer, format='JPEG', **options)
+    return buffer.getvalue()
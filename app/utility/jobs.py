@@ -0,0 +1,93 @@
+import concurrent.futures
+import os
+import threading
+import time
+
+
+class Job:
+    """
+        One background pipeline run: its future, plus the stage it is in and
+        the share done, which the worker thread updates through progress
+        (the progress callback of enhance_bytes).
+
+        Params:
+            - preview: anything to show while the job runs (the preview JPEG)
+    """
+    def __init__(self, preview=None):
+        self.preview = preview
+        self.fraction = 0.0
+        self.stage = 'queued'
+        self.future = None
+        # time.monotonic() when the future finished
+        self.finished = None
+
+    def progress(self, fraction, name):
+        self.fraction = fraction
+        self.stage = name
+
+    def done(self):
+        return self.future.done()
+
+    def result(self):
+        return self.future.result()
+
+
+class JobRunner:
+    """
+        Runs pipeline jobs on a small thread pool, at most one per key, so
+        that a Streamlit rerun (any widget interaction) during a job finds
+        the running job instead of starting the same work again. Safe to
+        share between sessions. Finished jobs nobody popped (the session
+        was closed while its job ran) are forgotten keep_seconds later.
+
+        Params:
+            - workers: jobs that run at the same time, later ones queue;
+            None for one per core
+            - keep_seconds: how long a finished job stays known
+    """
+    def __init__(self, workers=1, keep_seconds=60.0):
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers or os.cpu_count() or 1,
+                                                               thread_name_prefix='pipeline-job')
+        self.keep_seconds = keep_seconds
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            self._forget_finished()
+            return self._jobs.get(key)
+
+    def submit(self, key, function, /, *args, preview=None, **kwargs):
+        """
+            submit: run function(*args, progress=job.progress, **kwargs) in
+                    the background, unless a job for key is already known.
+
+            returns:
+                - the Job of key
+        """
+        with self._lock:
+            self._forget_finished()
+            job = self._jobs.get(key)
+            if job is None:
+                job = Job(preview)
+                job.future = self._executor.submit(function, *args, progress=job.progress, **kwargs)
+                job.future.add_done_callback(lambda _: setattr(job, 'finished', time.monotonic()))
+                self._jobs[key] = job
+            return job
+
+    def pop(self, key):
+        # forget a finished job; its result lives on in the result cache
+        with self._lock:
+            return self._jobs.pop(key, None)
+
+    def __len__(self):
+        with self._lock:
+            self._forget_finished()
+            return len(self._jobs)
+
+    def _forget_finished(self):
+        # called with the lock held
+        deadline = time.monotonic() - self.keep_seconds
+        for key in [key for key, job in self._jobs.items()
+                    if job.finished is not None and job.finished < deadline]:
+            del self._jobs[key]
@@ -0,0 +1,334 @@
+import io
+import math
+
+from utility.analysis import (SHARPNESS_EXPONENT, analyze_proxy, blur_map, open_analysis_proxy,
+                              renormalize_metrics)
+from utility.cache import CachedResult, ResultCache, cache_key
+from utility.config import METRIC_NAMES
+from utility.denoise import denoise, denoise_settings
+from utility.tiling import MEMORY_BUDGET
+from utility.helper import analyze_image, remove_blur, remove_blur_regions, remove_noise, apply_adjustments
+from utility.image_io import decode, decoded_pixels, encode, output_settings, to_array
+from utility.profiling import stage, traced
+from utility.strategies import STRATEGIES, strategy_parts, strategy_settings
+
+# Analysis settings used when the yaml has no 'analysis' section: full
+# resolution analysis, exactly as before proxies existed
+DEFAULT_ANALYSIS = {
+    'mode': 'full',
+    'proxy_max_pixels': 2000000,
+    'sharpness_exponent': SHARPNESS_EXPONENT
+}
+
+# Working memory budget used when the yaml has no 'processing' section
+DEFAULT_MEMORY_BUDGET_MB = MEMORY_BUDGET // (1024 * 1024)
+
+# Denoise when the noise level is above this value, deblur when the
+# blur level is below this value (same limits as app/main.py)
+NOISE_THRESHOLD = 10
+BLUR_THRESHOLD = 100
+
+# Blur map settings used when the yaml has no 'blur_map' section: one
+# global blur level, deblurring the whole frame or nothing, as before
+DEFAULT_BLUR_MAP = {
+    'mode': 'global',
+    'tile_size': 64,
+    'threshold': BLUR_THRESHOLD,
+    'min_contrast': 8.0
+}
+
+# Preview settings used when the yaml has no 'preview' section: the UI
+# first shows the upload enhanced at max_pixels, without denoising and
+# deblurring, then the full resolution result. The preview is analyzed at
+# analysis_max_pixels, like an analysis proxy, and the full resolution run
+# reuses that analysis.
+DEFAULT_PREVIEW = {
+    'enabled': True,
+    'max_pixels': 250000,
+    'analysis_max_pixels': 2000000,
+    'workers': 1
+}
+
+# Share of a full resolution run done when each stage starts, for the
+# progress callback of enhance_bytes; denoising and deblurring take most
+# of the time
+PROGRESS_STAGES = {
+    'decode': 0.0,
+    'analysis': 0.1,
+    'restore': 0.2,
+    'adjustments': 0.75,
+    'encode': 0.9
+}
+
+
+def analysis_settings(thresholds):
+    """
+        analysis_settings: the 'analysis' section of the thresholds with
+                        defaults filled in.
+    """
+    settings = dict(DEFAULT_ANALYSIS)
+    settings.update(thresholds.get('analysis') or {})
+    if settings['mode'] not in ('full', 'proxy'):
+        raise ValueError(f"analysis mode must be 'full' or 'proxy', not {settings['mode']!r}")
+    return settings
+
+
+def blur_map_settings(thresholds):
+    """
+        blur_map_settings: the 'blur_map' section of the thresholds with
+                        defaults filled in.
+    """
+    settings = dict(DEFAULT_BLUR_MAP)
+    settings.update(thresholds.get('blur_map') or {})
+    if settings['mode'] not in ('global', 'map'):
+        raise ValueError(f"blur_map mode must be 'global' or 'map', not {settings['mode']!r}")
+    return settings
+
+
+def preview_settings(thresholds):
+    """
+        preview_settings: the 'preview' section of the thresholds with
+                        defaults filled in.
+    """
+    settings = dict(DEFAULT_PREVIEW)
+    settings.update(thresholds.get('preview') or {})
+    return settings
+
+
+def memory_budget(thresholds):
+    # working memory budget in bytes from the 'processing' section
+    processing = thresholds.get('processing') or {}
+    return int(processing.get('memory_budget_mb', DEFAULT_MEMORY_BUDGET_MB) * 1024 * 1024)
+
+
+@traced()
+def analyze(image, thresholds, scale=1.0):
+    """
+        analyze: compute the ImageMetrics of the image at the resolution
+                the thresholds' analysis section asks for.
+
+        Params:
+            - image: PIL image or RGB numpy array
+            - thresholds: thresholds dictionary from load_thresholds
+            - scale: linear factor between the full resolution image and
+            image, when image is already downscaled (a preview); the
+            metrics are renormalized like those of an analysis proxy
+
+        returns:
+            - ImageMetrics on the full resolution scale, with a blur map in
+            the 'map' mode of the blur_map section; with restore off in the
+            strategy section, only the metrics of the strategy's statistics
+            (the others nan) and no blur map
+    """
+    settings = analysis_settings(thresholds)
+    budget = memory_budget(thresholds)
+    # the statistics of the strategy, and of restore when it runs
+    parts = strategy_parts(thresholds)
+    max_pixels = settings['proxy_max_pixels'] if settings['mode'] == 'proxy' else None
+    if max_pixels:
+        metrics = analyze_proxy(image, max_pixels, settings['sharpness_exponent'], parts)
+    else:
+        metrics = analyze_image(image, budget, parts)
+    metrics = renormalize_metrics(metrics, scale, settings['sharpness_exponent'])
+    map_settings = blur_map_settings(thresholds)
+    if map_settings['mode'] == 'map' and strategy_settings(thresholds)['restore']:
+        metrics = metrics._replace(blur_map=blur_map(image, map_settings['tile_size'], map_settings['threshold'],
+                                                     map_settings['min_contrast'], max_pixels,
+                                                     settings['sharpness_exponent'], budget, scale))
+    return metrics
+
+
+@traced()
+def restore(image_np, analysis, thresholds):
+    """
+        restore: denoise and deblur the image in place when the analysis
+                says it needs it. The 'denoise' section of the thresholds
+                picks the denoiser: in 'tiered' mode a tier chosen from the
+                estimated noise_sigma, in 'legacy' mode full NLM whenever
+                the global std is above NOISE_THRESHOLD. Deblurring
+                covers the blurry tiles of the blur map when the analysis
+                has one, otherwise the whole frame when the global blur is
+                below BLUR_THRESHOLD. Nothing is done when the strategy
+                section turns restore off (the fast path).
+
+        Params:
+            - image_np: RGB numpy array, modified in place
+            - analysis: ImageMetrics of the image
+            - thresholds: thresholds dictionary from load_thresholds
+
+        returns:
+            - image_np
+    """
+    if not strategy_settings(thresholds)['restore']:
+        return image_np
+    budget = memory_budget(thresholds)
+    settings = denoise_settings(thresholds)
+    if settings['mode'] == 'tiered':
+        denoise(image_np, analysis.noise_sigma, settings, budget, out=image_np)
+    elif analysis.noise > NOISE_THRESHOLD:
+        remove_noise(image_np, budget, out=image_np)
+    if analysis.blur_map is not None:
+        remove_blur_regions(image_np, analysis.blur_map.blurry, analysis.blur_map.tile_size, out=image_np)
+    elif analysis.blur < BLUR_THRESHOLD:
+        remove_blur(image_np, budget, out=image_np)
+    return image_np
+
+
+@traced()
+def recommend(analysis, thresholds):
+    """
+        recommend: recommended value of every adjustment metric, from the
+                strategy the 'strategy' section names (utility.strategies).
+
+        returns:
+            - dictionary keyed by METRIC_NAMES
+    """
+    return STRATEGIES[strategy_settings(thresholds)['name']].recommend(analysis, thresholds)
+
+
+def enhance_image(image, thresholds):
+    """
+        enhance_image: run the full enhancement pipeline on one image, the
+                    same steps app/main.py runs for an upload.
+
+        Params:
+            - image: PIL image
+            - thresholds: thresholds dictionary from load_thresholds
+
+        returns:
+            - the enhanced PIL image and a report dictionary with the
+            current metrics, recommended values, noise and blur level
+    """
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+    budget = memory_budget(thresholds)
+    analysis = analyze(image, thresholds)
+
+    restored = restore(to_array(image, budget), analysis, thresholds)
+    recommended = recommend(analysis, thresholds)
+    adjusted_image = apply_adjustments(restored, *(recommended[name] for name in METRIC_NAMES), memory_budget=budget)
+
+    report = {
+        'metrics': {name: getattr(analysis, name) for name in METRIC_NAMES},
+        'recommended': recommended,
+        'noise_level': analysis.noise,
+        'blur_level': analysis.blur
+    }
+    return adjusted_image, report
+
+
+def result_cache_from_config(thresholds):
+    """
+        result_cache_from_config: build the ResultCache described by the
+                        'cache' section of the thresholds.
+    """
+    settings = thresholds.get('cache') or {}
+    return ResultCache(max_bytes=int(settings.get('memory_max_mb', 512) * 1024 * 1024),
+                       disk_dir=settings.get('disk_dir'),
+                       disk_max_bytes=int(settings.get('disk_max_mb', 1024) * 1024 * 1024))
+
+
+def _no_progress(fraction, name):
+    pass
+
+
+@traced()
+def preview_bytes(image_bytes, thresholds, quality=None):
+    """
+        preview_bytes: fast low resolution preview of an encoded upload.
+                    The image is decoded straight to an analysis proxy of
+                    the preview section's analysis_max_pixels (JPEGs at
+                    1/2, 1/4 or 1/8 scale) and analyzed like one; a
+                    max_pixels copy of it is adjusted with the recommended
+                    values.
+                    Denoising and deblurring are left to the full
+                    resolution run, which reuses the analysis (see
+                    enhance_bytes).
+
+        Params:
+            - image_bytes: encoded image (the uploaded file content)
+            - thresholds: thresholds dictionary from load_thresholds
+            - quality: JPEG quality of the preview, the 'output' section's
+            when None
+
+        returns:
+            - ImageMetrics on the full resolution scale, the recommended
+            values and the preview JPEG bytes
+    """
+    settings = output_settings(thresholds, quality)
+    preview = preview_settings(thresholds)
+    image, scale = open_analysis_proxy(io.BytesIO(image_bytes), preview['analysis_max_pixels'])
+    if settings['max_pixels']:
+        # the full resolution run decodes to the output's pixel budget
+        scale *= math.sqrt(decoded_pixels(image_bytes, settings['max_pixels']) / decoded_pixels(image_bytes))
+    analysis = analyze(image, thresholds, scale)
+    recommended = recommend(analysis, thresholds)
+    shrink = math.sqrt(image.width * image.height / preview['max_pixels'])
+    if shrink > 1:
+        image = image.resize((max(1, int(image.width / shrink)), max(1, int(image.height / shrink))),
+                             reducing_gap=2.0)
+    adjusted_image = apply_adjustments(to_array(image), *(recommended[name] for name in METRIC_NAMES))
+    return analysis, recommended, encode(adjusted_image, settings=dict(settings, optimize=False))
+
+
+def enhance_bytes(image_bytes, thresholds, cache=None, quality=None, analysis=None, recommended=None, key=None,
+                  progress=None):
+    """
+        enhance_bytes: enhance an encoded upload, served from the cache when
+                    the same bytes were enhanced with the same config before.
+
+        Params:
+            - image_bytes: encoded image (the uploaded file content)
+            - thresholds: thresholds dictionary from load_thresholds
+            - cache: ResultCache or None
+            - quality: JPEG quality of the encoded output, the 'output'
+            section's when None
+            - analysis: ImageMetrics to reuse (from preview_bytes), the
+            image is analyzed when None
+            - recommended: recommended values to reuse, computed from the
+            analysis when None
+            - key: cache key of the result, cache_key(image_bytes,
+            thresholds, quality=...) when None. Results of a reused
+            analysis need a key of their own.
+            - progress: called with the share done and the stage name as
+            each stage starts (see PROGRESS_STAGES), and (1.0, 'done')
+
+        returns:
+            - CachedResult with the metrics, recommended values, the
+            restored (denoised/deblurred) array and the JPEG output bytes
+    """
+    settings = output_settings(thresholds, quality)
+    if key is None:
+        key = cache_key(image_bytes, thresholds, quality=settings['quality'])
+    if cache is not None:
+        entry = cache.get(key)
+        if entry is not None:
+            return entry
+    if progress is None:
+        progress = _no_progress
+
+    budget = memory_budget(thresholds)
+    progress(PROGRESS_STAGES['decode'], 'decode')
+    with stage('decode'):
+        image, metadata = decode(image_bytes, settings['max_pixels'])
+        image_np = to_array(image, budget)
+    if analysis is None:
+        progress(PROGRESS_STAGES['analysis'], 'analysis')
+        analysis = analyze(image, thresholds)
+    del image
+    progress(PROGRESS_STAGES['restore'], 'restore')
+    restored = restore(image_np, analysis, thresholds)
+    if recommended is None:
+        recommended = recommend(analysis, thresholds)
+    progress(PROGRESS_STAGES['adjustments'], 'adjustments')
+    adjusted_image = apply_adjustments(restored, *(recommended[name] for name in METRIC_NAMES),
+                                       memory_budget=budget)
+    progress(PROGRESS_STAGES['encode'], 'encode')
+    with stage('encode', adjusted_image.width * adjusted_image.height / 1e6):
+        output = encode(adjusted_image, settings=settings, metadata=metadata)
+
+    entry = CachedResult(key, analysis, recommended, restored, output)
+    if cache is not None:
+        cache.put(entry)
+    progress(1.0, 'done')
+    return entry
@@ -0,0 +1,307 @@
+from collections import namedtuple
+import contextlib
+import contextvars
+import cProfile
+import functools
+import os
+import random
+import threading
+import time
+import tracemalloc
+
+import numpy as np
+
+# One timed stage of a request. depth is the nesting level (0 for stages
+# called directly by the request), cpu is process CPU time so it includes
+# OpenCV's worker threads, bytes_allocated is the traced peak above the
+# allocations live when the stage started (None unless allocations are
+# tracked).
+StageRecord = namedtuple('StageRecord', ['name', 'depth', 'wall', 'cpu', 'megapixels', 'bytes_allocated'])
+
+# Profiling settings used when the yaml has no 'profiling' section
+DEFAULT_PROFILING = {
+    'enabled': False,
+    'track_allocations': False,
+    'profile_sample_rate': 0.0,
+    'profile_dir': None,
+    'prometheus_file': None
+}
+
+# Upper bounds (seconds) of the wall time histogram buckets
+WALL_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+_current_tracer = contextvars.ContextVar('tracer', default=None)
+_NO_STAGE = contextlib.nullcontext()
+
+# tracemalloc is process-wide and stages reset its peak, so one tracer at a
+# time tracks allocations: the owner
+_allocation_lock = threading.Lock()
+_allocation_owner = None
+
+
+def megapixels_of(image):
+    # size of a PIL image or numpy array, None for anything else
+    if isinstance(image, np.ndarray):
+        return image.shape[0] * image.shape[1] / 1e6 if image.ndim >= 2 else None
+    if hasattr(image, 'width') and hasattr(image, 'height'):
+        return image.width * image.height / 1e6
+    return None
+
+
+class MetricsRegistry:
+    """
+        Totals per stage name across requests, rendered in the Prometheus
+        text exposition format. Safe to share between threads.
+    """
+    def __init__(self, buckets=WALL_BUCKETS):
+        self.buckets = buckets
+        self._stages = {}
+        self._lock = threading.Lock()
+
+    def observe(self, record):
+        with self._lock:
+            totals = self._stages.get(record.name)
+            if totals is None:
+                totals = self._stages[record.name] = {
+                    'count': 0, 'wall': 0.0, 'cpu': 0.0, 'megapixels': 0.0, 'bytes': 0,
+                    'buckets': [0] * len(self.buckets)
+                }
+            totals['count'] += 1
+            totals['wall'] += record.wall
+            totals['cpu'] += record.cpu
+            totals['megapixels'] += record.megapixels or 0.0
+            totals['bytes'] += record.bytes_allocated or 0
+            for index, bound in enumerate(self.buckets):
+                if record.wall <= bound:
+                    totals['buckets'][index] += 1
+
+    def snapshot(self):
+        with self._lock:
+            return {name: dict(totals, buckets=list(totals['buckets'])) for name, totals in self._stages.items()}
+
+    def prometheus_text(self, prefix='enhancement_stage'):
+        """
+            prometheus_text: every stage as a wall time histogram plus CPU
+                            seconds, megapixels and allocated bytes counters.
+        """
+        stages = sorted(self.snapshot().items())
+        lines = [f'# HELP {prefix}_seconds Wall time of each pipeline stage.',
+                 f'# TYPE {prefix}_seconds histogram']
+        for name, totals in stages:
+            for bound, count in zip(self.buckets, totals['buckets']):
+                lines.append(f'{prefix}_seconds_bucket{{stage="{name}",le="{bound}"}} {count}')
+            lines.append(f'{prefix}_seconds_bucket{{stage="{name}",le="+Inf"}} {totals["count"]}')
+            lines.append(f'{prefix}_seconds_sum{{stage="{name}"}} {totals["wall"]:.6f}')
+            lines.append(f'{prefix}_seconds_count{{stage="{name}"}} {totals["count"]}')
+        for metric, key, help_text in (('cpu_seconds_total', 'cpu', 'Process CPU time of each pipeline stage.'),
+                                       ('megapixels_total', 'megapixels', 'Megapixels processed by each stage.'),
+                                       ('allocated_bytes_total', 'bytes', 'Traced peak bytes allocated by each stage.')):
+            lines.append(f'# HELP {prefix}_{metric} {help_text}')
+            lines.append(f'# TYPE {prefix}_{metric} counter')
+            for name, totals in stages:
+                lines.append(f'{prefix}_{metric}{{stage="{name}"}} {totals[key]:.6g}')
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path):
+        # atomic, so a scraper reading the file never sees half of it
+        with open(path + '.part', 'w') as f:
+            f.write(self.prometheus_text())
+        os.replace(path + '.part', path)
+
+
+# Process-wide registry every finished Tracer reports to
+REGISTRY = MetricsRegistry()
+
+
+class _Stage:
+    __slots__ = ('tracer', 'name', 'megapixels', 'depth', 'wall', 'cpu')
+
+    def __init__(self, tracer, name, megapixels):
+        self.tracer = tracer
+        self.name = name
+        self.megapixels = megapixels
+
+    def __enter__(self):
+        tracer = self.tracer
+        self.depth = tracer._depth
+        tracer._depth += 1
+        if tracer.track_allocations:
+            current, peak = tracemalloc.get_traced_memory()
+            if tracer._peaks:
+                # the peak is reset below, keep the enclosing stage's so far
+                tracer._peaks[-1][1] = max(tracer._peaks[-1][1], peak)
+            tracer._peaks.append([current, current])
+            tracemalloc.reset_peak()
+        self.cpu = time.process_time()
+        self.wall = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        wall = time.perf_counter() - self.wall
+        cpu = time.process_time() - self.cpu
+        tracer = self.tracer
+        tracer._depth -= 1
+        allocated = None
+        if tracer.track_allocations:
+            start, running_peak = tracer._peaks.pop()
+            peak = max(running_peak, tracemalloc.get_traced_memory()[1])
+            allocated = peak - start
+            if tracer._peaks:
+                tracer._peaks[-1][1] = max(tracer._peaks[-1][1], peak)
+        tracer.records.append(StageRecord(self.name, self.depth, wall, cpu, self.megapixels, allocated))
+        return False
+
+
+class Tracer:
+    """
+        Context manager collecting the StageRecords of one request. Stages
+        run inside it (stage() blocks and traced() functions, also in
+        nested calls) are recorded; outside of any Tracer they cost one
+        context variable lookup.
+
+        Params:
+            - name: request name, used for the profile file name
+            - enabled: False makes the tracer a no-op
+            - track_allocations: trace allocations with tracemalloc (slow).
+            Only one tracer per process tracks them at a time; a tracer
+            entered while another one does (a second session or worker
+            thread) records bytes_allocated as None. The owner's figures
+            still count what other threads allocate meanwhile.
+            - profile: run cProfile for the whole request and dump it to
+            profile_dir (pstats format, e.g. for snakeviz)
+            - profile_dir: folder of the profile dumps
+            - registry: MetricsRegistry the records are added to, None to
+            keep them to the tracer
+    """
+    def __init__(self, name='request', enabled=True, track_allocations=False, profile=False,
+                 profile_dir=None, registry=REGISTRY):
+        self.name = name
+        self.enabled = enabled
+        self.track_allocations = track_allocations and enabled
+        self.profile = profile and enabled
+        self.profile_dir = profile_dir or '.'
+        self.profile_path = None
+        self.registry = registry
+        self.records = []
+        self._depth = 0
+        self._peaks = []
+        self._token = None
+        self._profiler = None
+        self._started_tracemalloc = False
+
+    def __enter__(self):
+        if not self.enabled:
+            return self
+        self._token = _current_tracer.set(self)
+        if self.track_allocations:
+            self.track_allocations = self._own_allocations()
+        if self.profile:
+            self._profiler = cProfile.Profile()
+            self._profiler.enable()
+        return self
+
+    def __exit__(self, *exc_info):
+        if not self.enabled:
+            return False
+        if self._profiler is not None:
+            self._profiler.disable()
+            os.makedirs(self.profile_dir, exist_ok=True)
+            self.profile_path = os.path.join(self.profile_dir, f'{self.name}-{time.time_ns()}.prof')
+            self._profiler.dump_stats(self.profile_path)
+            self._profiler = None
+        if self.track_allocations:
+            self._release_allocations()
+        _current_tracer.reset(self._token)
+        if self.registry is not None:
+            for record in self.records:
+                self.registry.observe(record)
+        return False
+
+    def _own_allocations(self):
+        # True when this tracer became the allocation owner
+        global _allocation_owner
+        with _allocation_lock:
+            if _allocation_owner is not None:
+                return False
+            _allocation_owner = self
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+                self._started_tracemalloc = True
+            return True
+
+    def _release_allocations(self):
+        global _allocation_owner
+        with _allocation_lock:
+            if self._started_tracemalloc:
+                tracemalloc.stop()
+                self._started_tracemalloc = False
+            _allocation_owner = None
+
+    def stage(self, name, megapixels=None):
+        return _Stage(self, name, megapixels) if self.enabled else _NO_STAGE
+
+    def slowest(self, count=5):
+        """
+            slowest: the `count` stages with the longest wall time.
+        """
+        return sorted(self.records, key=lambda record: record.wall, reverse=True)[:count]
+
+
+def stage(name, megapixels=None):
+    """
+        stage: context manager timing a block as a stage of the current
+            Tracer, a no-op when no Tracer is active.
+    """
+    tracer = _current_tracer.get()
+    if tracer is None:
+        return _NO_STAGE
+    return _Stage(tracer, name, megapixels)
+
+
+def traced(name=None):
+    """
+        traced: decorator recording every call of the function as a stage
+                of the current Tracer; the megapixels are taken from the
+                first argument when it is an image or array.
+    """
+    def decorator(function):
+        stage_name = name or function.__name__
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            tracer = _current_tracer.get()
+            if tracer is None:
+                return function(*args, **kwargs)
+            with _Stage(tracer, stage_name, megapixels_of(args[0]) if args else None):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def profiling_settings(thresholds):
+    """
+        profiling_settings: the 'profiling' section of the thresholds with
+                        defaults filled in.
+    """
+    settings = dict(DEFAULT_PROFILING)
+    settings.update(thresholds.get('profiling') or {})
+    return settings
+
+
+def tracer_from_config(thresholds, name='request', registry=REGISTRY):
+    """
+        tracer_from_config: Tracer for one request as the 'profiling'
+                        section describes it; a sampled share of the
+                        requests (profile_sample_rate) is also profiled.
+    """
+    settings = profiling_settings(thresholds)
+    profile = settings['enabled'] and random.random() < settings['profile_sample_rate']
+    return Tracer(name, enabled=settings['enabled'], track_allocations=settings['track_allocations'],
+                  profile=profile, profile_dir=settings['profile_dir'], registry=registry)
+
+
+def export_metrics(thresholds, registry=REGISTRY):
+    # write the Prometheus text file the 'profiling' section names, if any
+    path = profiling_settings(thresholds)['prometheus_file']
+    if path:
+        registry.write(path)
@@ -0,0 +1,135 @@
+import math
+
+import numpy as np
+import cv2
+
+# Histogram distances histogram_distances reports
+HISTOGRAM_DISTANCES = ('hellinger', 'emd', 'chi2')
+
+
+def mse(reference, image):
+    """
+        mse: mean squared error of image against reference, over every
+            pixel and channel.
+    """
+    return float(np.mean((np.asarray(reference, dtype=np.float64) - np.asarray(image, dtype=np.float64)) ** 2))
+
+
+def psnr(reference, image, data_range=255.0):
+    """
+        psnr: peak signal to noise ratio of image against reference, in dB
+            (inf for identical images).
+    """
+    error = mse(reference, image)
+    if error == 0:
+        return float('inf')
+    return float(10 * np.log10(data_range ** 2 / error))
+
+
+def _gray(array):
+    array = np.asarray(array)
+    if array.ndim == 3:
+        array = cv2.cvtColor(array, cv2.COLOR_RGB2GRAY)
+    return array
+
+
+def shrink(array, max_pixels):
+    # area downscale to at most max_pixels, the array itself when smaller
+    height, width = array.shape[:2]
+    if not max_pixels or width * height <= max_pixels:
+        return array
+    factor = math.sqrt(width * height / max_pixels)
+    return cv2.resize(array, (max(1, int(width / factor)), max(1, int(height / factor))), interpolation=cv2.INTER_AREA)
+
+
+def _ssim_map(x, y, data_range):
+    c1 = (0.01 * data_range) ** 2
+    c2 = (0.03 * data_range) ** 2
+
+    def blur(array):
+        return cv2.GaussianBlur(array, (11, 11), 1.5)
+
+    mu_x, mu_y = blur(x), blur(y)
+    sigma_x = blur(x * x) - mu_x * mu_x
+    sigma_y = blur(y * y) - mu_y * mu_y
+    sigma_xy = blur(x * y) - mu_x * mu_y
+    return ((2 * mu_x * mu_y + c1) * (2 * sigma_xy + c2)) / ((mu_x * mu_x + mu_y * mu_y + c1) * (sigma_x + sigma_y + c2))
+
+
+def ssim(reference, image, data_range=255.0, max_pixels=None):
+    """
+        ssim: mean structural similarity of the gray versions of two images,
+            with the usual 11x11 Gaussian window (sigma 1.5) of Wang et al.
+
+        With max_pixels, both images are first area downscaled to at most
+        that many pixels: much faster on large images, but blind to detail
+        finer than the downscale (sharpening, fine noise), which
+        tiled_ssim keeps.
+    """
+    x = shrink(_gray(reference), max_pixels).astype(np.float32)
+    y = shrink(_gray(image), max_pixels).astype(np.float32)
+    return float(_ssim_map(x, y, data_range).mean())
+
+
+def tiled_ssim(reference, image, data_range=255.0, tile_size=256, tiles=16):
+    """
+        tiled_ssim: mean SSIM of up to tiles full resolution windows of
+                    tile_size x tile_size spread evenly over the image (a
+                    grid, the same for both images). The cost is that of
+                    tiles windows whatever the image size, and fine detail
+                    is measured at full resolution.
+    """
+    reference, image = np.asarray(reference), np.asarray(image)
+    height, width = reference.shape[:2]
+    if tile_size * tile_size * tiles >= width * height:
+        return ssim(reference, image, data_range)
+    side = max(1, int(math.sqrt(tiles)))
+    rows = np.linspace(0, max(0, height - tile_size), side).astype(int)
+    columns = np.linspace(0, max(0, width - tile_size), side).astype(int)
+    scores = []
+    for top in rows:
+        for left in columns:
+            window = np.s_[top:top + tile_size, left:left + tile_size]
+            x = _gray(reference[window]).astype(np.float32)
+            y = _gray(image[window]).astype(np.float32)
+            scores.append(_ssim_map(x, y, data_range).mean())
+    return float(np.mean(scores))
+
+
+def channel_histograms(image):
+    """
+        channel_histograms: 256 bin histogram of every channel of an 8-bit
+                            image (the counts np.bincount gives, from
+                            cv2.calcHist, which is about 6x faster as it
+                            never widens the pixels to 64 bits).
+
+        returns:
+            - (channels, 256) int64 array of pixel counts
+    """
+    array = np.ascontiguousarray(image)
+    channels = 1 if array.ndim == 2 else array.shape[2]
+    return np.stack([np.rint(cv2.calcHist([array], [channel], None, [256], [0, 256]).ravel()).astype(np.int64)
+                     for channel in range(channels)])
+
+
+def histogram_distances(reference_histograms, histograms):
+    """
+        histogram_distances: distances between the channel histograms of two
+                            images, averaged over the channels.
+
+        Params:
+            - reference_histograms, histograms: channel_histograms outputs
+
+        returns:
+            - dictionary keyed by HISTOGRAM_DISTANCES: 'hellinger' (0 for
+            the same distribution, 1 for disjoint ones), 'emd' (earth
+            mover's distance in gray levels, how far the tones moved) and
+            'chi2' (symmetric chi-squared, 0 to 1)
+    """
+    p = reference_histograms / np.maximum(reference_histograms.sum(axis=1, keepdims=True), 1)
+    q = histograms / np.maximum(histograms.sum(axis=1, keepdims=True), 1)
+    hellinger = np.sqrt(np.maximum(0.0, 1 - np.sqrt(p * q).sum(axis=1)))
+    emd = np.abs(np.cumsum(p, axis=1) - np.cumsum(q, axis=1)).sum(axis=1)
+    total = p + q
+    chi2 = 0.5 * np.divide((p - q) ** 2, total, out=np.zeros_like(total), where=total > 0).sum(axis=1)
+    return {'hellinger': float(hellinger.mean()), 'emd': float(emd.mean()), 'chi2': float(chi2.mean())}
@@ -0,0 +1,149 @@
+import math
+
+import numpy as np
+
+
+class QuantileSketch:
+    """
+        QuantileSketch: streaming quantiles of non-negative values with a
+                    bounded relative error (a DDSketch).
+
+        Values are counted in logarithmic buckets: bucket i holds the
+        values in (gamma ** (i - 1), gamma ** i], gamma =
+        (1 + accuracy) / (1 - accuracy), so any quantile is returned within
+        `accuracy` of the true value relative to it. Zero (and anything
+        below min_value) has its own counter. Memory does not grow with the
+        number of values, only with the range they span; past max_buckets
+        the lowest buckets are folded together, which only costs accuracy
+        at the very bottom of the range.
+
+        Two sketches with the same accuracy merge by adding their bucket
+        counts, so sketches built by different workers, shards or runs
+        combine into exactly the sketch of all the values, in any order.
+
+        Params:
+            - accuracy: relative accuracy of the quantiles
+            - max_buckets: bucket limit
+            - min_value: smallest value told apart from zero
+    """
+
+    def __init__(self, accuracy=0.01, max_buckets=2048, min_value=1e-6):
+        self.accuracy = accuracy
+        self.max_buckets = max_buckets
+        self.min_value = min_value
+        self.gamma = (1 + accuracy) / (1 - accuracy)
+        self._log_gamma = math.log(self.gamma)
+        self.buckets = {}
+        self.zero_count = 0
+        self.count = 0
+        self.total = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+
+    def add(self, value):
+        self.add_many([value])
+
+    def add_many(self, values):
+        """
+            add_many: count an array of values; NaNs are ignored and
+                    negative values are not supported.
+        """
+        values = np.asarray(values, dtype=np.float64).ravel()
+        values = values[~np.isnan(values)]
+        if not len(values):
+            return
+        if values.min() < 0:
+            raise ValueError("QuantileSketch only holds non-negative values")
+        self.count += len(values)
+        self.total += float(values.sum())
+        self.min = min(self.min, float(values.min()))
+        self.max = max(self.max, float(values.max()))
+
+        positive = values[values > self.min_value]
+        self.zero_count += len(values) - len(positive)
+        if len(positive):
+            keys = np.ceil(np.log(positive) / self._log_gamma).astype(np.int64)
+            unique, counts = np.unique(keys, return_counts=True)
+            for key, count in zip(unique.tolist(), counts.tolist()):
+                self.buckets[key] = self.buckets.get(key, 0) + count
+            self._collapse()
+
+    def _collapse(self):
+        # fold the lowest buckets into one when there are too many
+        if len(self.buckets) <= self.max_buckets:
+            return
+        keys = sorted(self.buckets)
+        excess = keys[:len(keys) - self.max_buckets + 1]
+        folded = sum(self.buckets.pop(key) for key in excess)
+        self.buckets[excess[-1]] = folded
+
+    def merge(self, other):
+        """
+            merge: add the values counted by another sketch to this one.
+        """
+        if other.accuracy != self.accuracy or other.min_value != self.min_value:
+            raise ValueError("only sketches with the same accuracy and min_value can be merged")
+        for key, count in other.buckets.items():
+            self.buckets[key] = self.buckets.get(key, 0) + count
+        self.zero_count += other.zero_count
+        self.count += other.count
+        self.total += other.total
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        self._collapse()
+        return self
+
+    def quantile(self, q):
+        """
+            quantile: value at quantile q (0-1), None for an empty sketch.
+        """
+        if not self.count:
+            return None
+        if q <= 0:
+            return self.min
+        if q >= 1:
+            return self.max
+        rank = q * (self.count - 1)
+        seen = self.zero_count
+        if rank < seen:
+            return 0.0 if self.min <= 0 else self.min
+        for key in sorted(self.buckets):
+            seen += self.buckets[key]
+            if rank < seen:
+                # middle of the bucket in relative terms
+                value = 2 * self.gamma ** key / (self.gamma + 1)
+                return min(self.max, max(self.min, value))
+        return self.max
+
+    def percentile(self, p):
+        return self.quantile(p / 100)
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else None
+
+    def to_dict(self):
+        # JSON friendly state, see from_dict
+        return {
+            'accuracy': self.accuracy,
+            'max_buckets': self.max_buckets,
+            'min_value': self.min_value,
+            'buckets': {str(key): count for key, count in self.buckets.items()},
+            'zero_count': self.zero_count,
+            'count': self.count,
+            'total': self.total,
+            'min': self.min if self.count else None,
+            'max': self.max if self.count else None
+        }
+
+    @classmethod
+    def from_dict(cls, state):
+        sketch = cls(state['accuracy'], state['max_buckets'], state['min_value'])
+        sketch.buckets = {int(key): count for key, count in state['buckets'].items()}
+        sketch.zero_count = state['zero_count']
+        sketch.count = state['count']
+        sketch.total = state['total']
+        if sketch.count:
+            sketch.min = state['min']
+            sketch.max = state['max']
+        return sketch
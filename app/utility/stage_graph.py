@@ -0,0 +1,184 @@
+from collections import Counter, OrderedDict
+import functools
+import threading
+
+from PIL import Image
+
+from utility.adjustments import adjustment_factors, brighten, contrast, saturate, sharpen
+from utility.helper import apply_adjustments
+from utility.image_io import encode
+from utility.quality import shrink
+
+# Interactive settings used when the yaml has no 'interactive' section: the
+# sliders work on a proxy of at most proxy_max_pixels (about a screen),
+# shown as a JPEG of display_quality
+DEFAULT_INTERACTIVE = {
+    'proxy_max_pixels': 1500000,
+    'display_quality': 85
+}
+
+# Adjustment stages in the order apply_adjustments runs them, with the
+# recommended value each one reads
+ADJUSTMENT_STAGES = ('saturation', 'brightness', 'contrast', 'sharpness')
+
+
+def interactive_settings(thresholds):
+    """
+        interactive_settings: the 'interactive' section of the thresholds
+                            with defaults filled in.
+    """
+    settings = dict(DEFAULT_INTERACTIVE)
+    settings.update(thresholds.get('interactive') or {})
+    return settings
+
+
+class StageGraph:
+    """
+        Memoized graph of named stages. Each stage is a function of the
+        outputs of its input stages and of its own parameters; its outputs
+        are cached on those parameters and on the parameters of everything
+        upstream. Changing a parameter therefore recomputes that stage and
+        the stages downstream of it, and nothing upstream.
+
+        Params (add):
+            - name: stage name
+            - function: called as function(*input outputs, **params)
+            - inputs: names of the stages it reads, added before it
+            - keep: outputs cached per stage (least recently used dropped)
+            - params: initial parameter values, set again with set()
+
+        runs counts the computations per stage.
+    """
+    def __init__(self):
+        self._stages = OrderedDict()
+        self._params = {}
+        self._outputs = {}
+        self._lock = threading.RLock()
+        self.runs = Counter()
+
+    def add(self, name, function, inputs=(), keep=1, **params):
+        for input_name in inputs:
+            if input_name not in self._stages:
+                raise KeyError(f"stage {name!r} reads unknown stage {input_name!r}")
+        self._stages[name] = (function, tuple(inputs), keep)
+        self._params[name] = dict(params)
+        self._outputs[name] = OrderedDict()
+        return self
+
+    def set(self, name, **params):
+        # unknown parameter names are an error, not a silent new cache key
+        unknown = set(params) - set(self._params[name])
+        if unknown:
+            raise KeyError(f"stage {name!r} has no parameters {sorted(unknown)}")
+        self._params[name].update(params)
+
+    def key(self, name):
+        """
+            key: cache key of a stage's output under the current parameters,
+                its own parameters and the keys of its inputs.
+        """
+        _, inputs, _ = self._stages[name]
+        return (tuple(sorted(self._params[name].items())), tuple(self.key(input_name) for input_name in inputs))
+
+    def get(self, name):
+        """
+            get: output of a stage, computed (with whatever upstream stages
+                are missing) only when it is not cached for the current
+                parameters.
+        """
+        with self._lock:
+            function, inputs, keep = self._stages[name]
+            key = self.key(name)
+            outputs = self._outputs[name]
+            if key in outputs:
+                outputs.move_to_end(key)
+                return outputs[key]
+            output = function(*(self.get(input_name) for input_name in inputs), **self._params[name])
+            self.runs[name] += 1
+            outputs[key] = output
+            while len(outputs) > keep:
+                outputs.popitem(last=False)
+            return output
+
+
+def _saturation(image_np, value):
+    return saturate(image_np, adjustment_factors(value, 5, 5, 5)[0])
+
+
+def _brightness(image_np, value):
+    return brighten(image_np, adjustment_factors(5, value, 5, 5)[1])
+
+
+def _contrast(image_np, value):
+    return contrast(image_np, adjustment_factors(5, 5, value, 5)[2])
+
+
+def _sharpness(image_np, value):
+    return sharpen(image_np, adjustment_factors(5, 5, 5, value)[3])
+
+
+def _display(image_np, quality):
+    return encode(Image.fromarray(image_np), settings={'quality': quality, 'preserve_metadata': False})
+
+
+def _full_resolution(image_np, saturation, brightness, contrast, sharpness, settings=None, metadata=None,
+                     memory_budget=None):
+    adjusted = apply_adjustments(image_np, saturation, brightness, contrast, sharpness, memory_budget=memory_budget)
+    return encode(adjusted, settings=settings, metadata=metadata)
+
+
+def adjustment_graph(restored, recommended, thresholds, output=None, metadata=None, memory_budget=None):
+    """
+        adjustment_graph: StageGraph of the interactive sliders.
+
+        The source is the restored (denoised/deblurred) full resolution
+        array of a pipeline result, so decode, analysis and denoising are
+        never repeated. A screen sized proxy of it goes through one stage
+        per adjustment (saturation -> brightness -> contrast -> sharpness,
+        the passes of apply_adjustments, each cached on its slider value
+        and those upstream) and a 'display' JPEG stage. Moving one slider
+        recomputes its stage and the ones after it, on the proxy. The
+        'full' stage applies the current values to the full resolution
+        array with apply_adjustments and encodes it with the output
+        settings, for when the user commits.
+
+        Params:
+            - restored: full resolution RGB array (CachedResult.restored)
+            - recommended: starting slider values by metric name
+            - thresholds: thresholds dictionary from load_thresholds
+            - output: output_settings of the full resolution JPEG
+            - metadata: EXIF/ICC of the upload for the full resolution JPEG
+            - memory_budget: working memory in bytes of the full resolution
+            pass
+
+        returns:
+            - the StageGraph; set_adjustments moves the sliders,
+            get('display') renders the proxy; set('full', ...) with the
+            values to commit, then get('full'), gives the JPEG
+    """
+    settings = interactive_settings(thresholds)
+    graph = StageGraph()
+    graph.add('source', lambda: restored)
+    graph.add('proxy', shrink, inputs=('source',), max_pixels=settings['proxy_max_pixels'])
+    functions = {'saturation': _saturation, 'brightness': _brightness, 'contrast': _contrast,
+                 'sharpness': _sharpness}
+    upstream = 'proxy'
+    for name in ADJUSTMENT_STAGES:
+        # a few values per stage, so moving a slider back is a cache hit
+        graph.add(name, functions[name], inputs=(upstream,), keep=4, value=recommended[name])
+        upstream = name
+    graph.add('display', _display, inputs=(upstream,), keep=4, quality=settings['display_quality'])
+    graph.add('full', functools.partial(_full_resolution, settings=output, metadata=metadata,
+                                        memory_budget=memory_budget),
+              inputs=('source',), **{name: recommended[name] for name in ADJUSTMENT_STAGES})
+    return graph
+
+
+def set_adjustments(graph, values):
+    """
+        set_adjustments: move the sliders of an adjustment_graph to values
+                        (by metric name); only the stages whose value
+                        changed, and those after them, are recomputed.
+    """
+    for name in ADJUSTMENT_STAGES:
+        graph.set(name, value=values[name])
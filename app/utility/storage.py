@@ -0,0 +1,429 @@
+import concurrent.futures
+import io
+import os
+import threading
+import time
+from urllib.parse import urlparse
+
+# Storage settings used when the yaml has no 'storage' section: connections
+# kept open per client, reads ahead of the workers, parallel uploads, and
+# the output size from which uploads are split into parts of
+# multipart_chunk_mb. endpoint_url/gcs_endpoint point the S3 and GCS
+# clients at a compatible server (MinIO, moto, fake-gcs-server).
+DEFAULT_STORAGE = {
+    'max_connections': 16,
+    'prefetch': 8,
+    'upload_workers': 4,
+    'multipart_threshold_mb': 8,
+    'multipart_chunk_mb': 8,
+    'endpoint_url': None,
+    'gcs_endpoint': None
+}
+
+_MB = 1024 * 1024
+# GCS resumable uploads send chunks in multiples of 256 KiB
+_GCS_CHUNK_ALIGN = 256 * 1024
+
+
+def storage_settings(thresholds):
+    """
+        storage_settings: the 'storage' section of the thresholds with
+                        defaults filled in.
+    """
+    settings = dict(DEFAULT_STORAGE)
+    settings.update(thresholds.get('storage') or {})
+    return settings
+
+
+class TransferStats:
+    """
+        Bytes, operations, seconds and errors of reads and writes per
+        backend ('local', 's3', 'gcs'), rendered in the Prometheus text
+        exposition format. Seconds add up the time of every transfer, so
+        bytes / seconds is the throughput of one stream; with transfers in
+        parallel the aggregate rate is higher. Safe to share between
+        threads.
+    """
+    def __init__(self):
+        self._backends = {}
+        self._lock = threading.Lock()
+
+    def record(self, backend, direction, size, seconds, error=False):
+        with self._lock:
+            totals = self._backends.get(backend)
+            if totals is None:
+                totals = self._backends[backend] = {
+                    f'{key}_{kind}': 0 for key in ('read', 'write') for kind in ('count', 'bytes', 'seconds', 'errors')
+                }
+            if error:
+                totals[f'{direction}_errors'] += 1
+                return
+            totals[f'{direction}_count'] += 1
+            totals[f'{direction}_bytes'] += size
+            totals[f'{direction}_seconds'] += seconds
+
+    def snapshot(self):
+        with self._lock:
+            return {backend: dict(totals) for backend, totals in self._backends.items()}
+
+    def prometheus_text(self, prefix='enhancement_storage'):
+        """
+            prometheus_text: operations, bytes, seconds and errors counters
+                            per backend and direction.
+        """
+        backends = sorted(self.snapshot().items())
+        lines = []
+        for metric, kind, help_text in (('operations_total', 'count', 'Objects read or written.'),
+                                        ('bytes_total', 'bytes', 'Bytes read or written.'),
+                                        ('seconds_total', 'seconds', 'Time spent in reads or writes.'),
+                                        ('errors_total', 'errors', 'Failed reads or writes.')):
+            lines.append(f'# HELP {prefix}_{metric} {help_text}')
+            lines.append(f'# TYPE {prefix}_{metric} counter')
+            for backend, totals in backends:
+                for direction in ('read', 'write'):
+                    lines.append(f'{prefix}_{metric}{{backend="{backend}",direction="{direction}"}} '
+                                 f'{totals[f"{direction}_{kind}"]:.6g}')
+        return '\n'.join(lines) + '\n'
+
+
+# Process-wide counters every storage reports to
+STATS = TransferStats()
+
+
+class Storage:
+    """
+        Objects under a root: a local folder, an S3 bucket prefix or a GCS
+        bucket prefix. Keys are '/' separated and relative to the root.
+        read, write and exists may be called from several threads at once;
+        every read and write is counted in stats under the backend name.
+    """
+    backend = None
+
+    def __init__(self, settings=None, stats=STATS):
+        self.settings = dict(DEFAULT_STORAGE)
+        self.settings.update(settings or {})
+        self.stats = stats
+
+    def read(self, key):
+        return self._timed('read', self._read, key)
+
+    def write(self, key, data):
+        return self._timed('write', self._write, key, data)
+
+    def _timed(self, direction, function, *args):
+        start = time.perf_counter()
+        try:
+            data = function(*args)
+        except Exception:
+            self.stats.record(self.backend, direction, 0, 0.0, error=True)
+            raise
+        size = len(args[1]) if direction == 'write' else len(data)
+        self.stats.record(self.backend, direction, size, time.perf_counter() - start)
+        return data
+
+    def _multipart(self, data):
+        return len(data) >= self.settings['multipart_threshold_mb'] * _MB
+
+
+class LocalStorage(Storage):
+    """
+        Files under a folder ('' for paths as given). Writes go to a
+        temporary name first, so a killed run never leaves a truncated
+        file that a resumed run would mistake for a result.
+    """
+    backend = 'local'
+
+    def __init__(self, root='', settings=None, stats=STATS):
+        super().__init__(settings, stats)
+        self.root = root
+
+    def path(self, key):
+        return os.path.join(self.root, *key.split('/')) if self.root else key
+
+    def url(self, key):
+        return self.path(key)
+
+    def _read(self, key):
+        with open(self.path(key), 'rb') as f:
+            return f.read()
+
+    def _write(self, key, data):
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        with open(path + '.part', 'wb') as f:
+            f.write(data)
+        os.replace(path + '.part', path)
+
+    def exists(self, key):
+        return os.path.exists(self.path(key))
+
+    def list(self, prefix=''):
+        # sorted, like iter_inputs walks a folder
+        top = self.path(prefix) if prefix else (self.root or '.')
+        for root, dirs, files in os.walk(top):
+            dirs.sort()
+            for name in sorted(files):
+                if not name.endswith('.part'):
+                    yield os.path.relpath(os.path.join(root, name), self.root or '.').replace(os.sep, '/')
+
+
+_CLIENTS = {}
+_CLIENTS_LOCK = threading.Lock()
+
+
+def _endpoint_client(kind, endpoint, create):
+    # one client per backend and endpoint in each process: clients are
+    # thread safe and keep their connection pool between calls
+    with _CLIENTS_LOCK:
+        client = _CLIENTS.get((kind, endpoint, os.getpid()))
+        if client is None:
+            client = _CLIENTS[(kind, endpoint, os.getpid())] = create()
+        return client
+
+
+class S3Storage(Storage):
+    """
+        Objects under a prefix of an S3 (or S3-compatible, with
+        endpoint_url) bucket. One boto3 client per endpoint and process
+        with max_connections pooled connections is shared by every
+        instance; outputs of multipart_threshold_mb or more are uploaded in
+        parts of multipart_chunk_mb.
+
+        Params:
+            - bucket: bucket name
+            - prefix: key prefix of the root, '' for the whole bucket
+            - settings: storage_settings
+            - client: boto3 S3 client to use instead of the shared one
+    """
+    backend = 's3'
+
+    def __init__(self, bucket, prefix='', settings=None, client=None, stats=STATS):
+        super().__init__(settings, stats)
+        self.bucket = bucket
+        self.prefix = prefix.strip('/')
+        self.client = client or _endpoint_client('s3', self.settings['endpoint_url'], self._create_client)
+        self._transfer_config = None
+
+    def _create_client(self):
+        import boto3
+        from botocore.config import Config
+        config = Config(max_pool_connections=self.settings['max_connections'],
+                        retries={'max_attempts': 5, 'mode': 'adaptive'})
+        return boto3.session.Session().client('s3', endpoint_url=self.settings['endpoint_url'], config=config)
+
+    def _key(self, key):
+        return f'{self.prefix}/{key}' if self.prefix else key
+
+    def url(self, key):
+        return f's3://{self.bucket}/{self._key(key)}'
+
+    def _read(self, key):
+        return self.client.get_object(Bucket=self.bucket, Key=self._key(key))['Body'].read()
+
+    def _write(self, key, data):
+        if not self._multipart(data):
+            self.client.put_object(Bucket=self.bucket, Key=self._key(key), Body=data)
+            return
+        if self._transfer_config is None:
+            from boto3.s3.transfer import TransferConfig
+            self._transfer_config = TransferConfig(multipart_threshold=self.settings['multipart_threshold_mb'] * _MB,
+                                                   multipart_chunksize=self.settings['multipart_chunk_mb'] * _MB,
+                                                   max_concurrency=self.settings['upload_workers'])
+        self.client.upload_fileobj(io.BytesIO(data), self.bucket, self._key(key), Config=self._transfer_config)
+
+    def exists(self, key):
+        from botocore.exceptions import ClientError
+        try:
+            self.client.head_object(Bucket=self.bucket, Key=self._key(key))
+        except ClientError as e:
+            if e.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey', 'NotFound'):
+                return False
+            raise
+        return True
+
+    def list(self, prefix=''):
+        start = len(self.prefix) + 1 if self.prefix else 0
+        paginator = self.client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=self._key(prefix) if prefix or self.prefix else ''):
+            for item in page.get('Contents', ()):
+                if not item['Key'].endswith('/'):
+                    yield item['Key'][start:]
+
+
+class GCSStorage(Storage):
+    """
+        Objects under a prefix of a Google Cloud Storage bucket (or of a
+        GCS-compatible server, with gcs_endpoint, reached without
+        credentials). One client per endpoint and process with
+        max_connections pooled connections is shared by every instance;
+        outputs of multipart_threshold_mb or more are sent as a resumable
+        upload in chunks of multipart_chunk_mb.
+
+        Params:
+            - bucket: bucket name
+            - prefix: object name prefix of the root, '' for the whole bucket
+            - settings: storage_settings
+            - client: google.cloud.storage client to use instead of the
+            shared one
+    """
+    backend = 'gcs'
+
+    def __init__(self, bucket, prefix='', settings=None, client=None, stats=STATS):
+        super().__init__(settings, stats)
+        self.prefix = prefix.strip('/')
+        self.client = client or _endpoint_client('gcs', self.settings['gcs_endpoint'], self._create_client)
+        self.bucket = self.client.bucket(bucket)
+
+    def _create_client(self):
+        import requests
+        from google.cloud import storage
+        endpoint = self.settings['gcs_endpoint']
+        if endpoint:
+            from google.auth.credentials import AnonymousCredentials
+            client = storage.Client(project='local', credentials=AnonymousCredentials(),
+                                    client_options={'api_endpoint': endpoint})
+        else:
+            client = storage.Client()
+        # the default session keeps 10 connections per host, fewer than the
+        # prefetch and upload threads may use at once
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=self.settings['max_connections'])
+        client._http.mount('https://', adapter)
+        client._http.mount('http://', adapter)
+        return client
+
+    def _key(self, key):
+        return f'{self.prefix}/{key}' if self.prefix else key
+
+    def url(self, key):
+        return f'gs://{self.bucket.name}/{self._key(key)}'
+
+    def _read(self, key):
+        return self.bucket.blob(self._key(key)).download_as_bytes()
+
+    def _write(self, key, data):
+        chunk_size = None
+        if self._multipart(data):
+            chunk_size = max(1, self.settings['multipart_chunk_mb'] * _MB // _GCS_CHUNK_ALIGN) * _GCS_CHUNK_ALIGN
+        blob = self.bucket.blob(self._key(key), chunk_size=chunk_size)
+        blob.upload_from_file(io.BytesIO(data), size=len(data), content_type='image/jpeg')
+
+    def exists(self, key):
+        return self.bucket.blob(self._key(key)).exists()
+
+    def list(self, prefix=''):
+        start = len(self.prefix) + 1 if self.prefix else 0
+        for blob in self.client.list_blobs(self.bucket, prefix=self._key(prefix) if prefix or self.prefix else None):
+            if not blob.name.endswith('/'):
+                yield blob.name[start:]
+
+
+def is_url(location):
+    return urlparse(location).scheme in ('s3', 'gs', 'file')
+
+
+def open_storage(location, settings=None, client=None):
+    """
+        open_storage: the Storage rooted at a location.
+
+        Params:
+            - location: folder path, file:// URL, s3://bucket/prefix or
+            gs://bucket/prefix
+            - settings: storage_settings
+            - client: S3 or GCS client to use instead of the shared one
+            (e.g. a stub in tests)
+
+        returns:
+            - LocalStorage, S3Storage or GCSStorage
+    """
+    parsed = urlparse(location)
+    if parsed.scheme == 's3':
+        return S3Storage(parsed.netloc, parsed.path, settings, client)
+    if parsed.scheme == 'gs':
+        return GCSStorage(parsed.netloc, parsed.path, settings, client)
+    if parsed.scheme == 'file':
+        return LocalStorage(parsed.path, settings)
+    return LocalStorage(location, settings)
+
+
+def prefetch(items, read, depth):
+    """
+        prefetch: read items on a thread pool, keeping up to depth reads
+                ahead of the consumer, in the order of items.
+
+        Params:
+            - items: iterable of anything read accepts
+            - read: function of one item returning its data
+            - depth: reads in flight at once
+
+        returns:
+            - generator of (item, data, error) tuples, error the exception
+            the read raised (data None) or None
+    """
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, depth), thread_name_prefix='prefetch') as pool:
+        pending = []
+        items = iter(items)
+        try:
+            while True:
+                while len(pending) < depth:
+                    item = next(items, None)
+                    if item is None:
+                        break
+                    pending.append((item, pool.submit(read, item)))
+                if not pending:
+                    return
+                item, future = pending.pop(0)
+                try:
+                    yield item, future.result(), None
+                except Exception as e:
+                    yield item, None, e
+        finally:
+            for _, future in pending:
+                future.cancel()
+
+
+class Uploader:
+    """
+        Writes to a storage on workers threads, with at most 2 x workers
+        writes submitted and not finished: submit blocks beyond that, so
+        encoded outputs never pile up in memory when the storage is slower
+        than the pipeline.
+
+        Params:
+            - storage: Storage written to
+            - workers: writes in flight at once
+    """
+    def __init__(self, storage, workers=4):
+        self.storage = storage
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix='upload')
+        self._slots = threading.BoundedSemaphore(2 * workers)
+
+    def submit(self, key, data, callback=None):
+        """
+            submit: write data under key in the background; callback, when
+                    given, is called with (key, error message or None)
+                    from the upload thread.
+
+            returns:
+                - the write's future
+        """
+        self._slots.acquire()
+        future = self._executor.submit(self.storage.write, key, data)
+
+        def done(future):
+            self._slots.release()
+            if callback is not None:
+                error = future.exception()
+                callback(key, None if error is None else f"{type(error).__name__}: {error}")
+
+        future.add_done_callback(done)
+        return future
+
+    def close(self):
+        # waits for the writes still in flight
+        self._executor.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,194 @@
+from collections import namedtuple
+
+import numpy as np
+
+from utility.analysis import METRIC_PARTS, STATISTICS_PARTS
+from utility.config import METRIC_NAMES
+from utility.helper import recommend_value
+
+# Strategy settings used when the yaml has no 'strategy' section: the
+# recommend_value strategy main.py has always used, denoising and
+# deblurring on. main_01 is the strategy of main_01.py (None for name),
+# fast_name the one of the fast path (fast_path_thresholds).
+DEFAULT_STRATEGY = {
+    'name': 'metrics',
+    'main_01': 'histogram',
+    'fast_name': 'levels',
+    'restore': True
+}
+
+# Upper bound of recommend_value for metric sections without one
+UPPER_BOUND = 255
+
+# Factor ranges of main_01.py's subtle enhancement
+SUBTLE_RANGES = {
+    'brightness': (0.9, 1.1),
+    'contrast': (0.9, 1.3),
+    'sharpness': (0.9, 1.1),
+    'saturation': (0.9, 1.3)
+}
+
+# A recommendation strategy: recommend(analysis, thresholds) gives the
+# recommended value (0-10, 5 = unchanged) of every METRIC_NAMES entry from
+# an ImageMetrics and its ImageStatistics; parts are the statistics it
+# reads, so the analysis pass gathers nothing more on the fast path.
+Strategy = namedtuple('Strategy', ['recommend', 'parts'])
+
+
+def strategy_settings(thresholds):
+    """
+        strategy_settings: the 'strategy' section of the thresholds with
+                        defaults filled in and the names checked.
+    """
+    settings = dict(DEFAULT_STRATEGY)
+    settings.update(thresholds.get('strategy') or {})
+    for key in ('name', 'main_01', 'fast_name'):
+        if settings[key] is not None and settings[key] not in STRATEGIES:
+            raise ValueError(f"unknown strategy {key} {settings[key]!r}, choose from {', '.join(sorted(STRATEGIES))}")
+    return settings
+
+
+def factor_to_value(factor):
+    # inverse of the 1 + (value - 5) * 0.2 mapping of adjustment_factors
+    return 5 + (factor - 1) / 0.2
+
+
+def value_to_factor(value):
+    """
+        value_to_factor: the ImageEnhance factor of a recommended value,
+                        adjustment_factors without its clamping to 1-2.
+    """
+    return 1 + (value - 5) * 0.2
+
+
+def subtle_factor(name, factor):
+    # a factor clipped to its SUBTLE_RANGES range
+    return float(np.clip(factor, *SUBTLE_RANGES[name]))
+
+
+def recommend_metrics(analysis, thresholds):
+    """
+        recommend_metrics: the 'metrics' strategy, recommend_value on the
+                        HSV means, the gray standard deviation and the
+                        Laplacian variance against the low and high
+                        thresholds of each metric.
+    """
+    recommended = {}
+    for name in METRIC_NAMES:
+        recommended[name] = recommend_value(getattr(analysis, name),
+                                            thresholds[name]['low_threshold'],
+                                            thresholds[name]['high_threshold'],
+                                            thresholds[name].get('upper_bound', UPPER_BOUND))
+    return recommended
+
+
+def histogram_factors(histogram):
+    """
+        histogram_factors: main_01.py's subtle enhancement factors from a
+                        256 bin gray histogram. They are statistics of the
+                        bin counts (their mean, spread, tails and
+                        percentiles), not of the gray levels, computed
+                        exactly as main_01.py always has; kept for
+                        main_01.py only, level_factors is the same formula
+                        on the levels.
+
+        returns:
+            - brightness, contrast, sharpness and saturation factor
+    """
+    histogram = np.asarray(histogram)
+    brightness_factor = 1 + (0.5 - np.mean(histogram) / 255) * 0.2
+    contrast_factor = 1 + (np.std(histogram) / 128 - 1) * 0.2
+    sharpness_factor = 1 + (np.mean(histogram[-10:]) - np.mean(histogram[:10])) / 255 * 0.2
+    saturation_factor = 1 + (np.percentile(histogram, 95) - np.percentile(histogram, 5)) / 255 * 0.2
+    return (subtle_factor('brightness', brightness_factor), subtle_factor('contrast', contrast_factor),
+            subtle_factor('sharpness', sharpness_factor), subtle_factor('saturation', saturation_factor))
+
+
+def level_factors(histogram):
+    """
+        level_factors: the subtle enhancement factors of histogram_factors
+                    from statistics of the gray levels the histogram
+                    counts: their mean and standard deviation, the share
+                    of pixels in the 10 brightest against the 10 darkest
+                    levels, and the spread between their 5th and 95th
+                    percentiles.
+
+        Params:
+            - histogram: 256 bin gray histogram
+
+        returns:
+            - brightness, contrast, sharpness and saturation factor
+    """
+    histogram = np.asarray(histogram, dtype=np.float64)
+    count = histogram.sum()
+    if not count:
+        return 1.0, 1.0, 1.0, 1.0
+    levels = np.arange(len(histogram))
+    mean = (levels * histogram).sum() / count
+    std = np.sqrt((np.square(levels - mean) * histogram).sum() / count)
+    cdf = np.cumsum(histogram)
+    low, high = np.searchsorted(cdf, (0.05 * count, 0.95 * count))
+    brightness_factor = 1 + (0.5 - mean / 255) * 0.2
+    contrast_factor = 1 + (std / 128 - 1) * 0.2
+    sharpness_factor = 1 + (histogram[-10:].sum() - histogram[:10].sum()) / count * 0.2
+    saturation_factor = 1 + (high - low) / 255 * 0.2
+    return (subtle_factor('brightness', brightness_factor), subtle_factor('contrast', contrast_factor),
+            subtle_factor('sharpness', sharpness_factor), subtle_factor('saturation', saturation_factor))
+
+
+def _factors_to_values(brightness, contrast, sharpness, saturation):
+    return {'saturation': factor_to_value(saturation), 'brightness': factor_to_value(brightness),
+            'contrast': factor_to_value(contrast), 'sharpness': factor_to_value(sharpness)}
+
+
+def recommend_histogram(analysis, thresholds):
+    """
+        recommend_histogram: the 'histogram' strategy of main_01.py,
+                        histogram_factors of the gray histogram as
+                        recommended values. The pipeline's adjustments
+                        only enhance (factors of 1 or more), so factors
+                        below 1 leave their adjustment unchanged there.
+    """
+    return _factors_to_values(*histogram_factors(analysis.statistics.gray_histogram))
+
+
+def recommend_levels(analysis, thresholds):
+    """
+        recommend_levels: the 'levels' strategy, level_factors of the gray
+                        histogram as recommended values. It reads nothing
+                        but that histogram, the cheapest statistic to
+                        gather, which makes it the fast path default.
+    """
+    return _factors_to_values(*level_factors(analysis.statistics.gray_histogram))
+
+
+STRATEGIES = {
+    'metrics': Strategy(recommend_metrics, tuple(sorted({METRIC_PARTS[name] for name in METRIC_NAMES}))),
+    'histogram': Strategy(recommend_histogram, ('gray',)),
+    'levels': Strategy(recommend_levels, ('gray',)),
+}
+
+
+def strategy_parts(thresholds, name=None):
+    """
+        strategy_parts: the statistics the analysis pass has to gather for
+                        a strategy (the configured one when name is None):
+                        every part when denoising and deblurring are on,
+                        as the UI shows every metric, only the strategy's
+                        otherwise.
+    """
+    settings = strategy_settings(thresholds)
+    parts = set(STRATEGIES[name or settings['name']].parts)
+    if settings['restore']:
+        parts.update(STATISTICS_PARTS)
+    return tuple(sorted(parts))
+
+
+def fast_path_thresholds(thresholds):
+    """
+        fast_path_thresholds: the thresholds of the fast path for high
+                        volume traffic: the fast_name strategy, only the
+                        statistics it reads, no denoising or deblurring.
+    """
+    settings = strategy_settings(thresholds)
+    return dict(thresholds, strategy=dict(settings, name=settings['fast_name'], restore=False))
@@ -0,0 +1,78 @@
+import numpy as np
+
+# Default working memory budget for one image, in bytes. Full frames
+# (the decoded image and the result) are not counted, every temporary a
+# stage makes is kept inside the budget by processing the image in bands.
+MEMORY_BUDGET = 64 * 1024 * 1024
+
+# Rough working bytes per pixel of each stage, including its temporaries
+# (intermediate colour spaces, accumulators, the filtered band itself)
+BYTES_PER_PIXEL = {
+    'analysis': 48,
+    'denoise': 64,
+    'filter': 16,
+    'adjust': 24,
+}
+
+
+def band_rows(width, stage, memory_budget=None, halo=0):
+    """
+        band_rows: number of rows per band so that one band of the stage,
+                including its halo rows, fits in the memory budget.
+
+        Params:
+            - width: image width in pixels
+            - stage: key of BYTES_PER_PIXEL
+            - memory_budget: bytes, MEMORY_BUDGET when None
+            - halo: rows of context needed above and below each band
+
+        returns:
+            - rows per band, at least 1
+    """
+    budget = memory_budget or MEMORY_BUDGET
+    rows = budget // (max(1, width) * BYTES_PER_PIXEL[stage]) - 2 * halo
+    return max(1, int(rows))
+
+
+def apply_banded(image_np, function, halo, rows, out=None):
+    """
+        apply_banded: run a neighbourhood filter band by band.
+
+        Each band is filtered together with `halo` rows of context above and
+        below, and only its own rows are kept. A filter whose output depends
+        on pixels at most `halo` rows away gives exactly the full frame
+        result, since the real image edges are the band edges there and the
+        filter's own border handling applies to them.
+
+        Params:
+            - image_np: input array (H, W) or (H, W, C)
+            - function: filter taking and returning an array of one band
+            - halo: footprint radius of the filter in rows
+            - rows: rows per band
+            - out: output array; None allocates one, passing image_np
+            filters in place (the rows the next band still needs are
+            saved before they are overwritten)
+
+        returns:
+            - the filtered array
+    """
+    height = image_np.shape[0]
+    if out is None:
+        out = np.empty_like(image_np)
+    in_place = out is image_np
+    # original rows [halo_top, top) of the current band when filtering in
+    # place, the image itself holds filtered values there already
+    carry = image_np[:0].copy()
+    for top in range(0, height, rows):
+        bottom = min(height, top + rows)
+        halo_top = max(0, top - halo)
+        halo_bottom = min(height, bottom + halo)
+        if in_place:
+            block = np.concatenate([carry, image_np[top:halo_bottom]])
+            if halo:
+                carry = np.concatenate([carry, image_np[top:bottom]])[-halo:]
+        else:
+            block = image_np[halo_top:halo_bottom]
+        result = function(block)
+        out[top:bottom] = result[top - halo_top:top - halo_top + bottom - top]
+    return out
@@ -0,0 +1,70 @@
+import concurrent.futures
+
+# What the worker process's pool was started with (process_pool), None in
+# every other process
+_state = None
+
+
+def pin_threads():
+    # the pool already uses every core, keep OpenCV from spawning its own
+    # threads
+    try:
+        import cv2
+        cv2.setNumThreads(1)
+    except ImportError:
+        pass
+
+
+def _init_process(state):
+    global _state
+    _state = state
+    pin_threads()
+
+
+def worker_state():
+    """
+        worker_state: inside a process_pool worker, the state its pool was
+                    started with.
+    """
+    return _state
+
+
+def process_pool(workers, state=None):
+    """
+        process_pool: process pool whose workers run OpenCV single threaded
+                    and get state (thresholds and the like) once, through
+                    worker_state, instead of with every task.
+
+        Params:
+            - workers: worker processes, None for one per core
+            - state: picklable value handed to every worker
+
+        returns:
+            - ProcessPoolExecutor
+    """
+    return concurrent.futures.ProcessPoolExecutor(max_workers=workers, initializer=_init_process, initargs=(state,))
+
+
+def run_bounded(pool, tasks, max_in_flight, collect):
+    """
+        run_bounded: submit tasks to pool with at most max_in_flight of them
+                    pending, so a large corpus is never queued at once.
+
+        Params:
+            - pool: executor
+            - tasks: iterable of (tag, function, args) tuples, consumed as
+            slots free up
+            - max_in_flight: most tasks submitted and not yet collected
+            - collect: collect(future, tag) of every finished task, called
+            on the caller's thread
+    """
+    pending = {}
+    for tag, function, args in tasks:
+        if len(pending) >= max_in_flight:
+            done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                collect(future, pending.pop(future))
+        pending[pool.submit(function, *args)] = tag
+    done, _ = concurrent.futures.wait(pending)
+    for future in done:
+        collect(future, pending.pop(future))
@@ -0,0 +1,139 @@
+"""
+    bench_adjustments: compare the ImageEnhance chain of apply_adjustments
+                    with the fused engine at 12MP and 24MP.
+
+    Usage:
+        python benchmarks/bench_adjustments.py
+        python benchmarks/bench_adjustments.py --sizes 12 24 --repeat 3
+
+    Every (engine, size) pair runs in a fresh process so the peak RSS
+    increase it reports belongs to that engine only.
+"""
+import argparse
+import multiprocessing
+import os
+import resource
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'app'))
+
+# (width, height) of the synthetic test images per megapixel count
+SIZES = {
+    1: (1200, 900),
+    12: (4000, 3000),
+    24: (6000, 4000),
+    100: (12000, 8400),
+}
+
+# recommended values that make every stage of the chain do work
+VALUES = (7.5, 6.5, 8.0, 9.0)
+
+
+def synthetic_image(megapixels, seed=0):
+    """
+        synthetic_image: smooth gradients plus texture and noise, so the
+                    metrics and filters behave like on a photo.
+    """
+    import numpy as np
+    import cv2
+    from PIL import Image
+
+    width, height = SIZES[megapixels]
+    rng = np.random.default_rng(seed)
+    small = rng.integers(0, 256, (height // 16 + 1, width // 16 + 1, 3), dtype=np.uint8)
+    image_np = cv2.resize(small, (width, height), interpolation=cv2.INTER_CUBIC)
+    noise = rng.integers(-12, 13, (height, width, 1), dtype=np.int16)
+    image_np = np.clip(image_np.astype(np.int16) + noise, 0, 255).astype(np.uint8)
+    return Image.fromarray(image_np)
+
+
+def reset_peak_rss():
+    # Linux resets the VmHWM high-water mark when 5 is written to clear_refs
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+
+def peak_rss_mb():
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def current_rss_mb():
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return peak_rss_mb()
+
+
+def _run(engine, megapixels, repeat, queue):
+    from utility.adjustments import apply_adjustments_chain, apply_adjustments_fused
+    function = {'chain': apply_adjustments_chain, 'fused': apply_adjustments_fused}[engine]
+
+    image = synthetic_image(megapixels)
+    timings = []
+    peaks = []
+    for _ in range(repeat):
+        reset_peak_rss()
+        baseline_rss = current_rss_mb()
+        start = time.perf_counter()
+        result = function(image, *VALUES)
+        timings.append(time.perf_counter() - start)
+        peaks.append(peak_rss_mb() - baseline_rss)
+        del result
+    queue.put({'engine': engine, 'megapixels': megapixels, 'seconds': min(timings),
+               'peak_rss_mb': min(peaks)})
+
+
+def run_isolated(engine, megapixels, repeat):
+    queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=_run, args=(engine, megapixels, repeat, queue))
+    process.start()
+    result = queue.get()
+    process.join()
+    return result
+
+
+def check_output(megapixels):
+    import numpy as np
+    from utility.adjustments import apply_adjustments_chain, apply_adjustments_fused
+
+    image = synthetic_image(megapixels)
+    reference = np.asarray(apply_adjustments_chain(image, *VALUES), dtype=np.int16)
+    fused = np.asarray(apply_adjustments_fused(image, *VALUES), dtype=np.int16)
+    return int(np.abs(reference - fused).max())
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[12, 24], choices=sorted(SIZES))
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    print(f"{'MP':>4} {'engine':>7} {'seconds':>9} {'peak MB':>9} {'speedup':>8} {'memory':>7} {'max diff':>9}")
+    for megapixels in args.sizes:
+        chain = run_isolated('chain', megapixels, args.repeat)
+        fused = run_isolated('fused', megapixels, args.repeat)
+        max_diff = check_output(megapixels)
+        print(f"{megapixels:>4} {'chain':>7} {chain['seconds']:>9.3f} {chain['peak_rss_mb']:>9.1f}")
+        print(f"{megapixels:>4} {'fused':>7} {fused['seconds']:>9.3f} {fused['peak_rss_mb']:>9.1f} "
+              f"{chain['seconds'] / fused['seconds']:>7.2f}x "
+              f"{fused['peak_rss_mb'] / max(chain['peak_rss_mb'], 1e-9):>6.0%} {max_diff:>9}")
+
+
+if __name__ == "__main__":
+    main()
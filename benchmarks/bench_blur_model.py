@@ -0,0 +1,179 @@
+"""
+    bench_blur_model: latency, size and accuracy of the blur detection
+                models (BlurDetectionModel 'cnn' and the depthwise separable
+                'fast' variant, each as float, int8, TorchScript and ONNX)
+                against the Laplacian variance detect_blur of the pipeline.
+
+    Usage:
+        python benchmarks/bench_blur_model.py
+        python benchmarks/bench_blur_model.py --root ../Dataset_blurred --blurry-class blurry --epochs 5
+
+    Without --root a synthetic set is made: random shapes and texture, half
+    of the images blurred with a random 5x5 average, Gaussian or median
+    filter (as in Experiments/Training_data.ipynb). With --root, the
+    ImageFolder layout is read and --blurry-class names the blurry folder.
+    Each architecture is trained for --epochs on 80% of the images and
+    scored on the rest; detect_blur calls an image blurry below the
+    pipeline's BLUR_THRESHOLD, on the full size image. 'batch 1' is the
+    median latency of one image, 'batch 16' the throughput of batches.
+"""
+import argparse
+import io
+import os
+import sys
+import tempfile
+import time
+import warnings
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'app'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Models'))
+
+
+def synthetic_set(count, width=640, height=480, seed=0):
+    import numpy as np
+    import cv2
+
+    rng = np.random.default_rng(seed)
+    images, labels = [], []
+    for index in range(count):
+        image = np.full((height, width, 3), rng.integers(0, 255, 3), dtype=np.uint8)
+        for _ in range(12):
+            color = tuple(int(value) for value in rng.integers(0, 255, 3))
+            x, y = int(rng.integers(0, width)), int(rng.integers(0, height))
+            if rng.random() < 0.5:
+                cv2.circle(image, (x, y), int(rng.integers(10, 120)), color, -1)
+            else:
+                cv2.rectangle(image, (x, y), (x + int(rng.integers(10, 200)), y + int(rng.integers(10, 200))),
+                              color, -1)
+        image = np.clip(image + rng.normal(0, 6, image.shape), 0, 255).astype(np.uint8)
+        blurry = index % 2
+        if blurry:
+            kind = rng.integers(0, 3)
+            image = (cv2.blur(image, (5, 5)) if kind == 0 else cv2.GaussianBlur(image, (5, 5), 0) if kind == 1
+                     else cv2.medianBlur(image, 5))
+        images.append(image)
+        labels.append(blurry)
+    return images, labels
+
+
+def folder_set(root, blurry_class):
+    import numpy as np
+    from PIL import Image
+    from shard_dataset import find_images
+
+    classes, samples = find_images(root)
+    if blurry_class not in classes:
+        raise SystemExit(f"--blurry-class {blurry_class!r} is not one of {classes}")
+    images = []
+    for path, _ in samples:
+        with Image.open(path) as image:
+            images.append(np.asarray(image.convert('RGB')))
+    return images, [int(classes[label] == blurry_class) for _, label in samples]
+
+
+def train(model, inputs, labels, epochs, lr, batch_size=16, seed=0):
+    import torch
+    from torch import nn, optim
+
+    torch.manual_seed(seed)
+    targets = torch.tensor(labels, dtype=torch.float32).unsqueeze(1)
+    optimizer = optim.Adam(model.parameters(), lr=lr)
+    criterion = nn.BCELoss()
+    model.train()
+    for _ in range(epochs):
+        order = torch.randperm(len(inputs))
+        for start in range(0, len(inputs), batch_size):
+            batch = order[start:start + batch_size]
+            optimizer.zero_grad()
+            loss = criterion(model(inputs[batch]), targets[batch])
+            loss.backward()
+            optimizer.step()
+    return model.eval()
+
+
+def latency(function, inputs, repeat):
+    import numpy as np
+
+    timings = []
+    for index in range(repeat):
+        start = time.perf_counter()
+        function(inputs[index % len(inputs)])
+        timings.append(time.perf_counter() - start)
+    return float(np.median(timings))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--root', help="ImageFolder dataset, synthetic when not given")
+    parser.add_argument('--blurry-class', default='blurry', help="class folder of the blurry images")
+    parser.add_argument('--images', type=int, default=320, help="synthetic images")
+    parser.add_argument('--epochs', type=int, default=10)
+    parser.add_argument('--lr', type=float, default=0.01, help="Adam learning rate")
+    parser.add_argument('--threshold', type=float, default=0.5, help="score at or above which a model says blurry")
+    parser.add_argument('--repeat', type=int, default=30, help="timed runs per latency")
+    args = parser.parse_args()
+    # deprecation notices of torch.jit and the quantized tensors
+    warnings.filterwarnings('ignore', category=FutureWarning)
+    warnings.filterwarnings('ignore', category=UserWarning)
+
+    import numpy as np
+    import torch
+    from PIL import Image
+    from blur_detection_model import ARCHITECTURES, quantize_dynamic
+    from export_model import export_onnx, export_torchscript
+    from inference_server import load_model, preprocess
+    from utility.helper import detect_blur
+    from utility.pipeline import BLUR_THRESHOLD
+
+    images, labels = (folder_set(args.root, args.blurry_class) if args.root
+                      else synthetic_set(args.images))
+    order = np.random.default_rng(0).permutation(len(images))
+    split = int(0.8 * len(images))
+    train_index, test_index = order[:split], order[split:]
+    tensors = torch.stack([torch.from_numpy(preprocess(Image.fromarray(image))) for image in images])
+    labels = np.asarray(labels)
+    test_inputs, test_labels = tensors[test_index], labels[test_index]
+    singles = [test_inputs[index:index + 1] for index in range(len(test_inputs))]
+    batches = [test_inputs[start:start + 16] for start in range(0, len(test_inputs) - 15, 16)] or [test_inputs]
+    print(f"{len(train_index)} training and {len(test_index)} test images, {labels.mean():.0%} blurry")
+
+    print(f"{'model':>16} {'params':>8} {'size KB':>8} {'batch 1 ms':>10} {'batch 16 img/s':>14} {'accuracy':>8}")
+    with tempfile.TemporaryDirectory() as scratch:
+        for architecture, model_class in ARCHITECTURES.items():
+            start = time.perf_counter()
+            model = train(model_class(), tensors[train_index], labels[train_index].tolist(), args.epochs,
+                          args.lr)
+            print(f"  ({architecture} trained in {time.perf_counter() - start:.1f}s)")
+            params = sum(parameter.numel() for parameter in model.parameters())
+            buffer = io.BytesIO()
+            torch.save(model.state_dict(), buffer)
+
+            quantized = quantize_dynamic(model)
+            quantized_buffer = io.BytesIO()
+            torch.save(quantized.state_dict(), quantized_buffer)
+            script_path = export_torchscript(model, os.path.join(scratch, f'{architecture}.pt'))
+            onnx_path = export_onnx(model, os.path.join(scratch, f'{architecture}.onnx'))
+            variants = [
+                (architecture, model, len(buffer.getvalue())),
+                (f'{architecture}-int8', quantized, len(quantized_buffer.getvalue())),
+                (f'{architecture}-script', load_model(weights_path=script_path), os.path.getsize(script_path)),
+                (f'{architecture}-onnx', load_model(weights_path=onnx_path), os.path.getsize(onnx_path)),
+            ]
+            for name, variant, size in variants:
+                with torch.inference_mode():
+                    scores = torch.cat([variant(batch) for batch in torch.split(test_inputs, 16)]).reshape(-1)
+                    accuracy = float(((scores.numpy() >= args.threshold) == test_labels).mean())
+                    single = latency(variant, singles, args.repeat)
+                    batched = 16 / latency(variant, batches, max(3, args.repeat // 4))
+                print(f"{name:>16} {params:>8} {size / 1024:>8.0f} {single * 1000:>10.2f} {batched:>14.1f} "
+                      f"{accuracy:>8.1%}")
+
+    test_images = [images[index] for index in test_index]
+    accuracy = float(((np.array([detect_blur(image) for image in test_images]) < BLUR_THRESHOLD)
+                      == test_labels).mean())
+    single = latency(detect_blur, test_images, args.repeat)
+    print(f"{'laplacian':>16} {'-':>8} {'-':>8} {single * 1000:>10.2f} {1 / single:>14.1f} {accuracy:>8.1%}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+"""
+    bench_dataset: DataLoader throughput of the folder-of-JPEGs training
+                input (ImageFolder + Resize((224, 224)) + ToTensor) against
+                the packed, memory mapped shards of Models/shard_dataset.py.
+
+    Usage:
+        python benchmarks/bench_dataset.py
+        python benchmarks/bench_dataset.py --root ../Dataset_blurred/train --workers 0 4 --epochs 3
+
+    Without --root a synthetic ImageFolder of --images JPEGs of
+    --source-size is written to a temporary folder. Both loaders go
+    through every image --epochs times per worker count (shuffled, like
+    training); the table shows the best epoch in images per second. The
+    one-off packing time is printed first.
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Models'))
+
+
+def synthetic_folder(directory, images, width, height):
+    import numpy as np
+    from PIL import Image
+
+    rng = np.random.default_rng(0)
+    base = rng.integers(0, 255, (height // 8, width // 8, 3), dtype=np.uint8)
+    for index in range(images):
+        label = 'blurry' if index % 2 else 'sharp'
+        os.makedirs(os.path.join(directory, label), exist_ok=True)
+        image = Image.fromarray(np.roll(base, index, axis=1)).resize((width, height), Image.BICUBIC)
+        image.save(os.path.join(directory, label, f'image_{index:05d}.jpg'), quality=90)
+
+
+def epoch_rate(dataset, workers, batch_size, epochs):
+    import torch
+    from torch.utils.data import DataLoader
+
+    loader = DataLoader(dataset, batch_size=batch_size, shuffle=True, num_workers=workers,
+                        persistent_workers=workers > 0, generator=torch.Generator().manual_seed(0))
+    rates = []
+    for _ in range(epochs):
+        start = time.perf_counter()
+        count = 0
+        for images, labels in loader:
+            count += len(labels)
+        rates.append(count / (time.perf_counter() - start))
+    return max(rates)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--root', help="ImageFolder dataset, synthetic when not given")
+    parser.add_argument('--images', type=int, default=512, help="synthetic images")
+    parser.add_argument('--source-size', type=int, nargs=2, default=[1024, 768], metavar=('W', 'H'))
+    parser.add_argument('--workers', type=int, nargs='+', default=[0, 2])
+    parser.add_argument('--batch-size', type=int, default=32)
+    parser.add_argument('--epochs', type=int, default=2)
+    args = parser.parse_args()
+
+    from torchvision import datasets, transforms
+    from shard_dataset import ShardedImageDataset, pack
+
+    scratch = tempfile.mkdtemp(prefix='bench_dataset_')
+    try:
+        root = args.root
+        if root is None:
+            root = os.path.join(scratch, 'folder')
+            synthetic_folder(root, args.images, *args.source_size)
+
+        start = time.perf_counter()
+        pack(root, os.path.join(scratch, 'packed'), log=lambda line: None)
+        packing = time.perf_counter() - start
+        loaders = {
+            'folder': datasets.ImageFolder(root, transform=transforms.Compose([
+                transforms.Resize((224, 224)), transforms.ToTensor()])),
+            'shards': ShardedImageDataset(os.path.join(scratch, 'packed')),
+        }
+        count = len(loaders['shards'])
+        print(f"{count} images packed in {packing:.1f}s ({count / packing:.1f} images/s, once)")
+
+        print(f"{'workers':>7} {'loader':>7} {'images/s':>9} {'speedup':>8}")
+        for workers in args.workers:
+            baseline = None
+            for name, dataset in loaders.items():
+                rate = epoch_rate(dataset, workers, args.batch_size, args.epochs)
+                baseline = baseline or rate
+                print(f"{workers:>7} {name:>7} {rate:>9.1f} {rate / baseline:>7.1f}x")
+    finally:
+        shutil.rmtree(scratch)
+
+
+if __name__ == "__main__":
+    main()
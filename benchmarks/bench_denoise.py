@@ -0,0 +1,60 @@
+"""
+    bench_denoise: speed and quality of every denoiser tier against the
+                current full NLM output (remove_noise) and the clean image.
+
+    Usage:
+        python benchmarks/bench_denoise.py
+        python benchmarks/bench_denoise.py --sizes 1 12 --sigmas 3 8 15
+
+    A clean synthetic image gets Gaussian noise of each sigma (per channel,
+    8-bit levels). For every tier the table shows the run time, PSNR/SSIM
+    against the NLM output the pipeline produced so far, and PSNR/SSIM
+    against the clean image. The 'selected' column marks the tier the
+    default tier settings would pick for that noise level.
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'app'))
+
+from bench_adjustments import SIZES, synthetic_image
+
+
+def main():
+    import numpy as np
+    import cv2
+    from utility.analysis import analyze_image
+    from utility.denoise import DENOISERS, DEFAULT_DENOISE, select_denoiser
+    from utility.quality import psnr, ssim
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1], choices=sorted(SIZES))
+    parser.add_argument('--sigmas', type=float, nargs='+', default=[3, 8, 15])
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    print(f"{'MP':>4} {'sigma':>6} {'est.':>6} {'denoiser':>11} {'seconds':>8} "
+          f"{'PSNR/nlm':>9} {'SSIM/nlm':>9} {'PSNR/clean':>11} {'SSIM/clean':>11} selected")
+    for megapixels in args.sizes:
+        clean = cv2.GaussianBlur(np.asarray(synthetic_image(megapixels)), (0, 0), 1.5)
+        for sigma in args.sigmas:
+            noisy = np.clip(clean + rng.normal(0, sigma, clean.shape), 0, 255).astype(np.uint8)
+            estimate = analyze_image(noisy).noise_sigma
+            selected = select_denoiser(estimate, dict(DEFAULT_DENOISE, mode='tiered'))
+
+            results = {}
+            for name, function in DENOISERS.items():
+                start = time.perf_counter()
+                results[name] = (function(noisy, estimate), time.perf_counter() - start)
+            reference = results['nlm'][0]
+            for name, (output, seconds) in results.items():
+                print(f"{megapixels:>4} {sigma:>6.1f} {estimate:>6.2f} {name:>11} {seconds:>8.3f} "
+                      f"{psnr(reference, output):>9.2f} {ssim(reference, output):>9.4f} "
+                      f"{psnr(clean, output):>11.2f} {ssim(clean, output):>11.4f} "
+                      f"{'*' if name == selected else ''}")
+
+
+if __name__ == "__main__":
+    main()
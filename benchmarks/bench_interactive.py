@@ -0,0 +1,76 @@
+"""
+    bench_interactive: slider latency of the interactive mode, the stage
+                graph of utility/stage_graph.py, at 12MP and 24MP.
+
+    Usage:
+        python benchmarks/bench_interactive.py
+        python benchmarks/bench_interactive.py --sizes 24 100 --moves 10
+
+    For every slider, --moves values are set one after the other and the
+    proxy is rendered after each move, as a Streamlit rerun does; the table
+    shows the median and worst time per move and the stages the move
+    recomputed. 'rerender' is what a move cost without the graph:
+    apply_adjustments and the JPEG encode on the full resolution image
+    (decode, analysis and denoising not counted). The first render (the
+    screen proxy) and the full resolution commit are timed once.
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'app'))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from bench_adjustments import SIZES, VALUES, synthetic_image
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[12, 24], choices=sorted(SIZES),
+                        help="megapixels of the synthetic image")
+    parser.add_argument('--moves', type=int, default=6, help="slider positions per slider")
+    args = parser.parse_args()
+
+    import numpy as np
+    from utility.helper import apply_adjustments
+    from utility.image_io import encode
+    from utility.stage_graph import ADJUSTMENT_STAGES, adjustment_graph, set_adjustments
+
+    recommended = dict(zip(ADJUSTMENT_STAGES, VALUES))
+    positions = np.linspace(2.0, 9.5, args.moves)
+    print(f"{'size':>5} {'slider':>11} {'median ms':>10} {'worst ms':>9}  recomputed")
+    for megapixels in args.sizes:
+        restored = np.asarray(synthetic_image(megapixels))
+        graph = adjustment_graph(restored, recommended, {})
+        start = time.perf_counter()
+        graph.get('display')
+        print(f"{megapixels:>4}M {'first':>11} {(time.perf_counter() - start) * 1000:>10.1f} {'':>9}  "
+              f"proxy {graph.get('proxy').shape[1]}x{graph.get('proxy').shape[0]}")
+
+        values = dict(recommended)
+        for name in ADJUSTMENT_STAGES:
+            timings, recomputed = [], set()
+            for position in positions:
+                values[name] = float(position)
+                runs = dict(graph.runs)
+                set_adjustments(graph, values)
+                start = time.perf_counter()
+                graph.get('display')
+                timings.append(time.perf_counter() - start)
+                recomputed.update(stage for stage in graph.runs if graph.runs[stage] != runs.get(stage, 0))
+            print(f"{megapixels:>4}M {name:>11} {np.median(timings) * 1000:>10.1f} {max(timings) * 1000:>9.1f}  "
+                  f"{', '.join(stage for stage in ADJUSTMENT_STAGES + ('display',) if stage in recomputed)}")
+
+        start = time.perf_counter()
+        encode(apply_adjustments(restored, *(values[name] for name in ADJUSTMENT_STAGES)))
+        print(f"{megapixels:>4}M {'rerender':>11} {(time.perf_counter() - start) * 1000:>10.1f} {'':>9}  "
+              f"full resolution, every stage")
+        graph.set('full', **values)
+        start = time.perf_counter()
+        graph.get('full')
+        print(f"{megapixels:>4}M {'commit':>11} {(time.perf_counter() - start) * 1000:>10.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+"""
+    bench_io: decode -> array -> adjust -> encode, the way the app did it
+            (Image.open, np.array, Image.fromarray, BytesIO) against the
+            utility.image_io layer.
+
+    Usage:
+        python benchmarks/bench_io.py
+        python benchmarks/bench_io.py --sizes 12 24 100 --repeat 3
+
+    Every (path, size) pair runs in a fresh process. Both paths also run
+    the in-place deblur filter, so the array has to be writable. The
+    'frames' column is the peak RSS increase divided by the size of one
+    RGB frame (W x H x 3 bytes): how many full size copies were alive at
+    the same time. The input is a JPEG of the synthetic image.
+"""
+import argparse
+import io
+import multiprocessing
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'app'))
+
+from bench_adjustments import SIZES, VALUES, synthetic_image, reset_peak_rss, peak_rss_mb, current_rss_mb
+
+
+def legacy_path(image_bytes):
+    import numpy as np
+    from PIL import Image
+    from utility.helper import remove_blur, apply_adjustments
+
+    image = Image.open(io.BytesIO(image_bytes))
+    image_np = np.array(image)
+    remove_blur(image_np, out=image_np)
+    adjusted_image = apply_adjustments(Image.fromarray(image_np), *VALUES)
+    buffer = io.BytesIO()
+    adjusted_image.save(buffer, format='JPEG', quality=75)
+    return buffer.getvalue()
+
+
+def streamed_path(image_bytes):
+    from utility.helper import remove_blur, apply_adjustments
+    from utility.image_io import decode, encode, to_array
+
+    image, metadata = decode(image_bytes)
+    image_np = to_array(image)
+    del image
+    remove_blur(image_np, out=image_np)
+    adjusted_image = apply_adjustments(image_np, *VALUES)
+    return encode(adjusted_image, metadata=metadata)
+
+
+PATHS = {'legacy': legacy_path, 'image_io': streamed_path}
+
+
+def _run(path, megapixels, repeat, queue):
+    buffer = io.BytesIO()
+    synthetic_image(megapixels).save(buffer, format='JPEG', quality=95)
+    image_bytes = buffer.getvalue()
+    del buffer
+
+    timings = []
+    peaks = []
+    for _ in range(repeat):
+        reset_peak_rss()
+        baseline_rss = current_rss_mb()
+        start = time.perf_counter()
+        output = PATHS[path](image_bytes)
+        timings.append(time.perf_counter() - start)
+        peaks.append(peak_rss_mb() - baseline_rss)
+        del output
+    queue.put({'seconds': min(timings), 'peak_rss_mb': min(peaks)})
+
+
+def run_isolated(path, megapixels, repeat):
+    queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=_run, args=(path, megapixels, repeat, queue))
+    process.start()
+    result = queue.get()
+    process.join()
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[12, 24], choices=sorted(SIZES))
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    print(f"{'MP':>4} {'path':>9} {'seconds':>9} {'peak MB':>9} {'frames':>7}")
+    for megapixels in args.sizes:
+        width, height = SIZES[megapixels]
+        frame_mb = width * height * 3 / (1024 * 1024)
+        for path in PATHS:
+            result = run_isolated(path, megapixels, args.repeat)
+            print(f"{megapixels:>4} {path:>9} {result['seconds']:>9.3f} {result['peak_rss_mb']:>9.1f} "
+                  f"{result['peak_rss_mb'] / frame_mb:>7.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,266 @@
+"""
+    bench_pipeline: time every pipeline stage at several resolutions and
+                compare against a stored baseline.
+
+    Usage:
+        python benchmarks/bench_pipeline.py --sizes 1 12 --json results.json
+        python benchmarks/bench_pipeline.py --samples ../Dataset/samples/*.jpg
+        python benchmarks/bench_pipeline.py --save-baseline benchmarks/baseline.json
+        python benchmarks/bench_pipeline.py --baseline benchmarks/baseline.json --threshold 0.15
+
+    Stages: decode, get_image_metrics, detect_noise, detect_blur,
+    remove_noise, remove_blur, apply_adjustments and encode (JPEG). Every
+    image runs in a fresh process. For each stage the best and median time
+    of --repeat runs are kept, together with the peak RSS increase (Linux
+    VmHWM) and the peak of allocations traced by tracemalloc in one extra,
+    untimed run (numpy buffers are traced, OpenCV/Pillow internals are not).
+
+    With --baseline, a stage whose best time (or peak RSS) grows by more
+    than --threshold is a regression and the exit code is 1. Stages faster
+    than --min-seconds are not timed against the baseline and peak RSS
+    must also grow by more than --min-rss-mb, smaller changes are mostly
+    noise.
+"""
+import argparse
+import io
+import json
+import multiprocessing
+import os
+import platform
+import statistics
+import sys
+import time
+import tracemalloc
+from queue import Empty
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'app'))
+
+from bench_adjustments import SIZES, VALUES, synthetic_image, reset_peak_rss, peak_rss_mb, current_rss_mb
+
+STAGES = ['decode', 'get_image_metrics', 'detect_noise', 'detect_blur',
+          'remove_noise', 'remove_blur', 'apply_adjustments', 'encode']
+JPEG_QUALITY = 75
+
+
+def release_memory():
+    # hand freed heap back to the OS so the next peak starts from the floor
+    import ctypes
+    import gc
+
+    gc.collect()
+    try:
+        ctypes.CDLL('libc.so.6').malloc_trim(0)
+    except (OSError, AttributeError):
+        pass
+
+
+def stage_functions():
+    """
+        stage_functions: stage name -> function(state) for every stage;
+                    state holds the encoded bytes, the decoded image and
+                    its array.
+    """
+    from PIL import Image
+    from utility.helper import (get_image_metrics, detect_noise, detect_blur,
+                                remove_noise, remove_blur, apply_adjustments)
+
+    def decode(state):
+        with Image.open(io.BytesIO(state['bytes'])) as image:
+            return image.convert('RGB')
+
+    def encode(state):
+        buffer = io.BytesIO()
+        state['image'].save(buffer, format='JPEG', quality=JPEG_QUALITY)
+        return buffer.getvalue()
+
+    return {
+        'decode': decode,
+        'get_image_metrics': lambda state: get_image_metrics(state['image']),
+        'detect_noise': lambda state: detect_noise(state['array']),
+        'detect_blur': lambda state: detect_blur(state['array']),
+        'remove_noise': lambda state: remove_noise(state['array']),
+        'remove_blur': lambda state: remove_blur(state['array']),
+        'apply_adjustments': lambda state: apply_adjustments(state['image'], *VALUES),
+        'encode': encode,
+    }
+
+
+def load_input(source):
+    """
+        load_input: (name, encoded bytes) of a synthetic size (int, in
+                    megapixels) or a sample image path.
+    """
+    if isinstance(source, int):
+        buffer = io.BytesIO()
+        synthetic_image(source).save(buffer, format='JPEG', quality=95)
+        return f'synthetic-{source}MP', buffer.getvalue()
+    with open(source, 'rb') as f:
+        return os.path.basename(source), f.read()
+
+
+def _bench_input(source, stages, repeat, queue):
+    import numpy as np
+    from PIL import Image
+
+    name, image_bytes = load_input(source)
+    functions = stage_functions()
+    with Image.open(io.BytesIO(image_bytes)) as image:
+        image = image.convert('RGB')
+    state = {'bytes': image_bytes, 'image': image, 'array': np.asarray(image)}
+    megapixels = image.width * image.height / 1e6
+
+    results = []
+    for stage in stages:
+        function = functions[stage]
+        timings = []
+        peaks = []
+        for _ in range(repeat):
+            release_memory()
+            reset_peak_rss()
+            baseline_rss = current_rss_mb()
+            start = time.perf_counter()
+            result = function(state)
+            timings.append(time.perf_counter() - start)
+            peaks.append(peak_rss_mb() - baseline_rss)
+            del result
+        tracemalloc.start()
+        result = function(state)
+        _, traced_peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        del result
+        results.append({
+            'input': name,
+            'megapixels': round(megapixels, 2),
+            'stage': stage,
+            'seconds': min(timings),
+            'seconds_median': statistics.median(timings),
+            'peak_rss_mb': min(peaks),
+            'traced_peak_mb': traced_peak / (1024 * 1024),
+        })
+    queue.put(results)
+
+
+def bench_input(source, stages, repeat):
+    """
+        bench_input: run _bench_input in a fresh process.
+
+        returns:
+            - list of result dictionaries, or None when the process died
+            before reporting (out of memory at the largest sizes), and its
+            exit code
+    """
+    queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=_bench_input, args=(source, stages, repeat, queue))
+    process.start()
+    results = None
+    while results is None:
+        try:
+            results = queue.get(timeout=1.0)
+        except Empty:
+            if not process.is_alive():
+                # a result put just before exiting is still in the pipe
+                try:
+                    results = queue.get(timeout=1.0)
+                except Empty:
+                    break
+    process.join()
+    return results, process.exitcode
+
+
+def environment():
+    import numpy as np
+    import PIL
+    try:
+        import cv2
+        opencv = cv2.__version__
+    except ImportError:
+        opencv = None
+    return {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'machine': platform.machine(),
+        'cpu_count': os.cpu_count(),
+        'numpy': np.__version__,
+        'pillow': PIL.__version__,
+        'opencv': opencv,
+    }
+
+
+def compare(results, baseline, threshold, min_seconds, min_rss_mb):
+    """
+        compare: relative change of every (input, stage) that is in the
+                baseline too.
+
+        returns:
+            - list of (result, baseline result, time change, rss change,
+            regressed)
+    """
+    previous = {(entry['input'], entry['stage']): entry for entry in baseline['results']}
+    rows = []
+    for result in results:
+        before = previous.get((result['input'], result['stage']))
+        if before is None:
+            continue
+        time_change = result['seconds'] / max(before['seconds'], 1e-12) - 1
+        rss_growth = result['peak_rss_mb'] - before['peak_rss_mb']
+        rss_change = rss_growth / max(before['peak_rss_mb'], 1.0)
+        timed = max(result['seconds'], before['seconds']) >= min_seconds
+        regressed = (timed and time_change > threshold) or (rss_growth > min_rss_mb and rss_change > threshold)
+        rows.append((result, before, time_change, rss_change, regressed))
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='*', default=[1, 12], choices=sorted(SIZES))
+    parser.add_argument('--samples', nargs='*', default=[], help='real images to benchmark as well')
+    parser.add_argument('--stages', nargs='+', default=STAGES, choices=STAGES)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--json', help='write the results to this file')
+    parser.add_argument('--baseline', help='results file to compare against')
+    parser.add_argument('--save-baseline', help='write the results as the new baseline')
+    parser.add_argument('--threshold', type=float, default=0.2, help='allowed relative slowdown (0.2 = 20%%)')
+    parser.add_argument('--min-seconds', type=float, default=0.01)
+    parser.add_argument('--min-rss-mb', type=float, default=32.0)
+    args = parser.parse_args()
+
+    stages = [stage for stage in STAGES if stage in args.stages]
+    results = []
+    print(f"{'input':>20} {'MP':>6} {'stage':>18} {'seconds':>9} {'median':>9} {'peak MB':>8} {'traced MB':>9}")
+    failures = []
+    for source in list(args.sizes) + list(args.samples):
+        input_results, exitcode = bench_input(source, stages, args.repeat)
+        if input_results is None:
+            failures.append({'input': str(source), 'exitcode': exitcode})
+            print(f"{str(source)[:20]:>20} FAILED: benchmark process exited with code {exitcode}")
+            continue
+        for result in input_results:
+            results.append(result)
+            print(f"{result['input'][:20]:>20} {result['megapixels']:>6.1f} {result['stage']:>18} "
+                  f"{result['seconds']:>9.4f} {result['seconds_median']:>9.4f} "
+                  f"{result['peak_rss_mb']:>8.1f} {result['traced_peak_mb']:>9.1f}")
+
+    report = {'environment': environment(), 'repeat': args.repeat, 'results': results, 'failures': failures}
+    for path in (args.json, args.save_baseline):
+        if path:
+            with open(path, 'w') as f:
+                json.dump(report, f, indent=2)
+
+    if not args.baseline:
+        return 1 if failures else 0
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    rows = compare(results, baseline, args.threshold, args.min_seconds, args.min_rss_mb)
+    print(f"\ncompared with {args.baseline} (threshold {args.threshold:.0%})")
+    print(f"{'input':>20} {'stage':>18} {'before':>9} {'after':>9} {'time':>8} {'rss':>8}")
+    for result, before, time_change, rss_change, regressed in rows:
+        print(f"{result['input'][:20]:>20} {result['stage']:>18} {before['seconds']:>9.4f} "
+              f"{result['seconds']:>9.4f} {time_change:>+8.1%} {rss_change:>+8.1%}"
+              f"{'  REGRESSION' if regressed else ''}")
+    regressions = sum(row[-1] for row in rows)
+    print(f"{regressions} regression(s) in {len(rows)} compared stage(s)")
+    return 1 if regressions or failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
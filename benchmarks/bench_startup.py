@@ -0,0 +1,128 @@
+"""
+    bench_startup: cold start of the entry points, measured in fresh
+                interpreters: how long their imports take and which heavy
+                modules (cv2, torch, torchvision, onnxruntime, mlflow,
+                fastapi) they load.
+
+    Usage:
+        python benchmarks/bench_startup.py
+        python benchmarks/bench_startup.py --repeat 9 --top 10
+
+    'ui' is what app/main.py imports before the first upload, 'ui eager' the
+    imports it did up front before they were deferred (the processing
+    modules and OpenCV). 'inference onnx' is Models/inference.py on an
+    exported ONNX model, 'inference eager' the torch and torchvision
+    imports inference_server.py used to make on every start. The table
+    shows the median of --repeat processes after a warm-up one; --top prints the slowest
+    imports of each entry point from python -X importtime. The last lines
+    time load_thresholds: parsing the yaml once against a cached rerun.
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+APP = os.path.join(ROOT, 'app')
+MODELS = os.path.join(ROOT, 'Models')
+sys.path.insert(0, APP)
+
+HEAVY = ('cv2', 'torch', 'torchvision', 'onnxruntime', 'mlflow', 'fastapi')
+
+ENTRY_POINTS = {
+    'ui': "import streamlit; from utility import cache, config, image_io, profiling",
+    'ui eager': "import streamlit, yaml, cv2; from utility import cache, image_io, profiling, helper, pipeline",
+    'pipeline': "from utility import pipeline",
+    'service': "import service",
+    'inference onnx': "import inference, export_model",
+    'inference eager': "import inference, torch, torchvision.transforms, blur_detection_model",
+}
+
+PROBE = """
+import sys, time, json
+start = time.perf_counter()
+{imports}
+seconds = time.perf_counter() - start
+print(json.dumps({{'seconds': seconds, 'heavy': [name for name in {heavy!r} if name in sys.modules]}}))
+"""
+
+
+def environment():
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(path for path in (APP, MODELS, env.get('PYTHONPATH')) if path)
+    env['PYTHONWARNINGS'] = 'ignore'
+    return env
+
+
+def measure(imports, env):
+    """
+        measure: import time of one fresh interpreter and the heavy
+                modules it ended up loading, None when the imports fail
+                (e.g. a package that is not installed).
+    """
+    start = time.perf_counter()
+    result = subprocess.run([sys.executable, '-c', PROBE.format(imports=imports, heavy=HEAVY)], cwd=APP, env=env,
+                            capture_output=True, text=True)
+    total = time.perf_counter() - start
+    if result.returncode != 0:
+        return None
+    probe = json.loads(result.stdout.strip().splitlines()[-1])
+    return probe['seconds'], total, probe['heavy']
+
+
+def slowest_imports(imports, env, top):
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', imports], cwd=APP, env=env,
+                            capture_output=True, text=True)
+    rows = []
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        # top level packages only, their cumulative time includes the rest
+        if not name.startswith('  ') and '.' not in name.strip():
+            rows.append((int(cumulative), name.strip()))
+    return sorted(rows, reverse=True)[:top]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--repeat', type=int, default=5, help="fresh processes per entry point")
+    parser.add_argument('--top', type=int, default=0, help="slowest top level imports to list per entry point")
+    parser.add_argument('--config', default=os.path.join(APP, 'config', 'thersholds.yaml'))
+    args = parser.parse_args()
+
+    import numpy as np
+
+    env = environment()
+    print(f"{'entry point':>16} {'import ms':>10} {'process ms':>11}  heavy modules")
+    for name, imports in ENTRY_POINTS.items():
+        # one discarded run, so every entry point starts from a warm disk cache
+        runs = [measure(imports, env) for _ in range(args.repeat + 1)][1:]
+        if None in runs:
+            print(f"{name:>16} {'failed (missing package?)':>23}")
+            continue
+        imported = float(np.median([run[0] for run in runs]))
+        total = float(np.median([run[1] for run in runs]))
+        print(f"{name:>16} {imported * 1000:>10.1f} {total * 1000:>11.1f}  {', '.join(runs[0][2]) or '-'}")
+        for cumulative, module in slowest_imports(imports, env, args.top):
+            print(f"{'':>16} {cumulative / 1000:>10.1f}  {module}")
+
+    import yaml
+    from utility.config import load_thresholds
+
+    start = time.perf_counter()
+    with open(args.config, 'r') as f:
+        yaml.safe_load(f)
+    parsed = time.perf_counter() - start
+    load_thresholds(args.config)
+    start = time.perf_counter()
+    for _ in range(1000):
+        load_thresholds(args.config)
+    cached = (time.perf_counter() - start) / 1000
+    print(f"load_thresholds: {parsed * 1000:.2f} ms parsing the yaml, {cached * 1e6:.1f} us per cached load")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,132 @@
+"""
+    bench_video: frame-stream mode (utility/video.py) against enhancing every
+                frame on its own, on a synthetic clip.
+
+    Usage:
+        python benchmarks/bench_video.py
+        python benchmarks/bench_video.py --frames 150 --scenes 5 --workers 1 2 4 --fast
+
+    The clip pans over --scenes synthetic images of different exposure, with
+    fresh noise on every frame, written as mp4v. 'per frame' decodes the
+    clip and runs analysis, recommendation, restore, adjustments and the
+    JPEG encode on every frame in turn, as calling the pipeline per frame
+    does. 'stream' is run_stream with each --workers count, writing JPEG
+    frames. flicker is the mean change of the recommended values between
+    two frames of the same scene (0-10 scale): the analysis of every frame
+    jitters with the noise, the stream's values only move after a re-analysis,
+    and smoothly.
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'app'))
+
+RESOLUTIONS = {
+    '480': (854, 480),
+    '720': (1280, 720),
+    '1080': (1920, 1080)
+}
+
+
+def synthetic_clip(path, frames, scenes, size, seed=0):
+    """
+        synthetic_clip: write a clip of scenes panning over smooth textures,
+                    each scene at its own exposure, to path.
+
+        returns:
+            - the scene index of every frame
+    """
+    import cv2
+    import numpy as np
+
+    width, height = size
+    rng = np.random.default_rng(seed)
+    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*'mp4v'), 25.0, (width, height))
+    scene_of = []
+    per_scene = -(-frames // scenes)
+    for scene in range(scenes):
+        small = rng.integers(0, 256, (height // 12 + 1, int(width * 1.5) // 12 + 1, 3), dtype=np.uint8)
+        base = cv2.resize(small, (int(width * 1.5), height), interpolation=cv2.INTER_CUBIC).astype(np.float32)
+        # exposure and gamma of the scene, so a cut moves the histogram
+        gamma = (0.5, 1.0, 2.0, 0.7, 1.4)[scene % 5]
+        base = 255 * (base / 255) ** gamma * (0.6 + 0.4 * (scene % 3) / 2)
+        for step in range(min(per_scene, frames - len(scene_of))):
+            left = int((base.shape[1] - width) * step / per_scene)
+            frame = base[:, left:left + width] + rng.normal(0, 3, (height, width, 3))
+            writer.write(np.clip(frame, 0, 255).astype(np.uint8))
+            scene_of.append(scene)
+    writer.release()
+    return scene_of
+
+
+def flicker(values, scene_of):
+    # mean absolute change of the recommended values within scenes
+    import numpy as np
+
+    changes = [np.mean([abs(current[name] - previous[name]) for name in current])
+               for previous, current, same in zip(values, values[1:],
+                                                  (a == b for a, b in zip(scene_of, scene_of[1:])))
+               if same]
+    return float(np.mean(changes)) if changes else 0.0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--frames', type=int, default=90, help="frames in the clip")
+    parser.add_argument('--scenes', type=int, default=3, help="scenes in the clip")
+    parser.add_argument('--size', default='720', choices=sorted(RESOLUTIONS), help="frame height")
+    parser.add_argument('--workers', type=int, nargs='+', default=[os.cpu_count() or 1],
+                        help="worker counts of the stream runs")
+    parser.add_argument('--fast', action='store_true', help="fast path thresholds (no denoising/deblurring)")
+    args = parser.parse_args()
+
+    from utility.config import METRIC_NAMES, load_thresholds
+    from utility.helper import apply_adjustments
+    from utility.image_io import encode, output_settings
+    from utility.pipeline import analyze, recommend, restore
+    from utility.strategies import fast_path_thresholds
+    from utility.video import SceneTracker, frame_histogram, open_frames, run_stream, video_settings
+
+    config = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'app', 'config', 'thersholds.yaml')
+    thresholds = load_thresholds(config)
+    if args.fast:
+        thresholds = fast_path_thresholds(thresholds)
+    settings = video_settings(thresholds)
+
+    with tempfile.TemporaryDirectory() as folder:
+        clip = os.path.join(folder, 'clip.mp4')
+        scene_of = synthetic_clip(clip, args.frames, args.scenes, RESOLUTIONS[args.size])
+        width, height = RESOLUTIONS[args.size]
+        print(f"clip: {len(scene_of)} frames {width}x{height}, {args.scenes} scenes, "
+              f"{'fast path' if args.fast else 'full pipeline'}")
+        print(f"{'mode':>12} {'workers':>7} {'fps':>7} {'sustained':>9} {'analyses':>8} {'flicker':>7}")
+
+        frames, _, _ = open_frames(clip)
+        values, tracked = [], []
+        tracker = SceneTracker(thresholds, settings)
+        start = time.perf_counter()
+        for frame in frames:
+            tracked.append(tracker.update(frame, frame_histogram(frame, settings['detect_max_pixels']))[1])
+            analysis = analyze(frame, thresholds)
+            recommended = recommend(analysis, thresholds)
+            values.append(recommended)
+            restored = restore(frame, analysis, thresholds)
+            encode(apply_adjustments(restored, *(recommended[name] for name in METRIC_NAMES)),
+                   settings=output_settings(thresholds))
+        # the tracker's own analyses are not part of the per frame timing
+        elapsed = time.perf_counter() - start - tracker.analysis_seconds
+        print(f"{'per frame':>12} {1:>7} {len(values) / elapsed:>7.1f} {'':>9} {len(values):>8} "
+              f"{flicker(values, scene_of):>7.3f}")
+
+        for workers in args.workers:
+            summary = run_stream(clip, os.path.join(folder, f'frames_{workers}'), thresholds, workers=workers,
+                                 log=lambda line: None)
+            print(f"{'stream':>12} {workers:>7} {summary['fps']:>7.1f} {summary['sustained_fps']:>9.1f} "
+                  f"{summary['analyses']:>8} {flicker(tracked, scene_of):>7.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+"""
+    load_service: load generator for the HTTP enhancement service.
+
+    Usage:
+        python benchmarks/load_service.py                     # in-process app
+        python benchmarks/load_service.py --url http://localhost:8000 \\
+            --requests 200 --concurrency 16 --size 12
+
+    Sends the same synthetic JPEG --requests times with --concurrency
+    requests in flight and reports requests per second, the status codes
+    (429 shows how much admission control turned away) and the latency
+    percentiles of the successful requests. Without --url the app is served
+    in-process through httpx's ASGI transport, so no server needs to run.
+"""
+import argparse
+import asyncio
+import io
+import os
+import sys
+import time
+from collections import Counter
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'app'))
+
+from bench_adjustments import SIZES, synthetic_image
+
+
+def percentile(values, q):
+    ordered = sorted(values)
+    if not ordered:
+        return float('nan')
+    index = min(len(ordered) - 1, max(0, int(round(q / 100 * (len(ordered) - 1)))))
+    return ordered[index]
+
+
+async def run_load(client, image_bytes, requests, concurrency, multipart):
+    statuses = Counter()
+    latencies = []
+    remaining = iter(range(requests))
+
+    async def one_client():
+        for _ in remaining:
+            start = time.perf_counter()
+            if multipart:
+                response = await client.post('/enhance', files={'file': ('image.jpg', image_bytes, 'image/jpeg')})
+            else:
+                response = await client.post('/enhance', content=image_bytes, headers={'Content-Type': 'image/jpeg'})
+            elapsed = time.perf_counter() - start
+            statuses[response.status_code] += 1
+            if response.status_code == 200:
+                latencies.append(elapsed)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(one_client() for _ in range(concurrency)))
+    return statuses, latencies, time.perf_counter() - start
+
+
+async def main_async(args, image_bytes):
+    import httpx
+
+    timeout = httpx.Timeout(args.timeout)
+    if args.url:
+        async with httpx.AsyncClient(base_url=args.url, timeout=timeout) as client:
+            return await run_load(client, image_bytes, args.requests, args.concurrency, args.multipart)
+
+    from service import create_app
+
+    app = create_app(workers=args.workers, max_queue=args.max_queue, executor=args.executor)
+    # ASGITransport does not run the lifespan, drive it here
+    async with app.router.lifespan_context(app):
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url='http://service', timeout=timeout) as client:
+            return await run_load(client, image_bytes, args.requests, args.concurrency, args.multipart)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--url', help='service to load, the app runs in-process when omitted')
+    parser.add_argument('--requests', type=int, default=50)
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--size', type=int, default=1, choices=sorted(SIZES), help='megapixels of the test image')
+    parser.add_argument('--multipart', action='store_true', help='upload as multipart instead of a raw body')
+    parser.add_argument('--timeout', type=float, default=300.0)
+    parser.add_argument('--workers', type=int, help='in-process app only')
+    parser.add_argument('--max-queue', type=int, default=16, help='in-process app only')
+    parser.add_argument('--executor', choices=('process', 'thread'), default='process', help='in-process app only')
+    args = parser.parse_args()
+
+    buffer = io.BytesIO()
+    synthetic_image(args.size).save(buffer, format='JPEG', quality=90)
+    statuses, latencies, seconds = asyncio.run(main_async(args, buffer.getvalue()))
+
+    print(f"requests      {args.requests} ({args.concurrency} concurrent, {args.size}MP)")
+    print(f"statuses      {', '.join(f'{code}: {count}' for code, count in sorted(statuses.items()))}")
+    print(f"throughput    {args.requests / seconds:.2f} req/s ({statuses[200] / seconds:.2f} ok/s)")
+    for q in (50, 90, 99):
+        print(f"latency p{q:<3}  {percentile(latencies, q) * 1000:.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,8 @@
+import os
+import sys
+
+# The app scripts import `utility.x` and the training scripts their flat
+# siblings, both run from their own folder
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+for folder in ('app', 'Models'):
+    sys.path.insert(0, os.path.join(ROOT, folder))
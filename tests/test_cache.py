@@ -0,0 +1,81 @@
+import numpy as np
+import pytest
+
+from utility.analysis import ImageMetrics
+from utility.cache import CachedResult, ResultCache, cache_key
+
+METRICS = ImageMetrics(saturation=0.4, brightness=0.5, contrast=0.2, sharpness=120.0, blur=120.0, noise=3.0)
+RECOMMENDED = {'saturation': 5.0, 'brightness': 6.0, 'contrast': 4.0, 'sharpness': 7.0}
+
+
+def _entry(key, pixels=100, output=b'jpeg'):
+    restored = np.full((pixels, 1, 1), len(key), dtype=np.uint8)
+    return CachedResult(key, METRICS, RECOMMENDED, restored, output)
+
+
+def test_lru_eviction_by_bytes():
+    # every entry is 100 bytes of array and 4 of output
+    cache = ResultCache(max_bytes=3 * 104)
+    for key in ('a', 'b', 'c'):
+        cache.put(_entry(key))
+    assert cache.get('a') is not None
+    cache.put(_entry('d'))
+    assert cache.get('b') is None
+    for key in ('a', 'c', 'd'):
+        assert cache.get(key) is not None
+    stats = cache.stats()
+    assert stats['evictions'] == 1
+    assert stats['entries'] == 3
+    assert stats['bytes'] == 3 * 104
+
+
+def test_entry_larger_than_cache_is_not_kept():
+    cache = ResultCache(max_bytes=50)
+    cache.put(_entry('a'))
+    assert cache.get('a') is None
+    assert cache.stats()['bytes'] == 0
+
+
+def test_put_makes_arrays_read_only():
+    cache = ResultCache()
+    entry = _entry('a')
+    cache.put(entry)
+    with pytest.raises(ValueError):
+        entry.restored[0] = 1
+
+
+def test_disk_tier_round_trip(tmp_path):
+    entry = _entry('a', output=b'encoded image')
+    ResultCache(disk_dir=str(tmp_path)).put(entry)
+
+    # a new process: empty memory tier, same folder
+    cache = ResultCache(disk_dir=str(tmp_path))
+    loaded = cache.get('a')
+    assert loaded is not None
+    assert np.array_equal(loaded.restored, entry.restored)
+    assert not loaded.restored.flags.writeable
+    assert loaded.output == b'encoded image'
+    assert loaded.recommended == RECOMMENDED
+    assert loaded.metrics.sharpness == METRICS.sharpness
+    assert cache.get('a') is loaded
+    assert cache.stats()['disk_hits'] == 1
+    assert cache.stats()['hits'] == 1
+    assert cache.get('missing') is None
+    assert cache.stats()['misses'] == 1
+
+
+def test_disk_tier_is_trimmed(tmp_path):
+    cache = ResultCache(disk_dir=str(tmp_path), disk_max_bytes=1)
+    cache.put(_entry('a'))
+    assert list(tmp_path.iterdir()) == []
+    # still served from memory
+    assert cache.get('a') is not None
+
+
+def test_cache_key_only_hashes_result_sections():
+    thresholds = {'sharpness': {'low': 50, 'high': 300}, 'profiling': {'enabled': False}}
+    key = cache_key(b'image', thresholds, quality=90)
+    assert cache_key(b'image', dict(thresholds, profiling={'enabled': True}), quality=90) == key
+    assert cache_key(b'image', dict(thresholds, sharpness={'low': 60, 'high': 300}), quality=90) != key
+    assert cache_key(b'image', thresholds, quality=80) != key
+    assert cache_key(b'other', thresholds, quality=90) != key
@@ -0,0 +1,56 @@
+import yaml
+
+from calibrate_thresholds import replace_sections
+
+CONFIG = """\
+# metric thresholds
+saturation:
+  low_threshold: 30
+  high_threshold: 70
+sharpness:
+  low_threshold: 2000
+  # where the recommendation reaches 0
+  upper_bound: 9000
+# how images are analyzed
+analysis:
+  mode: full
+"""
+
+
+def test_replaces_values_and_keeps_comments():
+    text = replace_sections(CONFIG, {'sharpness': {'low_threshold': 1500, 'upper_bound': 8000}})
+    assert yaml.safe_load(text) == {
+        'saturation': {'low_threshold': 30, 'high_threshold': 70},
+        'sharpness': {'low_threshold': 1500, 'upper_bound': 8000},
+        'analysis': {'mode': 'full'},
+    }
+    for comment in ('# metric thresholds', '# where the recommendation reaches 0', '# how images are analyzed'):
+        assert comment in text
+    # the comment after sharpness still comes right before analysis
+    assert text.index('# how images are analyzed') < text.index('analysis:')
+    assert text.index('upper_bound') < text.index('# how images are analyzed')
+
+
+def test_adds_keys_and_sections():
+    text = replace_sections(CONFIG, {'saturation': {'low_threshold': 25, 'high_threshold': 75, 'upper_bound': 200},
+                                     'contrast': {'low_threshold': 40, 'high_threshold': 90}})
+    config = yaml.safe_load(text)
+    assert config['saturation'] == {'low_threshold': 25, 'high_threshold': 75, 'upper_bound': 200}
+    assert config['contrast'] == {'low_threshold': 40, 'high_threshold': 90}
+    assert config['sharpness'] == {'low_threshold': 2000, 'upper_bound': 9000}
+    assert text.startswith('contrast:')
+
+
+def test_drops_keys_not_given():
+    text = replace_sections(CONFIG, {'saturation': {'low_threshold': 10}})
+    assert yaml.safe_load(text)['saturation'] == {'low_threshold': 10}
+
+
+def test_nested_sections_are_dumped_whole():
+    sections = {'analysis': {'mode': 'proxy', 'proxy': {'max_pixels': 100}}}
+    assert yaml.safe_load(replace_sections(CONFIG, sections))['analysis'] == sections['analysis']
+
+
+def test_empty_config():
+    sections = {'saturation': {'low_threshold': 1, 'high_threshold': 2}}
+    assert yaml.safe_load(replace_sections('', sections)) == sections
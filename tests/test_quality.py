@@ -0,0 +1,62 @@
+import math
+
+import cv2
+import numpy as np
+import pytest
+
+from utility.quality import mse, psnr, ssim
+
+
+def _image(size=128):
+    # smooth gradients and edges, SSIM is meaningless on pure noise
+    y, x = np.mgrid[0:size, 0:size]
+    gray = (x * 255 // size).astype(np.uint8)
+    gray[size // 4:size // 2, size // 4:3 * size // 4] = 30
+    return np.dstack([gray, gray[::-1], np.full_like(gray, 128)])
+
+
+def _noisy(image, sigma, seed=0):
+    rng = np.random.default_rng(seed)
+    return np.clip(image + rng.normal(0, sigma, image.shape), 0, 255).astype(np.uint8)
+
+
+def test_psnr_identical_is_inf():
+    image = _image()
+    assert psnr(image, image) == float('inf')
+
+
+def test_psnr_of_known_error():
+    reference = np.zeros((4, 4), dtype=np.uint8)
+    image = np.full((4, 4), 10, dtype=np.uint8)
+    assert mse(reference, image) == 100
+    assert psnr(reference, image) == pytest.approx(10 * math.log10(255 ** 2 / 100))
+
+
+def test_psnr_drops_with_noise():
+    image = _image()
+    assert psnr(image, _noisy(image, 5)) > psnr(image, _noisy(image, 20))
+
+
+def test_ssim_identical_is_one():
+    image = _image()
+    assert ssim(image, image) == pytest.approx(1.0, abs=1e-6)
+
+
+def test_ssim_is_symmetric_and_orders_distortions():
+    image = _image()
+    light, heavy = _noisy(image, 5), _noisy(image, 25)
+    assert ssim(image, light) == pytest.approx(ssim(light, image), abs=1e-6)
+    assert 1 > ssim(image, light) > ssim(image, heavy) > 0
+
+
+def test_ssim_sees_blur():
+    image = _image()
+    assert ssim(image, cv2.GaussianBlur(image, (9, 9), 3)) < 0.99
+
+
+def test_ssim_max_pixels_downscales():
+    image = _image(256)
+    noisy = _noisy(image, 20)
+    # fine noise is averaged away on the downscaled images
+    assert ssim(image, noisy, max_pixels=64 * 64) > ssim(image, noisy)
+    assert ssim(image, noisy, max_pixels=256 * 256) == ssim(image, noisy)
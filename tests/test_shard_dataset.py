@@ -0,0 +1,100 @@
+import pickle
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from shard_dataset import ShardedImageDataset, load_resized, pack, read_index
+
+SIZE = 16
+
+
+def _write(root, name, label, color):
+    folder = root / label
+    folder.mkdir(parents=True, exist_ok=True)
+    path = folder / name
+    # PNG, so the pixels read back exactly
+    Image.new('RGB', (40, 30), color).save(path)
+    return str(path)
+
+
+def _corpus(root):
+    return [_write(root, f'{index}.png', 'blurred' if index % 2 else 'sharp', (index * 20, 100, 200))
+            for index in range(5)]
+
+
+def test_pack_then_read(tmp_path):
+    _corpus(tmp_path / 'data')
+    (tmp_path / 'data' / 'sharp' / 'notes.txt').write_text('not an image')
+    packed = str(tmp_path / 'packed')
+    assert pack(str(tmp_path / 'data'), packed, size=SIZE, shard_size=2, log=lambda line: None) == 5
+
+    dataset = ShardedImageDataset(packed, raw=True)
+    # sorted class folders are the labels, as with ImageFolder
+    assert dataset.classes == ['blurred', 'sharp']
+    assert len(dataset) == 5
+    assert sorted((tmp_path / 'packed').glob('shard-*.npy')) == \
+        [tmp_path / 'packed' / f'shard-{number:05d}.npy' for number in range(3)]
+    for item, path in enumerate(dataset.paths):
+        image, label = dataset[item]
+        assert image.dtype == np.uint8 and image.shape == (SIZE, SIZE, 3)
+        assert np.array_equal(image, load_resized(path, SIZE))
+        assert dataset.classes[label] in path
+    assert np.array_equal(dataset[-1][0], dataset[4][0])
+    with pytest.raises(IndexError):
+        dataset[5]
+
+
+def test_tensors(tmp_path):
+    _corpus(tmp_path / 'data')
+    packed = str(tmp_path / 'packed')
+    pack(str(tmp_path / 'data'), packed, size=SIZE, shard_size=2, log=lambda line: None)
+    raw = ShardedImageDataset(packed, raw=True)
+    tensor, label = ShardedImageDataset(packed)[3]
+    assert tuple(tensor.shape) == (3, SIZE, SIZE)
+    assert label == raw[3][1]
+    assert np.allclose(tensor.permute(1, 2, 0).numpy() * 255, raw[3][0])
+    doubled, _ = ShardedImageDataset(packed, transform=lambda x: x * 2)[3]
+    assert np.allclose(doubled.numpy(), tensor.numpy() * 2)
+
+
+def test_pack_appends_only_new_images(tmp_path):
+    root = tmp_path / 'data'
+    _corpus(root)
+    packed = str(tmp_path / 'packed')
+    pack(str(root), packed, size=SIZE, shard_size=2, log=lambda line: None)
+    before = ShardedImageDataset(packed, raw=True)
+    first = [before[item][0] for item in range(len(before))]
+
+    _write(root, '9.png', 'sharp', (0, 0, 0))
+    assert pack(str(root), packed, size=SIZE, shard_size=2, log=lambda line: None) == 1
+    assert pack(str(root), packed, size=SIZE, shard_size=2, log=lambda line: None) == 0
+
+    index, labels, paths = read_index(packed)
+    assert index['count'] == 6 and len(labels) == 6
+    after = ShardedImageDataset(packed, raw=True)
+    for item, image in enumerate(first):
+        assert np.array_equal(after[item][0], image)
+    assert after.paths[5].endswith('9.png')
+    assert after.classes[after[5][1]] == 'sharp'
+    assert not after[5][0].any()
+
+
+def test_pack_rejects_other_classes(tmp_path):
+    _corpus(tmp_path / 'data')
+    packed = str(tmp_path / 'packed')
+    pack(str(tmp_path / 'data'), packed, size=SIZE, log=lambda line: None)
+    with pytest.raises(ValueError):
+        pack(str(tmp_path / 'data'), packed, classes=['sharp', 'blurred'], log=lambda line: None)
+
+
+def test_pickle_reopens_shards(tmp_path):
+    _corpus(tmp_path / 'data')
+    packed = str(tmp_path / 'packed')
+    pack(str(tmp_path / 'data'), packed, size=SIZE, shard_size=2, log=lambda line: None)
+    dataset = ShardedImageDataset(packed, raw=True)
+    image = dataset[2][0]
+    # what a DataLoader worker gets: no memory maps, the same images
+    copy = pickle.loads(pickle.dumps(dataset))
+    assert copy._shards == {}
+    assert np.array_equal(copy[2][0], image)
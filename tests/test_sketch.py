@@ -0,0 +1,94 @@
+import json
+
+import numpy as np
+import pytest
+
+from utility.sketch import QuantileSketch
+
+QUANTILES = (0.01, 0.1, 0.25, 0.5, 0.75, 0.9, 0.99)
+
+
+def _values(count=20000, seed=0):
+    # a wide, skewed range like the sharpness of a corpus
+    return np.random.default_rng(seed).lognormal(mean=5, sigma=2, size=count)
+
+
+def _sketch(values, accuracy=0.01, **kwargs):
+    sketch = QuantileSketch(accuracy, **kwargs)
+    sketch.add_many(values)
+    return sketch
+
+
+def _exact(values, q):
+    # the value of the rank quantile() looks up
+    return np.sort(values)[int(q * (len(values) - 1))]
+
+
+@pytest.mark.parametrize('accuracy', [0.01, 0.05])
+def test_quantile_within_relative_accuracy(accuracy):
+    values = _values()
+    sketch = _sketch(values, accuracy)
+    for q in QUANTILES:
+        exact = _exact(values, q)
+        assert abs(sketch.quantile(q) - exact) <= accuracy * exact * (1 + 1e-9)
+    assert sketch.quantile(0) == values.min()
+    assert sketch.quantile(1) == values.max()
+    assert sketch.mean == pytest.approx(values.mean())
+
+
+def test_merge_equals_sketch_of_all_values():
+    values = _values()
+    parts = np.array_split(values, 7)
+    merged = QuantileSketch()
+    # any order gives the same sketch
+    for part in reversed(parts):
+        merged.merge(_sketch(part))
+    whole = _sketch(values)
+    assert merged.buckets == whole.buckets
+    assert merged.count == whole.count
+    assert (merged.min, merged.max) == (whole.min, whole.max)
+    for q in QUANTILES:
+        assert merged.quantile(q) == whole.quantile(q)
+
+
+def test_merge_rejects_other_accuracy():
+    with pytest.raises(ValueError):
+        QuantileSketch(0.01).merge(QuantileSketch(0.02))
+
+
+def test_zeros_and_nans():
+    sketch = _sketch([0.0, 0.0, 0.0, np.nan, 10.0])
+    assert sketch.count == 4
+    assert sketch.quantile(0.5) == 0.0
+    assert sketch.quantile(1) == 10.0
+    with pytest.raises(ValueError):
+        sketch.add(-1.0)
+
+
+def test_empty_sketch():
+    sketch = QuantileSketch()
+    assert sketch.quantile(0.5) is None
+    assert sketch.mean is None
+
+
+def test_collapse_keeps_upper_quantiles():
+    values = _values()
+    sketch = _sketch(values, max_buckets=400)
+    assert len(sketch.buckets) == 400
+    # only the values in the lowest, folded bucket lose accuracy
+    folded = sketch.gamma ** min(sketch.buckets)
+    checked = [q for q in QUANTILES if _exact(values, q) > folded]
+    assert 0.5 in checked
+    for q in checked:
+        exact = _exact(values, q)
+        assert abs(sketch.quantile(q) - exact) <= 0.01 * exact * (1 + 1e-9)
+
+
+def test_dict_round_trip():
+    sketch = _sketch(_values(1000))
+    restored = QuantileSketch.from_dict(json.loads(json.dumps(sketch.to_dict())))
+    assert restored.buckets == sketch.buckets
+    for q in QUANTILES:
+        assert restored.quantile(q) == sketch.quantile(q)
+    empty = QuantileSketch.from_dict(QuantileSketch().to_dict())
+    assert empty.count == 0 and empty.quantile(0.5) is None
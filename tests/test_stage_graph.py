@@ -0,0 +1,71 @@
+import numpy as np
+import pytest
+
+from utility.helper import apply_adjustments
+from utility.stage_graph import ADJUSTMENT_STAGES, StageGraph, adjustment_graph, set_adjustments
+
+
+def _chain():
+    # a -> b -> c, and d reading a only
+    graph = StageGraph()
+    graph.add('a', lambda value: value, value=1)
+    graph.add('b', lambda a, value: a + value, inputs=('a',), keep=2, value=10)
+    graph.add('c', lambda b, value: b * value, inputs=('b',), value=2)
+    graph.add('d', lambda a, value: a - value, inputs=('a',), value=1)
+    return graph
+
+
+def test_outputs_follow_the_inputs():
+    graph = _chain()
+    assert graph.get('c') == 22
+    assert graph.get('d') == 0
+    graph.set('a', value=2)
+    assert graph.get('c') == 24
+    assert graph.get('d') == 1
+
+
+def test_only_downstream_stages_rerun():
+    graph = _chain()
+    graph.get('c')
+    graph.get('d')
+    graph.set('b', value=20)
+    assert graph.get('c') == 42
+    assert graph.get('d') == 0
+    assert graph.runs == {'a': 1, 'b': 2, 'c': 2, 'd': 1}
+
+
+def test_cached_values_are_kept_per_stage():
+    graph = _chain()
+    graph.get('c')
+    graph.set('b', value=20)
+    graph.get('c')
+    # b keeps two outputs, c only the last
+    graph.set('b', value=10)
+    assert graph.get('c') == 22
+    assert graph.runs['b'] == 2
+    assert graph.runs['c'] == 3
+
+
+def test_unknown_stages_and_parameters():
+    graph = _chain()
+    with pytest.raises(KeyError):
+        graph.add('e', lambda z: z, inputs=('z',))
+    with pytest.raises(KeyError):
+        graph.set('b', amount=3)
+
+
+def test_adjustment_graph_matches_apply_adjustments():
+    rng = np.random.default_rng(0)
+    restored = rng.integers(0, 256, (60, 80, 3), dtype=np.uint8)
+    recommended = {'saturation': 6.0, 'brightness': 4.0, 'contrast': 7.0, 'sharpness': 3.0}
+    graph = adjustment_graph(restored, recommended, {'interactive': {'proxy_max_pixels': 10 ** 6}})
+    assert graph.get('display').startswith(b'\xff\xd8')
+
+    values = dict(recommended, contrast=2.0)
+    set_adjustments(graph, values)
+    graph.get('display')
+    # only contrast and what follows it ran again
+    assert [graph.runs[name] for name in ADJUSTMENT_STAGES] == [1, 1, 2, 2]
+    # the proxy is the full image here, so the last stage is the full pass
+    expected = np.asarray(apply_adjustments(restored, *(values[name] for name in ADJUSTMENT_STAGES)))
+    assert np.array_equal(np.asarray(graph.get('sharpness')), expected)
@@ -0,0 +1,41 @@
+import cv2
+import numpy as np
+import pytest
+
+from utility.tiling import apply_banded, band_rows
+
+
+def _image(height=97, width=64, channels=3):
+    rng = np.random.default_rng(0)
+    return rng.integers(0, 256, (height, width, channels), dtype=np.uint8)
+
+
+def _blur(band):
+    return cv2.GaussianBlur(band, (7, 7), 0)
+
+
+@pytest.mark.parametrize('rows', [1, 5, 16, 97, 200])
+def test_apply_banded_matches_full_frame(rows):
+    image = _image()
+    expected = _blur(image)
+    assert np.array_equal(apply_banded(image, _blur, 3, rows), expected)
+
+
+@pytest.mark.parametrize('rows', [1, 7, 30])
+def test_apply_banded_in_place_matches_full_frame(rows):
+    image = _image()
+    expected = _blur(image)
+    result = apply_banded(image, _blur, 3, rows, out=image)
+    assert result is image
+    assert np.array_equal(image, expected)
+
+
+def test_apply_banded_gray():
+    image = _image(channels=1)[:, :, 0]
+    assert np.array_equal(apply_banded(image, _blur, 3, 10), _blur(image))
+
+
+def test_band_rows_fits_budget():
+    rows = band_rows(1000, 'filter', memory_budget=16 * 1000 * 100, halo=5)
+    assert rows == 90
+    assert band_rows(10 ** 9, 'denoise', memory_budget=1) == 1